@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for this module's geocoding internals. None of them need network access, as the end-to-end
+   benchmarks geocode against a local geo.replay.ReplayServer, and only location_saves() and
+   nearest_neighbours() need a database (with the Location table created); run them with `python -m geo.benchmarks` (with DJANGO_SETTINGS_MODULE
+   set) or call them individually."""
+import gc, sys, time
+from cStringIO import StringIO
+
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+
+from geo import cache, gazetteer, geocoding, replay, transport
+from geo.misc import GeocodingError
+from geo.replay import YAHOO_RESPONSE, GOOGLE_RESPONSE, GOOGLE_JSON_RESPONSE, GEONAMES_RESPONSE, GEONAMES_JSON_RESPONSE, compress, geonames_rows
+
+class StaticTransport(object):
+	"""A transport which returns the same response body for every request, optionally compressed with
+	   encoding ('gzip' or 'deflate'). received is the total number of body bytes read from it."""
+	def __init__(self, body, encoding=None, *args, **kwargs):
+		self.body, self.encoding = compress(body, encoding), encoding
+		self.received = 0
+		return super(StaticTransport, self).__init__(*args, **kwargs)
+	
+	def open(self, url, timeout=None):
+		def on_close(finished):
+			self.received += response.received
+		response = transport.Response(StringIO(self.body), self.encoding, on_close)
+		return response
+	
+	def fetch(self, url, timeout=None):
+		return self.body
+
+def deep_size(obj, seen=None):
+	"""Returns the approximate number of bytes used by obj and everything it references (strings shared with
+	   other objects, such as interned tag names, are only counted once)."""
+	if seen is None:
+		seen = set()
+	if id(obj) in seen:
+		return 0
+	seen.add(id(obj))
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict):
+		for key, value in obj.items():
+			size += deep_size(key, seen) + deep_size(value, seen)
+	elif isinstance(obj, (list, tuple)):
+		for item in obj:
+			size += deep_size(item, seen)
+	if hasattr(obj, '__dict__'):
+		size += deep_size(obj.__dict__, seen)
+	for name in getattr(type(obj), '__slots__', ()):
+		if hasattr(obj, name):
+			size += deep_size(getattr(obj, name), seen)
+	return size
+
+def result_memory(count=10000):
+	"""Geocodes a recorded Yahoo! response count times and reports the bytes used per GeocodingResult in
+	   memory and when pickled, and by the StoredResult persisted in Location.result."""
+	geocoder = geocoding.YahooGeocoder
+	geocoder.transport = StaticTransport(YAHOO_RESPONSE)
+	try:
+		results = [geocoder(u'London, UK').lookup() for i in range(count)]
+	finally:
+		geocoder.transport = None
+	seen = set()
+	in_memory = sum([deep_size(result, seen) for result in results])
+	pickled = len(pickle.dumps(results[0]))
+	stored = len(pickle.dumps(geocoding.store_result(results[0])))
+	return {
+		'results': count,
+		'bytes_per_result': in_memory / count,
+		'pickled_bytes_per_result': pickled,
+		'stored_bytes_per_result': stored,
+	}
+
+def response_formats(count=5000):
+	"""Reports the time per lookup() of the Google and GeoNames geocoders over recorded XML and JSON
+	   responses."""
+	stats = {}
+	for geocoder, body in ((geocoding.GoogleGeocoder, GOOGLE_RESPONSE), (geocoding.GoogleJSONGeocoder, GOOGLE_JSON_RESPONSE),
+			(geocoding.GeoNamesGeocoder, GEONAMES_RESPONSE), (geocoding.GeoNamesJSONGeocoder, GEONAMES_JSON_RESPONSE)):
+		geocoder.transport = StaticTransport(body)
+		try:
+			started = time.time()
+			for i in range(count):
+				geocoder(u'London, UK').lookup()
+			elapsed = time.time() - started
+		finally:
+			geocoder.transport = None
+		stats['%s_microseconds_per_lookup' % geocoder.short_name] = elapsed / count * 1000000
+	return stats
+
+def compressed_transfer(count=200, rows=1000):
+	"""Reports the bytes read per lookup() of a GeoNames response with the given number of rows, and the time
+	   taken, with and without gzip compression and streaming parsing."""
+	from django.conf import settings
+	body = geonames_rows(rows)
+	stats = {'response_bytes': len(body)}
+	streaming = getattr(settings, 'GEOCODING_STREAMING_PARSE', True)
+	try:
+		for encoding in (None, 'gzip'):
+			for settings.GEOCODING_STREAMING_PARSE in (False, True):
+				name = '%s_%s' % (encoding or 'identity', settings.GEOCODING_STREAMING_PARSE and 'streaming' or 'buffered')
+				geocoding.GeoNamesGeocoder.transport = static = StaticTransport(body, encoding)
+				started = time.time()
+				for i in range(count):
+					geocoding.GeoNamesGeocoder(u'London, UK').lookup()
+				stats['%s_microseconds_per_lookup' % name] = (time.time() - started) / count * 1000000
+				stats['%s_bytes_per_lookup' % name] = static.received / count
+	finally:
+		geocoding.GeoNamesGeocoder.transport = None
+		settings.GEOCODING_STREAMING_PARSE = streaming
+	return stats
+
+class Point(object):
+	"""A stand-in for a Location, for the proximity benchmarks."""
+	def __init__(self, latitude, longitude, *args, **kwargs):
+		self.latitude, self.longitude = latitude, longitude
+		return super(Point, self).__init__(*args, **kwargs)
+	
+	@property
+	def coords_tuple(self):
+		return (self.latitude, self.longitude)
+
+def random_points(count, origin=(51.5, -0.12), spread=2.0):
+	"""Returns count Points scattered within spread degrees of origin."""
+	import random
+	random.seed(0)
+	return [Point(origin[0] + random.uniform(-spread, spread), origin[1] + random.uniform(-spread, spread)) for i in range(count)]
+
+def counting_distances(function):
+	"""Calls function() and returns the number of distances it calculated (with geopy, or with
+	   geo.distances) and the time it took."""
+	from geopy import distance
+	from geo import distances
+	original, original_distances, calls = distance.distance, distances.distances, [0]
+	def counted(*args, **kwargs):
+		calls[0] += 1
+		return original(*args, **kwargs)
+	def counted_distances(origin, latitudes, longitudes, method=None):
+		calls[0] += len(latitudes)
+		return original_distances(origin, latitudes, longitudes, method)
+	distance.distance, distances.distances = counted, counted_distances
+	try:
+		started = time.time()
+		function()
+		return calls[0], time.time() - started
+	finally:
+		distance.distance, distances.distances = original, original_distances
+
+def proximity_ordering(count=10000, radius_miles=100):
+	"""Reports the distance calculations and time taken to filter count candidates to radius_miles and order
+	   them by proximity: by the original geopy filter and cmp sort, and by proximity.by_proximity() with each
+	   of the distances methods, with and without NumPy."""
+	from geo import distances, proximity
+	origin = (51.5, -0.12)
+	def original():
+		from geopy import distance
+		def proximity_cmp(current, previous):
+			return cmp(distance.distance(current.coords_tuple, origin).feet, distance.distance(previous.coords_tuple, origin).feet)
+		points = [point for point in random_points(count) if distance.distance((point.latitude, point.longitude), origin).miles <= radius_miles]
+		points.sort(proximity_cmp)
+	stats = {'candidates': count}
+	stats['cmp_sort_distance_calls'], stats['cmp_sort_seconds'] = counting_distances(original)
+	numpy = distances.numpy
+	try:
+		for distances.numpy, name in ((numpy, 'numpy'), (None, 'python')):
+			if name == 'numpy' and numpy is None:
+				continue
+			for method in distances.METHODS:
+				calls, seconds = counting_distances(lambda: proximity.by_proximity(random_points(count), origin, radius_miles, method))
+				stats['by_proximity_%s_%s_distance_calls' % (method, name)], stats['by_proximity_%s_%s_seconds' % (method, name)] = calls, seconds
+	finally:
+		distances.numpy = numpy
+	return stats
+
+def synthetic_gazetteer(count=100000):
+	"""Returns a Gazetteer of count made-up places spread over the globe."""
+	import random
+	random.seed(0)
+	lines = []
+	for i in range(count):
+		name = u'place %d' % i
+		lines.append(u'\t'.join([unicode(i), name, name, u'', unicode(random.uniform(-80, 80)), unicode(random.uniform(-180, 180)),
+			u'P', u'PPL', random.choice([u'GB', u'US', u'FR', u'AU']), u'', u'', u'', u'', u'', unicode(random.randint(0, 10 ** 6)), u'0']))
+	return gazetteer.Gazetteer().load(lines)
+
+def gazetteer_lookup(count=100000, lookups=10000):
+	"""Reports the time per Gazetteer.lookup() against a gazetteer of count places."""
+	import random
+	places = synthetic_gazetteer(count)
+	queries = [u'Place %d, US' % random.randint(0, count - 1) for i in range(lookups)]
+	started = time.time()
+	for query in queries:
+		places.lookup(query)
+	elapsed = time.time() - started
+	return {
+		'places': count,
+		'microseconds_per_lookup': elapsed / lookups * 1000000,
+	}
+
+def reverse_lookup(count=100000, lookups=10000):
+	"""Reports the time per Gazetteer.reverse() against a gazetteer of count places."""
+	import random
+	places = synthetic_gazetteer(count)
+	places.spatial_index # Build the index before timing
+	points = [(random.uniform(-80, 80), random.uniform(-180, 180)) for i in range(lookups)]
+	started = time.time()
+	for latitude, longitude in points:
+		places.reverse(latitude, longitude)
+	elapsed = time.time() - started
+	return {
+		'places': count,
+		'microseconds_per_lookup': elapsed / lookups * 1000000,
+	}
+
+def timed(name, function, count):
+	"""Calls function(i) for i in range(count), and returns a dictionary of the calls per second, their 50th
+	   and 99th percentile durations in milliseconds, and the number of objects each left for the garbage
+	   collector (i.e. in reference cycles) or still referenced afterwards."""
+	durations = []
+	gc.collect()
+	objects = len(gc.get_objects())
+	gc.disable()
+	try:
+		started = time.time()
+		for i in range(count):
+			call_started = time.time()
+			function(i)
+			durations.append(time.time() - call_started)
+		elapsed = time.time() - started
+		retained = len(gc.get_objects()) - objects
+	finally:
+		gc.enable()
+	durations.sort()
+	return {
+		'%s_requests_per_second' % name: count / elapsed,
+		'%s_p50_milliseconds' % name: durations[len(durations) // 2] * 1000,
+		'%s_p99_milliseconds' % name: durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000,
+		'%s_retained_objects_per_geocode' % name: float(retained) / count,
+	}
+
+def replaying(function, latency=0.002, max_connections=8):
+	"""Calls function() with the geocoders pointed at a ReplayServer adding latency seconds to every response,
+	   through a PooledHTTPTransport keeping up to max_connections connections, and returns its result."""
+	server = replay.ReplayServer(latency=latency, seed=0).start()
+	transport.set_transport(transport.PooledHTTPTransport(max_connections, host_overrides=server.host_overrides))
+	try:
+		return function()
+	finally:
+		transport.set_transport(None)
+		cache.get_cache().clear()
+		server.stop()
+
+def end_to_end(count=500, workers=8, latency=0.002):
+	"""Reports the throughput, latency and retained objects of lookup() for each online geocoder, and of
+	   geocode_many() with workers threads, against a ReplayServer."""
+	def run():
+		stats = {}
+		for geocoder in (geocoding.YahooGeocoder, geocoding.GoogleGeocoder, geocoding.GoogleJSONGeocoder, geocoding.GeoNamesGeocoder, geocoding.GeoNamesJSONGeocoder):
+			stats.update(timed(geocoder.short_name, lambda i: geocoder(u'London %d, UK' % i).lookup(), count))
+		started = time.time()
+		for query, result in geocoding.geocode_many([u'London %d, UK' % i for i in range(count)], 'geonames', workers):
+			if isinstance(result, GeocodingError):
+				raise result
+		stats['geocode_many_requests_per_second'] = count / (time.time() - started)
+		return stats
+	return replaying(run, latency, workers)
+
+def location_saves(count=200, latency=0.002):
+	"""Reports the throughput and latency of saving new Locations (geocoded with settings.DEFAULT_GEOCODER)
+	   against a ReplayServer. The Locations are deleted afterwards."""
+	from geo.models import Location
+	def run():
+		try:
+			return timed('save', lambda i: Location(query=u'Benchmark %d, UK' % i).save(), count)
+		finally:
+			Location.objects.filter(query__startswith=u'Benchmark ').delete()
+	return replaying(run, latency)
+
+def nearest_neighbours(count=5000, k=10, lookups=100):
+	"""Reports the rows fetched and time taken to find the k nearest of count Locations to each of lookups
+	   points: by ordering every row with by_proximity_to_location, and with LocationManager.nearest(). The
+	   Locations are deleted afterwards."""
+	from django.db import transaction
+	from geo import proximity
+	from geo.models import Location
+	def create():
+		for i, point in enumerate(random_points(count, spread=5.0)):
+			Location.objects.create(query=u'Benchmark %d' % i, geocoded=False, latitude=point.latitude, longitude=point.longitude)
+	transaction.commit_on_success(create)()
+	try:
+		origins = [(point.latitude, point.longitude) for point in random_points(lookups, spread=4.0)]
+		stats = {'locations': count, 'k': k}
+		stats['all_rows_distance_calls'], stats['all_rows_seconds'] = counting_distances(lambda: [proximity.by_proximity(Location.objects.all(), origin)[:k] for origin in origins])
+		stats['nearest_distance_calls'], stats['nearest_seconds'] = counting_distances(lambda: [Location.objects.nearest(origin, k) for origin in origins])
+		return stats
+	finally:
+		Location.objects.filter(query__startswith=u'Benchmark ').delete()
+
+def report(name, stats):
+	print '%s:' % name
+	for key in sorted(stats):
+		print '    %s: %s' % (key, stats[key])
+
+if __name__ == '__main__':
+	report('result_memory', result_memory())
+	report('response_formats', response_formats())
+	report('compressed_transfer', compressed_transfer())
+	report('end_to_end', end_to_end())
+	report('location_saves', location_saves())
+	report('proximity_ordering', proximity_ordering())
+	report('nearest_neighbours', nearest_neighbours())
+	report('gazetteer_lookup', gazetteer_lookup())
+	report('reverse_lookup', reverse_lookup())
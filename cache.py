@@ -0,0 +1,334 @@
+"""Caching of geocoding results. Results are keyed by the geocoder's short_name plus the normalized query,
+   and are looked up first in an in-process LRU cache and then (optionally) in Django's cache backend.
+   Concurrent geocodes of the same query are coalesced so that only one provider request is made, and
+   queries the provider couldn't geocode are remembered for a while so they aren't retried every time."""
+import hashlib, sys, threading, time
+
+from django.conf import settings
+
+from geo.misc import normalize_query, GeocodingTimeout
+
+class LRUCache(object):
+	"""A thread-safe, in-process least-recently-used cache holding at most max_size items, each of which
+	   expires ttl seconds after it was set (never, if ttl is None)."""
+	def __init__(self, max_size=1000, ttl=None, *args, **kwargs):
+		self.max_size, self.ttl = max_size, ttl
+		self.lock = threading.Lock()
+		# Maps key -> [previous link, next link, key, value, expiry time]; the links form a circular, doubly
+		# linked list with the most recently used item after self.root.
+		self.map = {}
+		self.root = []
+		self.root[:] = [self.root, self.root, None, None, None]
+		return super(LRUCache, self).__init__(*args, **kwargs)
+	
+	def __len__(self):
+		return len(self.map)
+	
+	def _unlink(self, link):
+		link[0][1], link[1][0] = link[1], link[0]
+	
+	def _push(self, link):
+		# Inserts link as the most recently used item.
+		link[0], link[1] = self.root, self.root[1]
+		self.root[1][0] = link
+		self.root[1] = link
+	
+	def get(self, key, default=None):
+		self.lock.acquire()
+		try:
+			link = self.map.get(key)
+			if link is None:
+				return default
+			if link[4] is not None and link[4] <= time.time():
+				self._unlink(link)
+				del self.map[key]
+				return default
+			self._unlink(link)
+			self._push(link)
+			return link[3]
+		finally:
+			self.lock.release()
+	
+	def set(self, key, value, ttl=None):
+		"""Stores value under key. ttl overrides the cache's default expiry for this item."""
+		if ttl is None:
+			ttl = self.ttl
+		expires = ttl is not None and time.time() + ttl or None
+		self.lock.acquire()
+		try:
+			link = self.map.get(key)
+			if link is not None:
+				self._unlink(link)
+				link[3], link[4] = value, expires
+			else:
+				link = self.map[key] = [None, None, key, value, expires]
+			self._push(link)
+			while len(self.map) > self.max_size:
+				oldest = self.root[0]
+				self._unlink(oldest)
+				del self.map[oldest[2]]
+		finally:
+			self.lock.release()
+	
+	def delete(self, key):
+		self.lock.acquire()
+		try:
+			link = self.map.pop(key, None)
+			if link is not None:
+				self._unlink(link)
+		finally:
+			self.lock.release()
+	
+	def clear(self):
+		self.lock.acquire()
+		try:
+			self.map.clear()
+			self.root[:] = [self.root, self.root, None, None, None]
+		finally:
+			self.lock.release()
+
+class _Call(object):
+	"""An in-flight SingleFlight call."""
+	def __init__(self, *args, **kwargs):
+		self.event = threading.Event()
+		self.result = None
+		self.error = None
+		return super(_Call, self).__init__(*args, **kwargs)
+
+class SingleFlight(object):
+	"""Makes sure only one call for a given key is in flight at once in this process: callers arriving while
+	   it runs wait for it and share its result (or exception) rather than making their own call."""
+	def __init__(self, *args, **kwargs):
+		self.lock = threading.Lock()
+		self.calls = {}
+		self.shared = 0 # How many callers have been handed another caller's result
+		return super(SingleFlight, self).__init__(*args, **kwargs)
+	
+	def do(self, key, function, args=(), timeout=None):
+		"""Calls function(*args), unless a call for key is already in flight, in which case its outcome is
+		   waited for (for at most timeout seconds, after which GeocodingTimeout is raised) and returned (or
+		   raised) instead."""
+		self.lock.acquire()
+		call = self.calls.get(key)
+		if call is not None:
+			self.shared += 1
+			self.lock.release()
+			call.event.wait(timeout)
+			if not call.event.isSet():
+				raise GeocodingTimeout('Timed out waiting for another geocode of the same query.')
+			if call.error is not None:
+				raise call.error[0], call.error[1], call.error[2]
+			return call.result
+		call = self.calls[key] = _Call()
+		self.lock.release()
+		try:
+			try:
+				call.result = function(*args)
+			except:
+				call.error = sys.exc_info()
+				raise
+		finally:
+			self.lock.acquire()
+			del self.calls[key]
+			self.lock.release()
+			call.event.set()
+		return call.result
+
+class GeocodeCache(object):
+	"""Two-tier cache of GeocodingResults. The first tier is an in-process LRUCache (disabled if max_size is
+	   0); the second is Django's cache backend, used if use_django_cache is True. Hit and miss counts for
+	   each tier are available from stats()."""
+	def __init__(self, max_size=1000, ttl=60 * 60 * 24, use_django_cache=False, lock_timeout=None, negative_ttl=300, max_negative_ttl=60 * 60 * 24, *args, **kwargs):
+		self.ttl = ttl
+		# Failed queries are blocked for negative_ttl seconds, doubling with each consecutive failure up to
+		# max_negative_ttl (0 disables negative caching).
+		self.negative_ttl, self.max_negative_ttl = negative_ttl, max_negative_ttl
+		self.failures = None
+		if negative_ttl:
+			self.failures = LRUCache(max_size or 1000, max_negative_ttl * 2)
+		# If set (and use_django_cache is True), geocodes are also coalesced across processes by taking a lock
+		# in Django's cache for up to lock_timeout seconds.
+		self.lock_timeout = lock_timeout
+		self.local = None
+		if max_size:
+			self.local = LRUCache(max_size, ttl)
+		self.use_django_cache = use_django_cache
+		self.counts = {'local_hits': 0, 'django_hits': 0, 'misses': 0, 'negative_hits': 0}
+		self.counts_lock = threading.Lock()
+		return super(GeocodeCache, self).__init__(*args, **kwargs)
+	
+	def key(self, short_name, query):
+		"""Returns the cache key for query as geocoded by the geocoder with short_name."""
+		return ('geo:%s:%s' % (short_name, normalize_query(query))).encode('utf-8')
+	
+	def django_key(self, short_name, query):
+		"""Returns the key for query in Django's cache. The normalized query is hashed, as backends such as
+		   memcached don't allow spaces or control characters in keys, or keys longer than 250 bytes."""
+		return 'geo:%s:%s' % (short_name.encode('utf-8'), hashlib.md5(normalize_query(query).encode('utf-8')).hexdigest())
+	
+	def count(self, name):
+		self.counts_lock.acquire()
+		try:
+			self.counts[name] += 1
+		finally:
+			self.counts_lock.release()
+	
+	def get(self, short_name, query, record=True):
+		"""Returns the cached result for query, or None. The lookup only counts towards stats() if record is
+		   True."""
+		key = self.key(short_name, query)
+		if self.local is not None:
+			result = self.local.get(key)
+			if result is not None:
+				if record:
+					self.count('local_hits')
+				return result
+		if self.use_django_cache:
+			from django.core.cache import cache
+			result = cache.get(self.django_key(short_name, query))
+			if result is not None:
+				if record:
+					self.count('django_hits')
+				if self.local is not None:
+					self.local.set(key, result)
+				return result
+		if record:
+			self.count('misses')
+		return None
+	
+	def set(self, short_name, query, result):
+		key = self.key(short_name, query)
+		if self.local is not None:
+			self.local.set(key, result)
+		if self.use_django_cache:
+			from django.core.cache import cache
+			cache.set(self.django_key(short_name, query), result, self.ttl)
+	
+	def delete(self, short_name, query):
+		key = self.key(short_name, query)
+		if self.local is not None:
+			self.local.delete(key)
+		if self.use_django_cache:
+			from django.core.cache import cache
+			cache.delete(self.django_key(short_name, query))
+	
+	def failure_record(self, short_name, query):
+		# Failures are stored as (consecutive failures, blocked until, error message)
+		failure = self.failures.get(self.key(short_name, query))
+		if failure is None and self.use_django_cache:
+			from django.core.cache import cache
+			failure = cache.get(self.django_key(short_name, query) + ':failure')
+		return failure
+	
+	def get_failure(self, short_name, query):
+		"""Returns the error message of a recent failure to geocode query that hasn't yet been backed off from,
+		   or None."""
+		if self.failures is None:
+			return None
+		failure = self.failure_record(short_name, query)
+		if failure is not None and failure[1] > time.time():
+			self.count('negative_hits')
+			return failure[2]
+		return None
+	
+	def set_failure(self, short_name, query, message):
+		"""Records a failure to geocode query. Returns the number of seconds it will be blocked for."""
+		if self.failures is None:
+			return 0
+		previous = self.failure_record(short_name, query)
+		failures = previous and previous[0] + 1 or 1
+		ttl = min(self.max_negative_ttl, self.negative_ttl * 2 ** (failures - 1))
+		# The failure count is kept beyond the block so that the next failure backs off further
+		failure = (failures, time.time() + ttl, message)
+		self.failures.set(self.key(short_name, query), failure)
+		if self.use_django_cache:
+			from django.core.cache import cache
+			cache.set(self.django_key(short_name, query) + ':failure', failure, int(self.max_negative_ttl * 2))
+		return ttl
+	
+	def delete_failure(self, short_name, query):
+		"""Forgets any failures to geocode query (after it has been geocoded successfully)."""
+		if self.failures is None:
+			return
+		self.failures.delete(self.key(short_name, query))
+		if self.use_django_cache:
+			# Even without a local record, as the failure may have been recorded by another process
+			from django.core.cache import cache
+			cache.delete(self.django_key(short_name, query) + ':failure')
+	
+	def acquire(self, short_name, query, timeout=None):
+		"""Takes the cross-process lock on query in Django's cache, if lock_timeout is set. Returns a two-tuple
+		   of (result, locked): if another process holds the lock, this waits (for at most lock_timeout seconds,
+		   or timeout if that's shorter) for it to store its result, and returns that result. locked is True if
+		   the caller now holds the lock and must release() it."""
+		if not (self.use_django_cache and self.lock_timeout):
+			return None, False
+		from django.core.cache import cache
+		key = self.django_key(short_name, query)
+		give_up = time.time() + min(self.lock_timeout, timeout is None and self.lock_timeout or timeout)
+		while time.time() < give_up:
+			# add() only succeeds if the key isn't already set, so only one process can take the lock
+			if cache.add(key + ':lock', 1, int(self.lock_timeout) or 1):
+				return None, True
+			result = cache.get(key)
+			if result is not None:
+				self.count('django_hits')
+				return result, False
+			time.sleep(0.05)
+		return None, False
+	
+	def release(self, short_name, query):
+		"""Releases the cross-process lock taken by acquire()."""
+		from django.core.cache import cache
+		cache.delete(self.django_key(short_name, query) + ':lock')
+	
+	def clear(self):
+		"""Empties the in-process tier and resets the counters (Django's cache is left alone)."""
+		if self.local is not None:
+			self.local.clear()
+		if self.failures is not None:
+			self.failures.clear()
+		self.counts_lock.acquire()
+		try:
+			for name in self.counts:
+				self.counts[name] = 0
+		finally:
+			self.counts_lock.release()
+	
+	def stats(self):
+		"""Returns a dictionary of hit/miss counts, the overall hit ratio and the in-process tier's size."""
+		stats = dict(self.counts)
+		lookups = stats['local_hits'] + stats['django_hits'] + stats['misses']
+		stats['failures'] = self.failures is not None and len(self.failures) or 0
+		stats['hit_ratio'] = lookups and float(lookups - stats['misses']) / lookups or 0.0
+		stats['size'] = self.local is not None and len(self.local) or 0
+		return stats
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+	"""Returns the shared GeocodeCache, configured from settings.GEOCODING_CACHE_SIZE (in-process items,
+	   0 to disable), settings.GEOCODING_CACHE_TTL (seconds), settings.GEOCODING_USE_DJANGO_CACHE,
+	   settings.GEOCODING_LOCK_TIMEOUT (seconds to wait on another process geocoding the same query; None
+	   disables cross-process locking), settings.GEOCODING_NEGATIVE_CACHE_TTL (seconds to block a query after
+	   it fails, doubling with each consecutive failure; 0 disables) and
+	   settings.GEOCODING_NEGATIVE_CACHE_MAX_TTL."""
+	global _cache
+	if _cache is None:
+		_cache_lock.acquire()
+		try:
+			if _cache is None:
+				_cache = GeocodeCache(
+					max_size=getattr(settings, 'GEOCODING_CACHE_SIZE', 1000),
+					ttl=getattr(settings, 'GEOCODING_CACHE_TTL', 60 * 60 * 24),
+					use_django_cache=getattr(settings, 'GEOCODING_USE_DJANGO_CACHE', False),
+					lock_timeout=getattr(settings, 'GEOCODING_LOCK_TIMEOUT', None),
+					negative_ttl=getattr(settings, 'GEOCODING_NEGATIVE_CACHE_TTL', 300),
+					max_negative_ttl=getattr(settings, 'GEOCODING_NEGATIVE_CACHE_MAX_TTL', 60 * 60 * 24),
+				)
+		finally:
+			_cache_lock.release()
+	return _cache
+
+single_flight = SingleFlight()
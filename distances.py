@@ -0,0 +1,116 @@
+"""Distances in kilometers from one origin to many points at once. With NumPy installed, each calculation is
+   a single vectorized pass over arrays of latitudes and longitudes; without it, the same formulae are
+   applied one point at a time. method is 'haversine' (a sphere: fast, to within about 0.5%) or 'vincenty'
+   (the WGS-84 ellipsoid, as geopy's distance uses), defaulting to settings.GEOCODING_DISTANCE_METHOD."""
+import math
+
+from django.conf import settings
+from geopy import distance as geopy_distance
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+METHODS = ('haversine', 'vincenty')
+MAJOR, MINOR, FLATTENING = geopy_distance.ELLIPSOIDS['WGS-84']
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine(origin, latitudes, longitudes):
+	"""Returns the great-circle distances from origin (a lat/long pair) to each of the points, as a NumPy
+	   array."""
+	latitude, longitude = map(math.radians, origin[:2])
+	latitudes, longitudes = numpy.radians(latitudes), numpy.radians(longitudes)
+	a = numpy.sin((latitudes - latitude) / 2) ** 2 + math.cos(latitude) * numpy.cos(latitudes) * numpy.sin((longitudes - longitude) / 2) ** 2
+	return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+def vincenty(origin, latitudes, longitudes, iterations=20, tolerance=1e-11):
+	"""Returns the distances on the WGS-84 ellipsoid from origin (a lat/long pair) to each of the points, as
+	   a NumPy array. Vincenty's formula doesn't converge for nearly antipodal points; their great-circle
+	   distances are returned instead."""
+	latitudes, longitudes = numpy.asarray(latitudes, dtype=float), numpy.asarray(longitudes, dtype=float)
+	reduced1 = math.atan((1 - FLATTENING) * math.tan(math.radians(origin[0])))
+	reduced2 = numpy.arctan((1 - FLATTENING) * numpy.tan(numpy.radians(latitudes)))
+	sin_reduced1, cos_reduced1 = math.sin(reduced1), math.cos(reduced1)
+	sin_reduced2, cos_reduced2 = numpy.sin(reduced2), numpy.cos(reduced2)
+	delta_lng = numpy.radians(longitudes - origin[1])
+	lambda_lng = delta_lng
+	converged = numpy.zeros(latitudes.shape, dtype=bool)
+	errors = numpy.seterr(divide='ignore', invalid='ignore')
+	try:
+		for i in range(iterations):
+			sin_lambda_lng, cos_lambda_lng = numpy.sin(lambda_lng), numpy.cos(lambda_lng)
+			sin_sigma = numpy.sqrt((cos_reduced2 * sin_lambda_lng) ** 2 + (cos_reduced1 * sin_reduced2 - sin_reduced1 * cos_reduced2 * cos_lambda_lng) ** 2)
+			cos_sigma = sin_reduced1 * sin_reduced2 + cos_reduced1 * cos_reduced2 * cos_lambda_lng
+			sigma = numpy.arctan2(sin_sigma, cos_sigma)
+			# Coincident points have sin_sigma == 0, and points on the equator cos_sq_alpha == 0
+			sin_alpha = numpy.where(sin_sigma == 0, 0.0, cos_reduced1 * cos_reduced2 * sin_lambda_lng / sin_sigma)
+			cos_sq_alpha = 1 - sin_alpha ** 2
+			cos2_sigma_m = numpy.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_reduced1 * sin_reduced2 / cos_sq_alpha)
+			c = FLATTENING / 16. * cos_sq_alpha * (4 + FLATTENING * (4 - 3 * cos_sq_alpha))
+			previous = lambda_lng
+			lambda_lng = delta_lng + (1 - c) * FLATTENING * sin_alpha * (sigma + c * sin_sigma * (cos2_sigma_m + c * cos_sigma * (-1 + 2 * cos2_sigma_m ** 2)))
+			converged = numpy.abs(lambda_lng - previous) <= tolerance
+			if converged.all():
+				break
+	finally:
+		numpy.seterr(**errors)
+	u_sq = cos_sq_alpha * (MAJOR ** 2 - MINOR ** 2) / MINOR ** 2
+	a = 1 + u_sq / 16384. * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+	b = u_sq / 1024. * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+	delta_sigma = b * sin_sigma * (cos2_sigma_m + b / 4. * (cos_sigma * (-1 + 2 * cos2_sigma_m ** 2) - b / 6. * cos2_sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos2_sigma_m ** 2)))
+	kilometers = MINOR * a * (sigma - delta_sigma)
+	if not converged.all():
+		kilometers = numpy.where(converged, kilometers, haversine(origin, latitudes, longitudes))
+	return kilometers
+
+def bounding_box(latitude, longitude, distance, units='kilometers', margin=0.01):
+	"""Returns the smallest (south, west, north, east) box holding every point within distance (in units:
+	   'kilometers' or 'miles') of a point: the bounds of the spherical cap around it, widened by margin (a
+	   fraction) to allow for the ellipsoid. west > east if the box crosses the antimeridian, and it spans
+	   every longitude if the cap covers a pole."""
+	kilometers = geopy_distance.Distance(**{str(units): distance}).kilometers
+	angle = math.degrees(kilometers * (1 + margin) / EARTH_RADIUS_KM)
+	south, north = latitude - angle, latitude + angle
+	if south <= -90.0 or north >= 90.0 or angle >= 90.0:
+		return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+	# The widest point of the cap isn't level with its centre, but is found from the cap's tangent meridians
+	width = math.degrees(math.asin(min(1.0, math.sin(math.radians(angle)) / math.cos(math.radians(latitude)))))
+	west, east = longitude - width, longitude + width
+	if west < -180.0:
+		west += 360.0
+	if east > 180.0:
+		east -= 360.0
+	return south, west, north, east
+
+def python_haversine(latitude1, longitude1, latitude2, longitude2):
+	"""Returns the great-circle distance in kilometers between two points (in degrees) on a spherical earth."""
+	latitude1, longitude1, latitude2, longitude2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+	a = math.sin((latitude2 - latitude1) / 2) ** 2 + math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+	return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def python_vincenty(latitude1, longitude1, latitude2, longitude2):
+	try:
+		return geopy_distance.VincentyDistance((latitude1, longitude1), (latitude2, longitude2)).kilometers
+	except ValueError:
+		# Didn't converge, as for the vectorized version
+		return python_haversine(latitude1, longitude1, latitude2, longitude2)
+
+def get_method(method=None):
+	method = method or getattr(settings, 'GEOCODING_DISTANCE_METHOD', 'vincenty')
+	if method not in METHODS:
+		raise ValueError('Unknown distance method: %s' % method)
+	return method
+
+def distances(origin, latitudes, longitudes, method=None):
+	"""Returns the distances in kilometers from origin (a lat/long pair) to each of the points given by the
+	   sequences latitudes and longitudes: a NumPy array if NumPy is available, otherwise a list."""
+	method = get_method(method)
+	if numpy is not None:
+		return (method == 'vincenty' and vincenty or haversine)(origin, latitudes, longitudes)
+	function = method == 'vincenty' and python_vincenty or python_haversine
+	return [function(origin[0], origin[1], latitude, longitude) for latitude, longitude in zip(latitudes, longitudes)]
+
+def distance(origin, point, method=None):
+	"""Returns the distance in kilometers between two lat/long pairs."""
+	return float(distances(origin, [point[0]], [point[1]], method)[0])
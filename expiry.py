@@ -0,0 +1,83 @@
+"""When Locations expire and need re-geocoding. Coarse results (a country, say) rarely change so are kept for
+   longer than street-level ones, and each location's expiry is brought forward by a deterministic fraction
+   of its lifetime, so that rows created together don't all expire (and hit the geocoder) at once. The
+   computed time is stored in Location.expires_at, which LocationManager.expired queries."""
+import datetime, threading, zlib
+
+from django.conf import settings
+
+from geo.dateutil.relativedelta import relativedelta
+
+# (coarsest Google zoom level, relativedelta arguments) pairs: results at or above a level are kept for that
+# long, or for settings.MAX_LOCATION_CACHE_AGE if that's longer. Results finer than the last level (or of
+# unknown granularity) use settings.MAX_LOCATION_CACHE_AGE.
+DEFAULT_MAX_AGES = (
+	(3, {'years': 1}), # Country
+	(9, {'months': 6}), # State
+	(11, {'months': 3}), # City
+)
+
+class ExpiryPolicy(object):
+	"""Works out when a location expires. max_age (relativedelta arguments) applies to results finer than any
+	   of max_ages, a sequence of (Google zoom level, relativedelta arguments) pairs which can only lengthen
+	   it, so a coarse result is never kept for less time than a fine one. A location's expiry is brought
+	   forward by up to jitter (a fraction) of its lifetime, depending on a hash of its query."""
+	def __init__(self, max_age=None, max_ages=DEFAULT_MAX_AGES, jitter=0.1, *args, **kwargs):
+		self.max_age = max_age or settings.MAX_LOCATION_CACHE_AGE
+		self.max_ages = sorted(max_ages)
+		self.jitter = jitter
+		return super(ExpiryPolicy, self).__init__(*args, **kwargs)
+	
+	def lifetime(self, granularity):
+		"""Returns the relativedelta a result of the given granularity is kept for."""
+		if granularity:
+			for coarsest, max_age in self.max_ages:
+				if granularity <= coarsest:
+					return relativedelta(**max_age)
+		return relativedelta(**self.max_age)
+	
+	def spread(self, query):
+		"""Returns a fraction between 0 and 1 that's always the same for query."""
+		return (zlib.crc32(unicode(query).encode('utf-8')) & 0xffffffff) / float(0x100000000)
+	
+	def expires(self, refreshed, granularity=0, query=u''):
+		"""Returns the datetime when a result refreshed at refreshed expires."""
+		# Months and years vary in length, so lifetimes are compared as dates rather than as relativedeltas
+		expires = max(refreshed + self.lifetime(granularity), refreshed + relativedelta(**self.max_age))
+		lifetime = expires - refreshed
+		seconds = (lifetime.days * 86400 + lifetime.seconds) * self.jitter * self.spread(query)
+		return expires - datetime.timedelta(seconds=int(seconds))
+	
+	def location_expires(self, location):
+		"""Returns the datetime when location expires, according to its result's granularity."""
+		granularity = hasattr(location.result, 'coords') and location.result.coords.granularity or 0
+		return self.expires(location.refreshed, granularity, location.query)
+
+_policy = None
+_policy_lock = threading.Lock()
+
+def get_expiry_policy():
+	"""Returns the shared ExpiryPolicy, configured from settings.MAX_LOCATION_CACHE_AGE,
+	   settings.GEOCODING_EXPIRY_MAX_AGES and settings.GEOCODING_EXPIRY_JITTER on first use."""
+	global _policy
+	if _policy is None:
+		_policy_lock.acquire()
+		try:
+			if _policy is None:
+				_policy = ExpiryPolicy(
+					max_ages=getattr(settings, 'GEOCODING_EXPIRY_MAX_AGES', DEFAULT_MAX_AGES),
+					jitter=getattr(settings, 'GEOCODING_EXPIRY_JITTER', 0.1),
+				)
+		finally:
+			_policy_lock.release()
+	return _policy
+
+def set_expiry_policy(policy):
+	"""Replaces the shared ExpiryPolicy. Passing None makes the next get_expiry_policy() call rebuild it from
+	   settings."""
+	global _policy
+	_policy_lock.acquire()
+	try:
+		_policy = policy
+	finally:
+		_policy_lock.release()
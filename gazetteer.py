@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""An offline gazetteer built from a GeoNames dump (a tab-separated 'geoname' table such as cities1000.txt or
+   allCountries.txt, see http://download.geonames.org/export/dump/). Places are held in compact parallel
+   arrays with a hash index of normalized names, so common place names can be resolved locally without
+   calling a geocoding service. A grid index over the populated places also allows reverse geocoding."""
+import bisect, gzip, math, threading
+from array import array
+
+from django.conf import settings
+
+from geo.distances import bounding_box, python_haversine, EARTH_RADIUS_KM
+from geo.misc import normalize_query, country_codes
+
+# Columns of the GeoNames 'geoname' table used here
+NAME, ASCII_NAME, ALTERNATE_NAMES, LATITUDE, LONGITUDE, FEATURE_CLASS, FEATURE_CODE, COUNTRY_CODE = 1, 2, 3, 4, 5, 6, 7, 8
+POPULATION, ELEVATION = 14, 15
+
+# Zoom levels (as in misc.yahoo_precision_to_google_zoom_mappings) for GeoNames feature codes
+feature_code_to_google_zoom_mappings = {
+	'PCLI': 3, 'PCLD': 3, 'PCLF': 3, 'PCLS': 3, 'PCL': 3,
+	'ADM1': 9, 'ADM2': 10, 'ADM3': 10, 'ADM4': 11,
+}
+DEFAULT_ZOOM = 11 # Populated places, and anything else
+
+# Lookup from normalized country names and common aliases to ISO codes, for queries like u'paris, france'
+country_names = dict([(normalize_query(name), code) for code, name in country_codes.items()])
+country_names.update({u'uk': u'GB', u'england': u'GB', u'scotland': u'GB', u'wales': u'GB', u'usa': u'US', u'america': u'US'})
+
+class Place(object):
+	"""A single gazetteer entry."""
+	__slots__ = ('index', 'name', 'latitude', 'longitude', 'elevation', 'country_code', 'feature_code', 'population', 'distance')
+	
+	def __init__(self, index, name, latitude, longitude, elevation, country_code, feature_code, population, distance=None):
+		self.index, self.name, self.latitude, self.longitude = index, name, latitude, longitude
+		self.elevation, self.country_code, self.feature_code, self.population = elevation, country_code, feature_code, population
+		self.distance = distance # In kilometers from the point searched for, for places found by reverse geocoding
+	
+	def __repr__(self):
+		return '<Place: %s, %s (%s, %s)>' % (self.name.encode('utf-8'), self.country_code, self.latitude, self.longitude)
+	
+	@property
+	def country(self):
+		"""The place's country name from misc.country_codes (or its code, if it isn't in there)."""
+		return country_codes.get(self.country_code, self.country_code)
+	
+	@property
+	def granularity(self):
+		return feature_code_to_google_zoom_mappings.get(self.feature_code, DEFAULT_ZOOM)
+
+class SpatialIndex(object):
+	"""A grid of cell_size degree cells over a Gazetteer's populated places, for nearest-neighbour searches."""
+	def __init__(self, gazetteer, cell_size=1.0, *args, **kwargs):
+		self.gazetteer, self.cell_size = gazetteer, float(cell_size)
+		self.rows, self.columns = int(math.ceil(180 / self.cell_size)), int(math.ceil(360 / self.cell_size))
+		self.cells = {}
+		for index in xrange(len(gazetteer)):
+			if gazetteer.feature_codes[index].startswith('PPL'):
+				cell = self.cell(gazetteer.latitudes[index], gazetteer.longitudes[index])
+				self.cells.setdefault(cell, array('l')).append(index)
+		return super(SpatialIndex, self).__init__(*args, **kwargs)
+	
+	def cell(self, latitude, longitude):
+		"""Returns the (row, column) of the cell containing a point."""
+		row = min(self.rows - 1, int((latitude + 90) / self.cell_size))
+		column = int((longitude + 180) / self.cell_size) % self.columns
+		return row, column
+	
+	def cells_within(self, latitude, longitude, distance):
+		"""Yields every cell which could hold a place within distance kilometers of a point: those overlapping
+		   the bounding box of the spherical cap around it (see distances.bounding_box())."""
+		south, west, north, east = bounding_box(latitude, longitude, distance, margin=0)
+		first_row, last_row = self.cell(south, 0)[0], self.cell(north, 0)[0]
+		if west == -180.0 and east == 180.0:
+			columns = xrange(self.columns)
+		else:
+			first_column = int(math.floor((west + 180) / self.cell_size))
+			last_column = int(math.floor((east + 180) / self.cell_size))
+			if west > east:
+				# The box crosses the antimeridian
+				last_column += self.columns
+			if last_column - first_column + 1 >= self.columns:
+				columns = xrange(self.columns)
+			else:
+				columns = [column % self.columns for column in xrange(first_column, last_column + 1)]
+		for row in xrange(first_row, last_row + 1):
+			for column in columns:
+				yield row, column
+	
+	def nearest(self, latitude, longitude):
+		"""Returns (index, distance in kilometers) of the nearest populated place to a point, or (None, None) if
+		   the index is empty. The search radius doubles until it holds a place at least as close as itself, so
+		   only the cells near the point are examined."""
+		gazetteer = self.gazetteer
+		best, best_distance = None, None
+		searched = set()
+		radius = math.radians(self.cell_size) * EARTH_RADIUS_KM
+		while True:
+			for cell in self.cells_within(latitude, longitude, radius):
+				if cell in searched:
+					continue
+				searched.add(cell)
+				for index in self.cells.get(cell, ()):
+					distance = python_haversine(latitude, longitude, gazetteer.latitudes[index], gazetteer.longitudes[index])
+					if best_distance is None or distance < best_distance:
+						best, best_distance = index, distance
+			if (best_distance is not None and best_distance <= radius) or radius >= math.pi * EARTH_RADIUS_KM:
+				return best, best_distance
+			radius *= 2
+
+class Gazetteer(object):
+	"""In-memory place name index. Places are stored column-wise in arrays; self.index maps each normalized
+	   name (and alternate name) to the most populous place with that name in each country, and
+	   self.sorted_names holds the same names in order for prefix searches."""
+	def __init__(self, *args, **kwargs):
+		self.names = []
+		self.latitudes = array('d')
+		self.longitudes = array('d')
+		self.elevations = array('d')
+		self.populations = array('l')
+		self.country_codes = []
+		self.feature_codes = []
+		self.index = {}
+		self.sorted_names = []
+		self._spatial_index = None
+		return super(Gazetteer, self).__init__(*args, **kwargs)
+	
+	def __len__(self):
+		return len(self.names)
+	
+	def load(self, lines, feature_classes=('P', 'A'), alternate_names=True):
+		"""Loads places from an iterable of lines (e.g. an open file) in GeoNames format. Only features in
+		   feature_classes are kept (populated places and administrative areas by default)."""
+		interned = {}
+		for line in lines:
+			if isinstance(line, str):
+				line = line.decode('utf-8')
+			fields = line.rstrip(u'\r\n').split(u'\t')
+			if len(fields) < 15 or fields[FEATURE_CLASS] not in feature_classes:
+				continue
+			try:
+				latitude, longitude = float(fields[LATITUDE]), float(fields[LONGITUDE])
+				population = int(fields[POPULATION] or 0)
+				elevation = float(len(fields) > ELEVATION and fields[ELEVATION] or 0)
+			except ValueError:
+				continue
+			index = len(self.names)
+			self.names.append(fields[NAME])
+			self.latitudes.append(latitude)
+			self.longitudes.append(longitude)
+			self.elevations.append(elevation)
+			self.populations.append(population)
+			self.country_codes.append(interned.setdefault(fields[COUNTRY_CODE], fields[COUNTRY_CODE]))
+			self.feature_codes.append(interned.setdefault(fields[FEATURE_CODE], fields[FEATURE_CODE]))
+			names = [fields[NAME], fields[ASCII_NAME]]
+			if alternate_names and fields[ALTERNATE_NAMES]:
+				names.extend(fields[ALTERNATE_NAMES].split(u','))
+			for name in names:
+				self.add_name(normalize_query(name), index)
+		self.sorted_names = sorted(self.index)
+		self._spatial_index = None
+		return self
+	
+	def add_name(self, name, index):
+		# Entries are a single index, or a tuple of indexes (one per country) for names used in several
+		# countries; within a country only the most populous place keeps the name.
+		if not name:
+			return
+		existing = self.index.get(name)
+		if existing is None:
+			self.index[name] = index
+			return
+		if not isinstance(existing, tuple):
+			existing = (existing,)
+		country = self.country_codes[index]
+		for position, other in enumerate(existing):
+			if self.country_codes[other] == country:
+				if self.populations[index] > self.populations[other]:
+					existing = existing[:position] + (index,) + existing[position + 1:]
+				break
+		else:
+			existing = existing + (index,)
+		if len(existing) == 1:
+			existing = existing[0]
+		self.index[name] = existing
+	
+	def place(self, index, distance=None):
+		"""Returns the Place at index."""
+		return Place(index, self.names[index], self.latitudes[index], self.longitudes[index], self.elevations[index],
+			self.country_codes[index], self.feature_codes[index], self.populations[index], distance)
+	
+	@property
+	def spatial_index(self):
+		"""The SpatialIndex over this gazetteer's populated places (built on first use)."""
+		if self._spatial_index is None:
+			self._spatial_index = SpatialIndex(self, getattr(settings, 'GEOCODING_GAZETTEER_CELL_SIZE', 1.0))
+		return self._spatial_index
+	
+	def reverse(self, latitude, longitude):
+		"""Returns the nearest populated Place to a point (with its distance set), or None if there are none."""
+		index, distance = self.spatial_index.nearest(float(latitude), float(longitude))
+		if index is None:
+			return None
+		return self.place(index, distance)
+	
+	def reverse_many(self, latitudes, longitudes):
+		"""Returns a list of the nearest populated Places to each of the points given by two sequences (lists,
+		   arrays, etc.) of latitudes and longitudes."""
+		return [self.reverse(latitude, longitude) for latitude, longitude in zip(latitudes, longitudes)]
+	
+	def candidates(self, name):
+		"""Returns the indexes of the places called name (already normalized)."""
+		found = self.index.get(name)
+		if found is None:
+			return ()
+		if isinstance(found, tuple):
+			return found
+		return (found,)
+	
+	def lookup(self, query):
+		"""Returns the best matching Place for a free-text query, or None. u'London' finds the most populous
+		   London; u'London, Canada' or u'London, CA' restricts the search to that country."""
+		query = normalize_query(query)
+		candidates = self.candidates(query)
+		country = None
+		if not candidates and u',' in query:
+			parts = query.split(u', ')
+			name, qualifier = u', '.join(parts[:-1]), parts[-1]
+			country = country_names.get(qualifier) or (qualifier.upper() in country_codes and qualifier.upper()) or None
+			candidates = self.candidates(name)
+			if not candidates:
+				# Fall back to the first part alone (e.g. u'soho, london, uk' -> u'soho')
+				candidates = self.candidates(parts[0])
+		if country is not None:
+			candidates = [index for index in candidates if self.country_codes[index] == country]
+		if not candidates:
+			return None
+		best = candidates[0]
+		for index in candidates[1:]:
+			if self.populations[index] > self.populations[best]:
+				best = index
+		return self.place(best)
+	
+	def complete(self, prefix, limit=10):
+		"""Returns up to limit indexed names starting with prefix, in alphabetical order."""
+		prefix = normalize_query(prefix)
+		start = bisect.bisect_left(self.sorted_names, prefix)
+		names = []
+		for name in self.sorted_names[start:start + limit]:
+			if not name.startswith(prefix):
+				break
+			names.append(name)
+		return names
+
+def load_gazetteer(path, **kwargs):
+	"""Returns a Gazetteer loaded from the GeoNames dump at path (which may be gzipped)."""
+	if path.endswith('.gz'):
+		dump = gzip.open(path)
+	else:
+		dump = open(path)
+	try:
+		return Gazetteer().load(dump, **kwargs)
+	finally:
+		dump.close()
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+def get_gazetteer():
+	"""Returns the shared Gazetteer, loading it from settings.GEOCODING_GAZETTEER_PATH on first use."""
+	global _gazetteer
+	if _gazetteer is None:
+		_gazetteer_lock.acquire()
+		try:
+			if _gazetteer is None:
+				_gazetteer = load_gazetteer(settings.GEOCODING_GAZETTEER_PATH)
+		finally:
+			_gazetteer_lock.release()
+	return _gazetteer
+
+def set_gazetteer(gazetteer):
+	"""Replaces the shared Gazetteer (e.g. with one loaded from a small fixture in tests)."""
+	global _gazetteer
+	_gazetteer = gazetteer
+
+def reverse_geocode(latitude, longitude):
+	"""Returns the nearest populated Place in the shared gazetteer to the given point. The Place's country
+	   property gives its name from misc.country_codes."""
+	return get_gazetteer().reverse(latitude, longitude)
+
+def reverse_geocode_many(latitudes, longitudes):
+	"""Batch version of reverse_geocode(), taking sequences of latitudes and longitudes."""
+	return get_gazetteer().reverse_many(latitudes, longitudes)
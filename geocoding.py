@@ -1,16 +1,58 @@
-import re, urllib, urllib2
+import copy, re, time, urllib, threading, Queue
+from cStringIO import StringIO
 from elementtree import ElementTree
 
 from django.conf import settings
+from django.utils import simplejson
 
-from geo.misc import yahoo_precision_to_google_zoom_mappings, GeocodingError
+from geo import cache as geo_cache, gazetteer as geo_gazetteer, metrics as geo_metrics, ratelimit as geo_ratelimit, transport as geo_transport
+from geo.misc import google_accuracy_to_google_zoom_mappings, yahoo_precision_to_google_zoom_mappings, Deadline, GeocodingError, GeocoderUnavailable, GeocodingQuotaExceeded, GeocodingTimeout
 
 NAMESPACE_RE = re.compile(r'^\{.+\}') # To remove xml namespace declarations from tag names, as they are unhelpful here.
+_tag_names = {} # Memoizes clean_tag(), as responses only ever use a handful of distinct tags
 
-class XMLElement(object):
+def clean_tag(tag):
+	"""Returns the lowercased tag name of an ElementTree element with any namespace removed."""
+	try:
+		return _tag_names[tag]
+	except KeyError:
+		name = _tag_names[tag] = NAMESPACE_RE.sub('', unicode(tag).lower().strip())
+		return name
+
+def _restore(cls, state):
+	"""Recreates a SlottedObject from the compact state written by its __reduce__()."""
+	obj = object.__new__(cls)
+	obj.__setstate__(state)
+	return obj
+
+class SlottedObject(object):
+	"""Base class for the small objects making up a GeocodingResult. They use __slots__ rather than a
+	   per-instance __dict__, and pickle to a plain tuple of their slot values. Pickles of the dict-based
+	   objects used by older versions can still be loaded."""
+	__slots__ = ()
+	
+	def __getstate__(self):
+		return tuple([getattr(self, name, None) for name in self.__slots__])
+	
+	def __setstate__(self, state):
+		if isinstance(state, dict):
+			# Pickled before __slots__ were used: state is the old instance's __dict__
+			state = tuple([state.get(name) for name in self.__slots__])
+		# Slots added since the object was pickled are set to None
+		state = tuple(state) + (None,) * (len(self.__slots__) - len(state))
+		for name, value in zip(self.__slots__, state):
+			object.__setattr__(self, name, value)
+	
+	def __reduce__(self):
+		return (_restore, (self.__class__, self.__getstate__()))
+
+class XMLElement(SlottedObject):
 	"""Object for storing basic XML data (represents an element in an XML document). Content and attributes can
 	   be stored."""
+	__slots__ = ('tag', 'text', 'attrs')
+	
 	def __init__(self, tag='', text='', attrs={}, *args, **kwargs):
+		self.tag = tag
 		self.text = text
 		self.attrs = attrs
 		return super(XMLElement, self).__init__(*args, **kwargs)
@@ -30,8 +72,10 @@ class XMLElement(object):
 	def __float__(self):
 		return float(self.text)
 
-class Coordinates(object):
+class Coordinates(SlottedObject):
 	"""Basic object for storing co-ordinate data."""
+	__slots__ = ('latitude', 'longitude', 'elevation', 'granularity')
+	
 	def __init__(self, latitude=0.0, longitude=0.0, elevation=0.0, granularity=0, *args, **kwargs):
 		self.latitude, self.longitude, self.elevation, self.granularity = float(latitude), float(longitude), float(elevation), int(granularity)
 		return super(Coordinates, self).__init__(*args, **kwargs)
@@ -48,9 +92,11 @@ class Coordinates(object):
 	def __getitem__(self, index):
 		return tuple(self)[index]
 
-class XMLResponse(object):
+class XMLResponse(SlottedObject):
 	"""Object for storing a simple representation of an XML response (not as complex as an ElementTree,
 	   has no concept of nesting)."""
+	__slots__ = ('raw', 'coords', 'data')
+	
 	def __init__(self, *args, **kwargs):
 		self.raw = ''
 		self.coords = Coordinates()
@@ -67,37 +113,124 @@ class XMLResponse(object):
 		else:
 			return super(XMLResponse, self).__setattr__(name, value)
 
-class GeocodingResult(object):
+class GeocodingResult(SlottedObject):
 	"""Class to store geocoding response objects."""
+	__slots__ = ('response', 'query', 'coords', 'provider')
+	
 	def __init__(self, *args, **kwargs):
 		self.response = XMLResponse()
 		self.query = ''
 		self.coords = Coordinates()
+		self.provider = None # The short_name of the geocoder that produced this result
 		return super(GeocodingResult, self).__init__(*args, **kwargs)
 	
 	def __repr__(self):
 		return '<GeocodingResult instance for \'%s\'>' % self.query
 
+class StoredResult(SlottedObject):
+	"""The compact form of a GeocodingResult that is persisted in Location.result: just the query, provider,
+	   coordinates (including granularity) and a few selected response values in attributes. The raw response
+	   is only kept if settings.GEOCODING_RETAIN_RAW is True."""
+	__slots__ = ('query', 'provider', 'coords', 'attributes', 'raw')
+	
+	def __init__(self, query='', provider=None, coords=None, attributes=None, raw=None, *args, **kwargs):
+		self.query, self.provider, self.raw = query, provider, raw
+		self.coords = coords or Coordinates()
+		self.attributes = attributes or {}
+		return super(StoredResult, self).__init__(*args, **kwargs)
+	
+	def __repr__(self):
+		return '<StoredResult instance for \'%s\'>' % self.query
+
+def store_result(result, retain_raw=None):
+	"""Returns the StoredResult for a GeocodingResult (StoredResults are returned as they are, so this can be
+	   used to migrate old Location.result values). The response's values for the geocoder's stored_tags are
+	   kept in its attributes, and its raw response if retain_raw (defaults to settings.GEOCODING_RETAIN_RAW)."""
+	if isinstance(result, StoredResult) or not isinstance(result, GeocodingResult):
+		return result
+	if retain_raw is None:
+		retain_raw = getattr(settings, 'GEOCODING_RETAIN_RAW', False)
+	geocoder = SHORT_NAME_MAPPINGS.get(result.provider)
+	data = result.response.data
+	attributes = {}
+	for tag in geocoder and geocoder.stored_tags or ():
+		# Empty elements aren't worth storing
+		if tag in data and data[tag].text:
+			attributes[tag] = data[tag].text
+	return StoredResult(result.query, result.provider, result.coords, attributes, retain_raw and result.response.raw or None)
+
+class LatencyTracker(object):
+	"""Remembers the most recent size response times for each geocoder (by short_name), so that percentiles
+	   of them can be estimated."""
+	def __init__(self, size=100, *args, **kwargs):
+		self.size = size
+		self.samples = {}
+		self.lock = threading.Lock()
+		return super(LatencyTracker, self).__init__(*args, **kwargs)
+	
+	def record(self, short_name, seconds):
+		self.lock.acquire()
+		try:
+			samples = self.samples.setdefault(short_name, [])
+			samples.append(seconds)
+			if len(samples) > self.size:
+				del samples[0]
+		finally:
+			self.lock.release()
+	
+	def percentile(self, short_name, percentile, minimum_samples=10):
+		"""Returns the given percentile (0-100) of the recent response times for short_name, or None if fewer
+		   than minimum_samples have been recorded."""
+		self.lock.acquire()
+		try:
+			samples = sorted(self.samples.get(short_name, []))
+		finally:
+			self.lock.release()
+		if len(samples) < minimum_samples:
+			return None
+		return samples[min(len(samples) - 1, int(len(samples) * percentile / 100.0))]
+
+latencies = LatencyTracker()
+
 class XMLGeocoder(object):
 	short_name = ''
+	service = None # The short_name of the service whose API key and rate limit are used (defaults to short_name)
 	key_key = ''
 	geocoder_url = ''
 	query_key = ''
 	default_args = {}
+	transport = None # Uses the shared transport from geo.transport.get_transport() if None
+	# The (cleaned) tags additional_processing() needs. If set, responses are parsed incrementally and parsing
+	# stops as soon as they have all been seen, unless settings.GEOCODING_STREAMING_PARSE is False.
+	required_tags = ()
+	# Tags whose values are kept in the StoredResult persisted in Location.result (also parsed when streaming)
+	stored_tags = ()
+	# The (cleaned) tag of the element holding the first result. When streaming, stored_tags it doesn't contain
+	# are taken to be missing once it closes; without it, parsing stops as soon as required_tags are found.
+	result_tag = None
 	default_inst_args = {
 		'result': GeocodingResult(),
 		'geocoder_params': {},
 	}
 	
-	def __init__(self, location, *args, **kwargs):
+	def __init__(self, location, deadline=None, *args, **kwargs):
+		"""location can be any object with a name attribute (such as a Location), or a plain query string.
+		   deadline is the Deadline by which geocoding (including connecting, reading and parsing) must finish,
+		   or a number of seconds; it defaults to settings.GEOCODING_TIMEOUT seconds from now."""
 		if self.__class__.__name__ is 'XMLGeocoder':
 			raise NotImplementedError('You cannot instantiate XMLGeocoder directly; use on of its subclasses instead.')
 		# Set some instance attributes
+		if deadline is None:
+			deadline = getattr(settings, 'GEOCODING_TIMEOUT', 10)
+		if not isinstance(deadline, Deadline):
+			deadline = Deadline(deadline)
+		self.deadline = deadline
 		self.result = GeocodingResult()
-		self.geocoder_params = {unicode(self.query_key): location.name}
+		self.result.provider = self.short_name
+		self.geocoder_params = {unicode(self.query_key): getattr(location, 'name', location)}
 		self.result.query = self.geocoder_params[self.query_key]
 		# Return
-		return super(XMLGeocoder, self).__init__(self, *args, **kwargs)
+		return super(XMLGeocoder, self).__init__(*args, **kwargs)
 	
 	@property
 	def parameters(self):
@@ -119,28 +252,162 @@ class XMLGeocoder(object):
 		"""The API key to use with this geocoder. Returns a dictionary that can be added to the geocoder
 		   parameter."""
 		try:
-			return {self.key_key: unicode(settings.GEOCODING_KEYS[self.short_name])}
+			return {self.key_key: unicode(settings.GEOCODING_KEYS[self.service or self.short_name])}
 		except (AttributeError, KeyError):
 			# If the GEOCODING_KEYS setting isn't defined or the key isn't in there, return an
 			# empty dict.
 			return {}
 	
-	def geocode(self):
-		"""Let's get geocoding!"""
-		self.result.response.raw = urllib2.urlopen(self.url).read()
-		et = ElementTree.fromstring(self.result.response.raw)
+	@property
+	def rate_limiter(self):
+		"""The TokenBucket shared by all requests to this geocoder's service (None if it isn't rate limited)."""
+		return geo_ratelimit.get_rate_limiter(self.service or self.short_name)
+	
+	def open(self):
+		"""Requests this query through the geocoder's transport and returns a geo.transport.Response to read the
+		   response from."""
+		transport = self.transport or geo_transport.get_transport()
+		if not hasattr(transport, 'open'):
+			# A minimal transport which only implements fetch()
+			return geo_transport.Response(StringIO(transport.fetch(self.url, self.deadline.timeout())))
+		response = transport.open(self.url, self.deadline.timeout())
+		# The deadline is also checked between reads, so a slow response can't outlast it
+		response.deadline = self.deadline
+		return response
+	
+	def fetch(self):
+		"""Fetches the raw response for this query through the geocoder's transport."""
+		response = self.open()
+		try:
+			return response.read()
+		finally:
+			response.close()
+	
+	def geocode(self, use_cache=True):
+		"""Let's get geocoding! Results are served from (and stored in) the shared geocoding cache unless
+		   use_cache is False."""
+		self.deadline.check()
+		if not use_cache:
+			return self.lookup()
+		cache = geo_cache.get_cache()
+		result = cache.get(self.short_name, self.result.query)
+		geo_metrics.increment(result is None and 'cache_misses' or 'cache_hits', self.short_name)
+		if result is None:
+			# Queries which recently failed aren't sent to the provider again until they've been backed off from
+			failure = cache.get_failure(self.short_name, self.result.query)
+			if failure is not None:
+				geo_metrics.increment('negative_cache_hits', self.short_name)
+				raise GeocodingError(failure)
+			# Only one geocode per (provider, query) is made at once; concurrent callers share its result
+			result = geo_cache.single_flight.do(cache.key(self.short_name, self.result.query), self.cached_lookup, (cache,), self.deadline.remaining())
+		if result is not self.result:
+			# A copy of the cached result, so that changes to it (by additional_processing() or the caller)
+			# don't change what's cached
+			query = self.result.query
+			self.result = copy.deepcopy(result)
+			self.result.query = query
+		return self.result
+	
+	def cached_lookup(self, cache):
+		"""Performs lookup() and stores the result in cache (coordinating with other processes through cache's
+		   lock, if it has one)."""
+		# Another thread may have stored the result since this caller missed the cache
+		result = cache.get(self.short_name, self.result.query, record=False)
+		if result is not None:
+			return result
+		result, locked = cache.acquire(self.short_name, self.result.query, self.deadline.remaining())
+		if result is not None:
+			return result
+		try:
+			try:
+				result = self.lookup()
+			except GeocoderUnavailable:
+				# Not the query's fault, so it isn't remembered as a failure
+				raise
+			except GeocodingError, e:
+				cache.set_failure(self.short_name, self.result.query, unicode(e))
+				raise
+			cache.set(self.short_name, result.query, copy.deepcopy(result))
+			cache.delete_failure(self.short_name, self.result.query)
+		finally:
+			if locked:
+				cache.release(self.short_name, self.result.query)
+		return result
+	
+	def lookup(self):
+		"""Queries the geocoding service, bypassing the cache, and returns the processed GeocodingResult."""
+		try:
+			limiter = self.rate_limiter
+			if limiter is not None:
+				limiter.acquire(self.deadline.remaining())
+			started = time.time()
+			response = self.open()
+			opened = time.time()
+			try:
+				self.deadline.check()
+				# The response is parsed as it's read (and decompressed), and whatever the parser doesn't need is
+				# never read, unless the whole of it has to be kept.
+				if self.required_tags and getattr(settings, 'GEOCODING_STREAMING_PARSE', True) and not getattr(settings, 'GEOCODING_RETAIN_RAW', False):
+					self.parse_streaming(response)
+				else:
+					self.parse(response.read())
+			finally:
+				response.close()
+				# Only a complete body is kept: the part read before the parser stopped early is no use
+				self.result.response.raw = response.complete and response.content or None
+			# Reading and parsing are interleaved, so the network time (fetch_seconds, and the latency hedging
+			# is based on) is the time to the headers plus the time spent waiting for the body's reads
+			fetch_seconds = opened - started + response.read_seconds
+			latencies.record(self.short_name, fetch_seconds)
+			geo_metrics.observe('fetch_seconds', self.short_name, fetch_seconds)
+			geo_metrics.observe('bytes_received', self.short_name, response.received, geo_metrics.SIZE_BUCKETS)
+			try:
+				self.result = self.additional_processing(self.result)
+			except:
+				raise GeocodingError('The location could not be geocoded.')
+			self.deadline.check()
+			# Everything else since the headers arrived: decompressing, parsing and additional_processing()
+			geo_metrics.observe('parse_seconds', self.short_name, time.time() - opened - response.read_seconds)
+			return self.result
+		except Exception, e:
+			geo_metrics.increment('errors.%s' % e.__class__.__name__, self.short_name)
+			raise
+	
+	def parse(self, raw):
+		"""Parses the whole response, storing an XMLElement for the first occurrence of every tag in
+		   self.result.response.data (as parse_streaming() does, so results don't depend on which is used)."""
+		et = ElementTree.fromstring(raw)
 		for el in et.getiterator():
 			xml_element = XMLElement()
 			# Add the element content to the xml_element
-			xml_element.tag = NAMESPACE_RE.sub('', unicode(el.tag).lower().strip())
-			xml_element.text = unicode(el.text).strip()
+			xml_element.tag = clean_tag(el.tag)
+			xml_element.text = unicode(el.text or u'').strip()
 			xml_element.attrs = el.attrib
-			self.result.response.data[xml_element.tag] = xml_element
-		try:
-			self.result = self.additional_processing(self.result)
-		except:
-			raise GeocodingError('The location could not be geocoded.')
-		return self.result
+			if xml_element.tag not in self.result.response.data:
+				self.result.response.data[xml_element.tag] = xml_element
+	
+	def parse_streaming(self, source):
+		"""Parses the response incrementally from source (a file-like object), storing XMLElements for the
+		   first occurrence of each of self.required_tags and self.stored_tags only. Parsing (and reading) stops
+		   once they have all been found, or once the required_tags have been and the result_tag element has
+		   closed (stored_tags are optional). Elements are cleared as they're finished with so the tree is never
+		   built in full."""
+		data = self.result.response.data
+		required = set(self.required_tags)
+		remaining = set(self.required_tags + self.stored_tags)
+		for event, el in ElementTree.iterparse(source):
+			tag = clean_tag(el.tag)
+			if tag in remaining:
+				remaining.discard(tag)
+				required.discard(tag)
+				xml_element = XMLElement(tag, unicode(el.text or u'').strip())
+				if el.attrib:
+					# Copied, as clear() empties the element's own attrib dictionary
+					xml_element.attrs = dict(el.attrib)
+				data[tag] = xml_element
+			if not remaining or (not required and (self.result_tag is None or tag == self.result_tag)):
+				break
+			el.clear()
 	
 	def additional_processing(self, result):
 		"""Performs any additional processing that needs to be done on the GeocodingResult object passed
@@ -153,6 +420,9 @@ class YahooGeocoder(XMLGeocoder):
 	short_name = u'yahoo'
 	key_key = u'appid'
 	query_key = u'location'
+	required_tags = ('latitude', 'longitude', 'result')
+	stored_tags = ('address', 'city', 'state', 'zip', 'country')
+	result_tag = 'result'
 	
 	def additional_processing(self, result):
 		result.coords = Coordinates(result.response.data['latitude'].text, result.response.data['longitude'].text, 0, yahoo_precision_to_google_zoom_mappings[result.response.data['result'].attrs['precision']])
@@ -161,13 +431,43 @@ class YahooGeocoder(XMLGeocoder):
 class GoogleGeocoder(XMLGeocoder):
 	"""Google Maps' geocoder. Requires a 'google' key in settings.GEOCODING_KEYS to work correctly."""
 	geocoder_url = u'http://maps.google.com/maps/geo'
-	short_name = u'google',
+	short_name = u'google'
 	key_key = u'key'
 	query_key = u'q'
 	default_args = {u'output': u'xml'}
+	required_tags = ('code', 'coordinates', 'addressdetails')
+	stored_tags = ('address', 'countrynamecode')
+	result_tag = 'placemark'
+	# Google's status codes for too many queries, and for a server error or a bad key (neither of which is
+	# the query's fault)
+	quota_statuses = (620,)
+	unavailable_statuses = (500, 610)
+	
+	def check_status(self, code):
+		"""Raises a GeocodingError for any status code from Google other than 200 (success)."""
+		if code is None or int(code) == 200:
+			return
+		if int(code) in self.quota_statuses:
+			raise GeocodingQuotaExceeded('The geocoder\'s query limit has been exceeded (status %s).' % code)
+		if int(code) in self.unavailable_statuses:
+			raise GeocoderUnavailable('The geocoder returned status %s.' % code)
+		raise GeocodingError('The geocoder returned status %s.' % code)
+	
+	def parse(self, raw):
+		super(GoogleGeocoder, self).parse(raw)
+		self.check_status(self.result.response.data.get('code'))
+	
+	def parse_streaming(self, source):
+		super(GoogleGeocoder, self).parse_streaming(source)
+		self.check_status(self.result.response.data.get('code'))
 	
 	def additional_processing(self, result):
-		result.coords = Coordinates(*result.response.data['coordinates'].text.split(','))
+		# Google gives the coordinates as longitude, latitude, elevation
+		longitude, latitude, elevation = result.response.data['coordinates'].text.split(',')
+		details = result.response.data.get('addressdetails')
+		accuracy = details is not None and details.attrs.get('Accuracy')
+		granularity = accuracy and google_accuracy_to_google_zoom_mappings.get(int(accuracy), 0) or 0
+		result.coords = Coordinates(latitude, longitude, elevation, granularity)
 		return result
 
 class GeoNamesGeocoder(XMLGeocoder):
@@ -176,13 +476,303 @@ class GeoNamesGeocoder(XMLGeocoder):
 	short_name = u'geonames'
 	query_key = u'q'
 	default_args = {u'maxRows': 1}
+	required_tags = ('lat', 'lng')
+	stored_tags = ('name', 'countrycode', 'fcode')
+	result_tag = 'geoname'
+	
+	def additional_processing(self, result):
+		fcode = result.response.data.get('fcode')
+		granularity = fcode is not None and geo_gazetteer.feature_code_to_google_zoom_mappings.get(fcode.text, geo_gazetteer.DEFAULT_ZOOM) or 0
+		result.coords = Coordinates(result.response.data['lat'], result.response.data['lng'], 0, granularity)
+		return result
+
+class JSONGeocoder(XMLGeocoder):
+	"""Base class for geocoders of services that respond in JSON. The decoded response is available as
+	   self.document to additional_processing(), which should copy the values of stored_tags into
+	   result.response.data (as XMLElements, so they're stored like the XML geocoders' values)."""
+	document = None
+	
+	def parse(self, raw):
+		try:
+			self.document = simplejson.loads(raw)
+		except ValueError:
+			raise GeocodingError('The geocoder\'s response could not be decoded.')
+	
+	def parse_streaming(self, source):
+		# A JSON document is decoded in full either way
+		self.parse(source.read())
+	
+	def store(self, result, values):
+		"""Stores the values (a dictionary) for stored_tags in result.response.data."""
+		for tag in self.stored_tags:
+			if values.get(tag) is not None:
+				result.response.data[tag] = XMLElement(tag, unicode(values[tag]))
+
+class GoogleJSONGeocoder(JSONGeocoder, GoogleGeocoder):
+	"""Google Maps' geocoder, with JSON responses. Uses the 'google' key in settings.GEOCODING_KEYS."""
+	short_name = u'google_json'
+	service = u'google'
+	default_args = {u'output': u'json'}
+	
+	def parse(self, raw):
+		super(GoogleJSONGeocoder, self).parse(raw)
+		self.check_status(self.document.get(u'Status', {}).get(u'code'))
+	
+	def additional_processing(self, result):
+		placemark = self.document[u'Placemark'][0]
+		# In the order Google gives them, as for the XML geocoder
+		longitude, latitude, elevation = placemark[u'Point'][u'coordinates']
+		details = placemark.get(u'AddressDetails', {})
+		granularity = google_accuracy_to_google_zoom_mappings.get(details.get(u'Accuracy'), 0)
+		result.coords = Coordinates(latitude, longitude, elevation, granularity)
+		self.store(result, {
+			u'address': placemark.get(u'address'),
+			u'countrynamecode': details.get(u'Country', {}).get(u'CountryNameCode'),
+		})
+		return result
+
+class GeoNamesJSONGeocoder(JSONGeocoder, GeoNamesGeocoder):
+	"""GeoNames' geocoder, with JSON responses. Doesn't require an API key."""
+	geocoder_url = u'http://ws.geonames.org/searchJSON'
+	short_name = u'geonames_json'
+	service = u'geonames'
+	# GeoNames' status codes for exceeded daily, hourly and weekly limits
+	quota_statuses = (18, 19, 20)
+	
+	def parse(self, raw):
+		super(GeoNamesJSONGeocoder, self).parse(raw)
+		status = self.document.get(u'status')
+		if status is not None:
+			if status.get(u'value') in self.quota_statuses:
+				raise GeocodingQuotaExceeded(status.get(u'message'))
+			raise GeocodingError(status.get(u'message'))
 	
 	def additional_processing(self, result):
-		result.coords = Coordinates(result.response.data['lat'], result.response.data['lng'])
+		place = self.document[u'geonames'][0]
+		granularity = place.get(u'fcode') and geo_gazetteer.feature_code_to_google_zoom_mappings.get(place[u'fcode'], geo_gazetteer.DEFAULT_ZOOM) or 0
+		result.coords = Coordinates(place[u'lat'], place[u'lng'], 0, granularity)
+		self.store(result, {u'name': place.get(u'name'), u'countrycode': place.get(u'countryCode'), u'fcode': place.get(u'fcode')})
 		return result
 
+class GazetteerGeocoder(XMLGeocoder):
+	"""Offline geocoder which looks places up in the local GeoNames gazetteer (see geo.gazetteer). Requires
+	   settings.GEOCODING_GAZETTEER_PATH."""
+	short_name = u'gazetteer'
+	query_key = u'q'
+	stored_tags = ('name', 'countrycode')
+	
+	def geocode(self, use_cache=True):
+		# Gazetteer lookups are cheaper than going through the cache
+		return self.lookup()
+	
+	def lookup(self):
+		place = geo_gazetteer.get_gazetteer().lookup(self.result.query)
+		if place is None:
+			geo_metrics.increment('errors.GeocodingError', self.short_name)
+			raise GeocodingError('The location could not be found in the gazetteer.')
+		for tag, value in ((u'name', place.name), (u'countrycode', place.country_code), (u'fcode', place.feature_code), (u'population', place.population)):
+			self.result.response.data[tag] = XMLElement(tag, unicode(value))
+		self.result.coords = Coordinates(place.latitude, place.longitude, place.elevation, place.granularity)
+		return self.result
+
+class FailoverGeocoder(XMLGeocoder):
+	"""Composite geocoder that tries each of the geocoders named in providers (defaults to
+	   settings.GEOCODING_FAILOVER_PROVIDERS, or one geocoder for each other service, with the gazetteer only
+	   if settings.GEOCODING_GAZETTEER_PATH is set) in turn, moving on to the next as soon as one raises a
+	   GeocodingError.
+	
+	   If hedge_percentile (settings.GEOCODING_HEDGE_PERCENTILE) is set, a hedged request is also sent to the
+	   next provider once the current one has taken longer than that percentile of its recent response times
+	   (or hedge_delay seconds, settings.GEOCODING_HEDGE_DELAY, until enough have been recorded). The first
+	   good result is returned and any requests still running are ignored."""
+	short_name = u'failover'
+	providers = None
+	hedge_percentile = None
+	hedge_delay = None
+	
+	def __init__(self, location, *args, **kwargs):
+		self.location = location
+		return super(FailoverGeocoder, self).__init__(location, *args, **kwargs)
+	
+	def get_providers(self):
+		providers = self.providers or getattr(settings, 'GEOCODING_FAILOVER_PROVIDERS', None)
+		if not providers:
+			# One per service (its response format is picked by get_geocoder()), as trying a service twice
+			# doesn't help when it's down, and uses up its quota twice over
+			providers = set([geocoder.service or geocoder.short_name for geocoder in SHORT_NAME_MAPPINGS.values() if geocoder is not self.__class__])
+			if not getattr(settings, 'GEOCODING_GAZETTEER_PATH', None):
+				providers.discard(GazetteerGeocoder.short_name)
+			providers = sorted(providers)
+		return [get_geocoder(provider) for provider in providers]
+	
+	def get_hedge_delay(self, geocoder):
+		"""Returns how long to wait for geocoder before sending a hedged request (None to never hedge)."""
+		percentile = self.hedge_percentile or getattr(settings, 'GEOCODING_HEDGE_PERCENTILE', None)
+		if not percentile:
+			return None
+		delay = latencies.percentile(geocoder.short_name, percentile)
+		if delay is None:
+			delay = self.hedge_delay or getattr(settings, 'GEOCODING_HEDGE_DELAY', 1.0)
+		return delay
+	
+	def attempt(self, geocoder, use_cache=True):
+		"""Geocodes with geocoder, returning a two-tuple of its result and None, or of None and the
+		   GeocodingError it raised."""
+		try:
+			return geocoder(self.location, self.deadline).geocode(use_cache), None
+		except GeocodingError, e:
+			return None, e
+		except Exception, e:
+			return None, GeocodingError('The location could not be geocoded (%s).' % e)
+	
+	def geocode(self, use_cache=True):
+		pending = self.get_providers()
+		errors = []
+		self.deadline.check()
+		if self.get_hedge_delay(pending[0]) is None:
+			# Without hedging only one provider is ever running, so each is simply called in turn
+			for geocoder in pending:
+				self.deadline.check()
+				result, error = self.attempt(geocoder, use_cache)
+				if error is None:
+					self.result = result
+					return result
+				if isinstance(error, GeocodingTimeout):
+					# Every provider shares the deadline, so none of the rest would have any time either
+					raise error
+				errors.append('%s: %s' % (geocoder.short_name, error))
+			raise GeocodingError('The location could not be geocoded by any provider (%s).' % '; '.join(errors))
+		outcomes = Queue.Queue()
+		
+		def run(geocoder):
+			outcomes.put((geocoder,) + self.attempt(geocoder, use_cache))
+		
+		def start():
+			geocoder = pending.pop(0)
+			thread = threading.Thread(target=run, args=(geocoder,))
+			thread.setDaemon(True)
+			thread.start()
+			return geocoder
+		
+		running = 1
+		latest = start()
+		while running:
+			delay = pending and self.get_hedge_delay(latest) or None
+			remaining = self.deadline.remaining()
+			hedging = delay is not None and (remaining is None or delay < remaining)
+			if not hedging:
+				delay = remaining
+			try:
+				if delay is None:
+					geocoder, result, error = outcomes.get()
+				else:
+					geocoder, result, error = outcomes.get(True, delay)
+			except Queue.Empty:
+				if not hedging:
+					raise GeocodingTimeout('The geocoding deadline was exceeded.')
+				# The latest request is slow: hedge it with the next provider
+				running += 1
+				latest = start()
+				continue
+			running -= 1
+			if error is None:
+				self.result = result
+				return result
+			if isinstance(error, GeocodingTimeout):
+				raise error
+			errors.append('%s: %s' % (geocoder.short_name, error))
+			if pending:
+				running += 1
+				latest = start()
+		raise GeocodingError('The location could not be geocoded by any provider (%s).' % '; '.join(errors))
+
 SHORT_NAME_MAPPINGS = {
 	'yahoo': YahooGeocoder,
 	'google': GoogleGeocoder,
 	'geonames': GeoNamesGeocoder,
+	'google_json': GoogleJSONGeocoder,
+	'geonames_json': GeoNamesJSONGeocoder,
+	'gazetteer': GazetteerGeocoder,
+	'failover': FailoverGeocoder,
 }
+
+def get_geocoder(provider=None):
+	"""Returns the geocoder class for provider, which can be a short name from SHORT_NAME_MAPPINGS or an
+	   XMLGeocoder subclass. Defaults to settings.DEFAULT_GEOCODER. settings.GEOCODING_RESPONSE_FORMATS can
+	   map a short name to another response format, e.g. {'google': 'json'} to use GoogleJSONGeocoder."""
+	if provider is None:
+		provider = settings.DEFAULT_GEOCODER
+	if isinstance(provider, basestring):
+		format = getattr(settings, 'GEOCODING_RESPONSE_FORMATS', {}).get(provider, 'xml')
+		if format != 'xml':
+			return SHORT_NAME_MAPPINGS['%s_%s' % (provider, format)]
+		return SHORT_NAME_MAPPINGS[provider]
+	return provider
+
+_DONE = object() # Sentinel passed between the geocode_many() threads
+
+def geocode_many(queries, provider=None, max_workers=4, timeout=None):
+	"""Geocodes each of queries (plain strings or objects with a name attribute) over a pool of max_workers
+	   threads, yielding (query, result) two-tuples as each one finishes. result is the GeocodingResult, or
+	   the GeocodingError raised for that query -- a failed item doesn't abort the rest of the batch. queries
+	   can be any iterable (including a generator); it is consumed lazily. timeout is a budget in seconds
+	   shared by the whole batch: once it's spent, the remaining queries fail with GeocodingTimeout."""
+	geocoder = get_geocoder(provider)
+	deadline = Deadline(timeout)
+	pending = Queue.Queue(max_workers * 2)
+	finished = Queue.Queue()
+	stopped = threading.Event()
+	
+	def put(item):
+		# Blocks until there's room in the queue, giving up if the consumer has gone away.
+		while not stopped.isSet():
+			try:
+				pending.put(item, True, 0.1)
+				return True
+			except Queue.Full:
+				pass
+		return False
+	
+	def feed():
+		try:
+			for query in queries:
+				if not put(query):
+					return
+		finally:
+			for i in range(max_workers):
+				put(_DONE)
+	
+	def work():
+		while not stopped.isSet():
+			try:
+				query = pending.get(True, 0.1)
+			except Queue.Empty:
+				continue
+			if query is _DONE:
+				break
+			try:
+				if timeout is None:
+					result = geocoder(query).geocode()
+				else:
+					result = geocoder(query, deadline).geocode()
+			except GeocodingError, e:
+				result = e
+			except Exception, e:
+				result = GeocodingError('The location could not be geocoded (%s).' % e)
+			finished.put((query, result))
+		finished.put(_DONE)
+	
+	threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for i in range(max_workers)]
+	for thread in threads:
+		thread.setDaemon(True)
+		thread.start()
+	try:
+		running = max_workers
+		while running:
+			item = finished.get()
+			if item is _DONE:
+				running -= 1
+			else:
+				yield item
+	finally:
+		stopped.set()
@@ -0,0 +1,93 @@
+"""Geohashes: base 32 strings of interleaved longitude and latitude bits, in which each character narrows
+   the cell a point falls in. Points in the same cell share a prefix, so an index on a geohash column turns
+   a bounding box query into a few range scans over it (see cover())."""
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+DECODE = dict([(character, value) for value, character in enumerate(BASE32)])
+PRECISION = 12 # The length of the geohashes stored in Location.geohash (cells of a few centimetres)
+
+def bits(precision):
+	"""Returns the number of latitude and longitude bits in a geohash of the given length."""
+	total = 5 * precision
+	return total // 2, total - total // 2
+
+def indices(latitude, longitude, precision):
+	"""Returns the latitude and longitude indices of the cell containing the point at the given precision."""
+	latitude_bits, longitude_bits = bits(precision)
+	latitude_index = int((latitude + 90.0) / 180.0 * (1 << latitude_bits))
+	longitude_index = int((longitude + 180.0) / 360.0 * (1 << longitude_bits))
+	return min(max(latitude_index, 0), (1 << latitude_bits) - 1), min(max(longitude_index, 0), (1 << longitude_bits) - 1)
+
+def interleave(latitude_index, longitude_index, precision):
+	"""Returns the geohash of a cell as an integer, from its latitude and longitude indices."""
+	latitude_bits, longitude_bits = bits(precision)
+	value = 0
+	for position in range(5 * precision):
+		# Bits alternate, starting with longitude's most significant
+		if position % 2 == 0:
+			longitude_bits -= 1
+			value = (value << 1) | ((longitude_index >> longitude_bits) & 1)
+		else:
+			latitude_bits -= 1
+			value = (value << 1) | ((latitude_index >> latitude_bits) & 1)
+	return value
+
+def to_string(value, precision):
+	characters = []
+	for i in range(precision):
+		characters.append(BASE32[value & 31])
+		value >>= 5
+	characters.reverse()
+	return ''.join(characters)
+
+def encode(latitude, longitude, precision=PRECISION):
+	"""Returns the geohash of the given length for a point."""
+	latitude_index, longitude_index = indices(latitude, longitude, precision)
+	return to_string(interleave(latitude_index, longitude_index, precision), precision)
+
+def decode(geohash):
+	"""Returns the bounds of geohash's cell as a (south, west, north, east) tuple."""
+	latitude_index = longitude_index = 0
+	position = 0
+	for character in geohash:
+		value = DECODE[character]
+		for shift in range(4, -1, -1):
+			if position % 2 == 0:
+				longitude_index = (longitude_index << 1) | ((value >> shift) & 1)
+			else:
+				latitude_index = (latitude_index << 1) | ((value >> shift) & 1)
+			position += 1
+	latitude_bits, longitude_bits = bits(len(geohash))
+	height, width = 180.0 / (1 << latitude_bits), 360.0 / (1 << longitude_bits)
+	south, west = latitude_index * height - 90.0, longitude_index * width - 180.0
+	return south, west, south + height, west + width
+
+def cover(south, west, north, east, max_cells=32):
+	"""Returns a list of (low, high) geohash ranges which together contain every geohash in the bounding box,
+	   using cells as small as possible while needing no more than max_cells of them (per side of the
+	   antimeridian, if the box crosses it, i.e. west > east). A geohash is in a range if low <= geohash and
+	   (high is None or geohash < high); adjacent cells are merged into one range."""
+	if west > east:
+		return cover(south, west, north, 180.0, max_cells) + cover(south, -180.0, north, east, max_cells)
+	south, north = max(south, -90.0), min(north, 90.0)
+	precision = 1
+	for candidate in range(1, PRECISION + 1):
+		(south_index, west_index), (north_index, east_index) = indices(south, west, candidate), indices(north, east, candidate)
+		if (north_index - south_index + 1) * (east_index - west_index + 1) > max_cells:
+			break
+		precision = candidate
+	(south_index, west_index), (north_index, east_index) = indices(south, west, precision), indices(north, east, precision)
+	cells = []
+	for latitude_index in range(south_index, north_index + 1):
+		for longitude_index in range(west_index, east_index + 1):
+			cells.append(interleave(latitude_index, longitude_index, precision))
+	cells.sort()
+	ranges = []
+	for cell in cells:
+		if ranges and ranges[-1][1] == cell:
+			ranges[-1][1] = cell + 1
+		else:
+			ranges.append([cell, cell + 1])
+	last = 1 << (5 * precision)
+	# Ranges are bounded by the next cell's geohash (rather than by a sentinel character), so that they hold
+	# under any collation which orders digits before lowercase letters
+	return [(to_string(low, precision), high < last and to_string(high, precision) or None) for low, high in ranges]
@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from geo import refresher
+
+class Command(NoArgsCommand):
+	help = 'Fills in the geohash column of Locations saved before it was added.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+			help='Number of locations updated per transaction (default: 1000).'),
+		make_option('--all', dest='everything', action='store_true', default=False,
+			help='Recompute the geohash of every location, not just those without one.'),
+	)
+	
+	def handle_noargs(self, **options):
+		verbosity = int(options.get('verbosity', 1))
+		def progress(updated):
+			if verbosity > 1:
+				print '%d locations updated' % updated
+		updated = refresher.backfill_geohashes(chunk_size=options['chunk_size'], everything=options['everything'], callback=progress)
+		if verbosity:
+			print '%d locations updated' % updated
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from geo import refresher
+
+class Command(NoArgsCommand):
+	help = 'Re-geocodes expired Locations in batches, writing back only their coordinates, result and refreshed and expiry times.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--chunk-size', dest='chunk_size', type='int', default=500,
+			help='Number of locations fetched and written back at a time (default: 500).'),
+		make_option('--workers', dest='max_workers', type='int', default=4,
+			help='Number of concurrent geocoding requests (default: 4).'),
+		make_option('--provider', dest='provider', default=None,
+			help='Short name of the geocoder to use (default: settings.DEFAULT_GEOCODER).'),
+		make_option('--timeout', dest='timeout', type='float', default=None,
+			help='Time budget in seconds for geocoding each chunk.'),
+		make_option('--progress-file', dest='progress_file', default=None,
+			help='File recording progress after each chunk, so an interrupted run can be resumed.'),
+	)
+	
+	def handle_noargs(self, **options):
+		verbosity = int(options.get('verbosity', 1))
+		def progress(report):
+			if verbosity > 1:
+				print report
+		report = refresher.refresh_expired(
+			chunk_size=options['chunk_size'],
+			max_workers=options['max_workers'],
+			provider=options['provider'],
+			timeout=options['timeout'],
+			progress_file=options['progress_file'],
+			callback=progress,
+		)
+		if verbosity:
+			print report
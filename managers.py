@@ -1,51 +1,72 @@
-import datetime
+import datetime, math
 from geopy import distance as geopy_distance
 from django.db import models
+from django.db.models import Q
 from django.conf import settings
 
-from geo import misc
+from geo import distances, geohash as geo_geohash, proximity
 from geo.dateutil.relativedelta import relativedelta
 
 class LocationManager(models.Manager):
-	def by_proximity_to_location(self, origin_location, radius_miles=None):
+	def by_proximity_to_location(self, origin_location, radius_miles=None, radius_kilometers=None):
 		"""Returns a list of all self.model objects (excluding the origin_location)
-			within radius_miles miles of the passed location if specified (otherwise
-			returns all other objects), ordered by ascending proximity to it."""
+			within radius_miles miles (or radius_kilometers kilometers) of the passed
+			location if specified (otherwise returns all other objects), ordered by
+			ascending proximity to it. Each object's distance attribute is set to its
+			geopy Distance from the location."""
 		
+		if radius_kilometers is not None:
+			radius_miles = geopy_distance.Distance(radius_kilometers).miles
 		if radius_miles is not None:
-			# It is assumed that 1 degree of latitude and longitude is equal to
-			# 75 miles (this is actually overestimated)
-			coord_set = {
-				'latitude': {
-					'minimum': origin_location.latitude - (radius_miles / 75),
-					'maximum': origin_location.latitude + (radius_miles / 75),
-				},
-				'longitude': {
-					'minimum': origin_location.longitude - (radius_miles / 75),
-					'maximum': origin_location.longitude + (radius_miles / 75),
-				},
-			}
-		
-			results = self.model.objects.filter(latitude__range=(coord_set['latitude']['minimum'], coord_set['latitude']['maximum'])).filter(longitude__range=(coord_set['longitude']['minimum'], coord_set['longitude']['maximum']))
+			# Only the rows in the bounding box of the circle around the location can be within it
+			results = self.in_box(*distances.bounding_box(origin_location.latitude, origin_location.longitude, radius_miles, 'miles'))
 		else:
 			results = self.model.objects.all()
 		
 		# Exclude any locations with exactly the same co-ordinates (GeoPy doesn't play nice with these)
-		results = list(results.exclude(latitude__exact=origin_location.latitude).exclude(longitude__exact=origin_location.longitude))
-		# And any that don't actually fall within the radius (accurately calculated)
-		if radius_miles is not None:
-			for result in results:
-				if geopy_distance.distance((result.latitude, result.longitude), (origin_location.latitude, origin_location.longitude)).miles > radius_miles:
-					results.remove(result)
-		
-		def proximity_cmp(current, previous, location=origin_location):
-			return misc.base_cmp_by_proximity(current, previous, location.coords_tuple)
-		
-		results.sort(proximity_cmp)
-		return results
+		results = results.exclude(latitude__exact=origin_location.latitude, longitude__exact=origin_location.longitude)
+		# Each distance is calculated once, and used both to drop those outside the radius and for ordering
+		return proximity.by_proximity(results, (origin_location.latitude, origin_location.longitude), radius_miles)
 	# Backwards-compatibility
 	by_prox = by_proximity_to_location
 	
+	def nearest(self, origin, k, max_radius=None):
+		"""Returns a list of the k self.model objects nearest to origin (a location, which is itself excluded,
+		   or a lat/long pair), and no further than max_radius miles from it if specified, ordered by ascending
+		   proximity. Each object's distance attribute is set to its geopy Distance from origin.
+		
+		   The search starts with a small circle (settings.GEOCODING_NEAREST_INITIAL_RADIUS miles) around the
+		   origin and widens it until it holds k objects. Only the rows in each circle's bounding box are
+		   fetched (see in_box()), and any row outside the box is further away than everything in the circle,
+		   so the first circle holding k objects holds the k nearest."""
+		if hasattr(origin, 'latitude'):
+			point, exclude = (origin.latitude, origin.longitude), origin.pk
+		else:
+			point, exclude = tuple(origin[:2]), None
+		radius = getattr(settings, 'GEOCODING_NEAREST_INITIAL_RADIUS', 5.0)
+		if max_radius is not None:
+			radius = min(radius, max_radius)
+		while True:
+			box = distances.bounding_box(point[0], point[1], radius, 'miles')
+			results = self.in_box(*box)
+			if exclude is not None:
+				results = results.exclude(pk=exclude)
+			# Once the box covers the globe, every row has been fetched and only those beyond max_radius (if
+			# given) need be left out
+			everything = box == (-90.0, -180.0, 90.0, 180.0)
+			if everything:
+				nearby = proximity.by_proximity(results, point, max_radius)
+			else:
+				nearby = proximity.by_proximity(results, point, radius)
+			if len(nearby) >= k or everything or (max_radius is not None and radius >= max_radius):
+				return nearby[:k]
+			# Widen the circle to where k objects would be expected, if they're spread as evenly as those
+			# found so far, but by at least twice (so there are few queries) and at most eight times
+			growth = nearby and math.sqrt(float(k) / len(nearby)) or 8.0
+			radius *= min(max(growth, 2.0), 8.0)
+			if max_radius is not None:
+				radius = min(radius, max_radius)
+	
 	@property
 	def public(self):
 		"""Returns all self.model objects which have is_public set as True (convenience function)."""
@@ -53,10 +74,29 @@ class LocationManager(models.Manager):
 	
 	@property
 	def expired(self):
-		"""Returns all self.model objects which have expired (convenience function)."""
-		return self.model.objects.filter(refreshed__lte=(datetime.datetime.now() - relativedelta.relativedelta(**settings.MAX_LOCATION_CACHE_AGE)))
+		"""Returns all self.model objects which have expired (convenience function). Rows saved before
+		   expires_at was added are taken to expire settings.MAX_LOCATION_CACHE_AGE after they were refreshed."""
+		now = datetime.datetime.now()
+		return self.model.objects.filter(Q(expires_at__lte=now) | Q(expires_at__isnull=True, refreshed__lte=(now - relativedelta(**settings.MAX_LOCATION_CACHE_AGE))))
+	
+	def in_box(self, south, west, north, east):
+		"""Returns a QuerySet of self.model objects within the bounding box (which crosses the antimeridian if
+		   west > east). The indexed geohash column narrows the search to a few range scans first (see
+		   geohash.cover()); rows which don't have a geohash yet (see the backfill_geohashes command) are
+		   checked by their coordinates alone."""
+		prefilter = Q(geohash__isnull=True)
+		for low, high in geo_geohash.cover(south, west, north, east):
+			if high is None:
+				prefilter |= Q(geohash__gte=low)
+			else:
+				prefilter |= Q(geohash__gte=low, geohash__lt=high)
+		if west <= east:
+			longitudes = Q(longitude__range=(west, east))
+		else:
+			longitudes = Q(longitude__gte=west) | Q(longitude__lte=east)
+		return self.model.objects.filter(prefilter).filter(longitudes, latitude__range=(south, north))
 	
 	def within_bounds(self, north_west, south_east):
 		"""Returns a QuerySet of self.models within the supplied lat/long two-tuples (the northwest
 		   and southwest-most corners bounding the segment of the earth in which to search)."""
-		return self.model.objects.filter(latitude__range=(north_west[0], south_east[0])).filter(longitude__range=(north_west[1], south_east[1]))
\ No newline at end of file
+		return self.in_box(min(north_west[0], south_east[0]), north_west[1], max(north_west[0], south_east[0]), south_east[1])
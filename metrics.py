@@ -0,0 +1,143 @@
+"""Lightweight instrumentation for geocoding. Counters and histograms are kept per metric name and geocoder
+   short_name, and every observation is also passed to any registered listeners so it can be exported to an
+   external metrics system. Listeners can be added with add_listener() or named (by full dotted path) in
+   settings.GEOCODING_METRICS_LISTENERS; each is called as listener(kind, name, short_name, value), where kind
+   is 'counter' or 'histogram'. Set settings.GEOCODING_METRICS to False to turn instrumentation off."""
+import bisect, threading
+
+from django.conf import settings
+
+# Upper bounds of the histogram buckets for timings (seconds) and sizes (bytes)
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+class Histogram(object):
+	"""Counts observations into fixed buckets, and keeps their count and sum."""
+	__slots__ = ('bounds', 'buckets', 'count', 'sum')
+	
+	def __init__(self, bounds=TIME_BUCKETS):
+		self.bounds = bounds
+		self.buckets = [0] * (len(bounds) + 1) # The last bucket is for anything over the largest bound
+		self.count = 0
+		self.sum = 0.0
+	
+	def observe(self, value):
+		self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.sum += value
+	
+	def as_dict(self):
+		return {
+			'count': self.count,
+			'sum': self.sum,
+			'mean': self.count and self.sum / self.count or 0.0,
+			'buckets': zip(list(self.bounds) + [None], self.buckets),
+		}
+
+class MetricsRegistry(object):
+	"""Thread-safe store of counters and histograms keyed by (metric name, short_name)."""
+	def __init__(self, *args, **kwargs):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.histograms = {}
+		self.listeners = []
+		self.settings_loaded = False
+		return super(MetricsRegistry, self).__init__(*args, **kwargs)
+	
+	@property
+	def enabled(self):
+		return getattr(settings, 'GEOCODING_METRICS', True)
+	
+	def add_listener(self, listener):
+		self.lock.acquire()
+		try:
+			self.listeners.append(listener)
+		finally:
+			self.lock.release()
+	
+	def remove_listener(self, listener):
+		self.lock.acquire()
+		try:
+			self.listeners.remove(listener)
+		finally:
+			self.lock.release()
+	
+	def get_listeners(self):
+		if not self.settings_loaded:
+			self.lock.acquire()
+			try:
+				if not self.settings_loaded:
+					for path in getattr(settings, 'GEOCODING_METRICS_LISTENERS', ()):
+						module, attr = path.rsplit('.', 1)
+						self.listeners.append(getattr(__import__(module, {}, {}, [attr]), attr))
+					self.settings_loaded = True
+			finally:
+				self.lock.release()
+		return self.listeners
+	
+	def notify(self, kind, name, short_name, value):
+		for listener in self.get_listeners():
+			try:
+				listener(kind, name, short_name, value)
+			except Exception:
+				# A broken exporter mustn't break geocoding
+				pass
+	
+	def increment(self, name, short_name, amount=1):
+		"""Adds amount to the counter name for short_name."""
+		if not self.enabled:
+			return
+		key = (name, short_name)
+		self.lock.acquire()
+		try:
+			self.counters[key] = self.counters.get(key, 0) + amount
+		finally:
+			self.lock.release()
+		self.notify('counter', name, short_name, amount)
+	
+	def observe(self, name, short_name, value, bounds=TIME_BUCKETS):
+		"""Records value in the histogram name for short_name (created with the given bucket bounds)."""
+		if not self.enabled:
+			return
+		key = (name, short_name)
+		self.lock.acquire()
+		try:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = Histogram(bounds)
+			histogram.observe(value)
+		finally:
+			self.lock.release()
+		self.notify('histogram', name, short_name, value)
+	
+	def snapshot(self):
+		"""Returns a dictionary mapping each short_name to its counters, histograms (as dictionaries) and cache
+		   hit ratio."""
+		self.lock.acquire()
+		try:
+			snapshot = {}
+			for (name, short_name), value in self.counters.items():
+				snapshot.setdefault(short_name, {})[name] = value
+			for (name, short_name), histogram in self.histograms.items():
+				snapshot.setdefault(short_name, {})[name] = histogram.as_dict()
+		finally:
+			self.lock.release()
+		for metrics in snapshot.values():
+			lookups = metrics.get('cache_hits', 0) + metrics.get('cache_misses', 0)
+			metrics['cache_hit_ratio'] = lookups and float(metrics.get('cache_hits', 0)) / lookups or 0.0
+		return snapshot
+	
+	def reset(self):
+		self.lock.acquire()
+		try:
+			self.counters.clear()
+			self.histograms.clear()
+		finally:
+			self.lock.release()
+
+registry = MetricsRegistry()
+increment = registry.increment
+observe = registry.observe
+add_listener = registry.add_listener
+remove_listener = registry.remove_listener
+snapshot = registry.snapshot
@@ -249,10 +249,10 @@ country_codes = {
 
 def base_cmp_by_proximity(current, previous, coords):
 	"""Compare method for two objects with latitude and longitude in comparison to a lat/long pair."""
-	from geopy import distance as dist
+	from geo import distances
 	
-	current_distance = dist.distance(current.coords_tuple, coords).feet
-	previous_distance = dist.distance(previous.coords_tuple, coords).feet
+	current_distance = distances.distance(coords, current.coords_tuple)
+	previous_distance = distances.distance(coords, previous.coords_tuple)
 	if current_distance < previous_distance:
 		return -1
 	elif current_distance == previous_distance:
@@ -260,9 +260,62 @@ def base_cmp_by_proximity(current, previous, coords):
 	else:
 		return 1
 
+def normalize_query(query):
+	"""Normalizes a geocoding query so that trivially different spellings of the same place (case, stray
+	   whitespace, spacing around commas) compare equal: u' london,uk ' and u'London, UK' both become
+	   u'london, uk'."""
+	return u', '.join([u' '.join(part.split()) for part in unicode(query).lower().split(u',')]).strip(u', ')
+
 class GeocodingError(Exception):
 	pass
 
+class GeocoderUnavailable(GeocodingError):
+	"""Raised when the geocoding service couldn't be used (as opposed to it not finding the location)."""
+	pass
+
+class GeocodingQuotaExceeded(GeocoderUnavailable):
+	"""Raised when a geocoder's rate limit or daily quota won't allow another request."""
+	pass
+
+class GeocodingTimeout(GeocoderUnavailable):
+	"""Raised when geocoding doesn't finish within its Deadline."""
+	pass
+
+class Deadline(object):
+	"""The time by which an operation (such as a geocode, or a batch of them) must finish, given as a budget
+	   of seconds from now. A budget of None means there is no deadline. clock is the function returning the
+	   current time in seconds (time.time by default)."""
+	def __init__(self, seconds=None, clock=None, *args, **kwargs):
+		import time
+		self.time = clock or time.time
+		self.expires = None
+		if seconds is not None:
+			self.expires = self.time() + seconds
+		return super(Deadline, self).__init__(*args, **kwargs)
+	
+	def remaining(self):
+		"""Returns the number of seconds left (never negative), or None if there's no deadline."""
+		if self.expires is None:
+			return None
+		return max(0.0, self.expires - self.time())
+	
+	def timeout(self):
+		"""Returns the number of seconds left for use as a socket timeout, or None if there's no deadline.
+		   Raises GeocodingTimeout instead of returning 0, as a timeout of 0 makes a socket non-blocking."""
+		remaining = self.remaining()
+		if remaining is not None and remaining <= 0:
+			raise GeocodingTimeout('The geocoding deadline was exceeded.')
+		return remaining
+	
+	@property
+	def expired(self):
+		return self.expires is not None and self.time() >= self.expires
+	
+	def check(self):
+		"""Raises GeocodingTimeout if the deadline has passed."""
+		if self.expired:
+			raise GeocodingTimeout('The geocoding deadline was exceeded.')
+
 google_map_types = {
 	'standard': 'G_NORMAL_MAP',
 	'normal': 'G_NORMAL_MAP',
@@ -280,4 +333,16 @@ yahoo_precision_to_google_zoom_mappings = {
 	'city': 11,
 	'state': 9,
 	'country': 3,
-}
\ No newline at end of file
+}
+# From the Accuracy of a Google geocoder Placemark (0 is unknown)
+google_accuracy_to_google_zoom_mappings = {
+	1: 3, # Country
+	2: 9, # Region
+	3: 10, # Sub-region
+	4: 11, # Town
+	5: 13, # Post code
+	6: 16, # Street
+	7: 16, # Intersection
+	8: 17, # Address
+	9: 17, # Premise
+}
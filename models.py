@@ -1,11 +1,11 @@
-import datetime
+import datetime, time
 from geopy import distance as geopy_distance
 
 from django.db import models
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
-from geo import geocoding, managers, fields as custom_fields
+from geo import distances, expiry, gazetteer, geocoding, geohash as geo_geohash, managers, metrics, refresher, fields as custom_fields
 from geo.dateutil.relativedelta import relativedelta
 
 class Location(models.Model):
@@ -17,6 +17,8 @@ class Location(models.Model):
 	latitude = models.FloatField(blank=True, null=False)
 	longitude = models.FloatField(blank=True, null=False)
 	refreshed = models.DateTimeField(editable=False, blank=True, null=False, default=datetime.datetime.now())
+	expires_at = models.DateTimeField(editable=False, blank=True, null=True, db_index=True)
+	geohash = models.CharField(max_length=geo_geohash.PRECISION, editable=False, blank=True, null=True, db_index=True)
 	extra = custom_fields.DictionaryField(_('A dictionary of additional information'), blank=True, null=True, editable=False)
 	created = models.DateTimeField(editable=False, blank=True, null=True, default=datetime.datetime.now())
 	is_public = models.BooleanField(default=True)
@@ -28,8 +30,24 @@ class Location(models.Model):
 		list_filter = ('created', 'refreshed')
 	
 	def save(self, *args, **kwargs):
-		self.refresh()
-		return super(Location, self).save(*args, **kwargs)
+		# With settings.GEOCODING_STALE_WHILE_REVALIDATE, a stale location is saved as it is and re-geocoded
+		# in the background rather than blocking the save on the geocoder.
+		revalidate = getattr(settings, 'GEOCODING_STALE_WHILE_REVALIDATE', False) and self.stale
+		if not revalidate:
+			self.refresh()
+		self.expires_at = expiry.get_expiry_policy().location_expires(self)
+		if self.latitude is not None and self.longitude is not None:
+			self.geohash = geo_geohash.encode(self.latitude, self.longitude)
+		# Labelled with the geocoder that produced the result, if there is one
+		short_name = getattr(self.result, 'provider', None) or getattr(settings, 'DEFAULT_GEOCODER', None)
+		started = time.time()
+		try:
+			saved = super(Location, self).save(*args, **kwargs)
+		finally:
+			metrics.observe('save_seconds', short_name, time.time() - started)
+		if revalidate:
+			refresher.revalidate(self)
+		return saved
 	
 	# General
 	def __unicode__(self):
@@ -41,7 +59,7 @@ class Location(models.Model):
 	
 	def get_geocoder(self):
 		"""Returns an instantiated geocoder for this object. Make sure you have settings.DEFAULT_GEOCODER set correctly."""
-		return geocoding.SHORT_NAME_MAPPINGS[settings.DEFAULT_GEOCODER]
+		return geocoding.get_geocoder()
 	
 	@property
 	def coords(self):
@@ -71,8 +89,8 @@ class Location(models.Model):
 	# Caching
 	@property
 	def expires(self):
-		"""Returns the datetime when this object will be deemed to have expired."""
-		return self.refreshed + relativedelta(**settings.MAX_LOCATION_CACHE_AGE)
+		"""Returns the datetime when this object will be deemed to have expired (see expiry.ExpiryPolicy)."""
+		return self.expires_at or expiry.get_expiry_policy().location_expires(self)
 	
 	@property
 	def expired(self):
@@ -90,28 +108,45 @@ class Location(models.Model):
 			# The location hasn't expired
 			return False
 	
-	def force_refresh(self):
-		"""Forces a refresh of the geo-mapping by re-geocoding (if the location is geocoded)."""
+	@property
+	def stale(self):
+		"""Returns boolean as to whether this object has expired but may still be served while it's re-geocoded,
+		   i.e. it has been geocoded and expired less than settings.GEOCODING_MAX_STALENESS ago."""
+		if self.pk is None or not (self.expired and hasattr(self.result, 'coords')):
+			return False
+		return datetime.datetime.now() < self.expires + relativedelta(**getattr(settings, 'GEOCODING_MAX_STALENESS', {'days': 7}))
+	
+	def force_refresh(self, timeout=None):
+		"""Forces a refresh of the geo-mapping by re-geocoding (if the location is geocoded). timeout is the
+		   number of seconds (or a misc.Deadline) geocoding may take before GeocodingTimeout is raised; it
+		   defaults to settings.GEOCODING_TIMEOUT."""
 		if self.geocoded:
-			self.result = self.get_geocoder()(self).geocode()
+			# Only the compact StoredResult is persisted; older rows may still hold a full GeocodingResult
+			self.result = geocoding.store_result(self.get_geocoder()(self, timeout).geocode())
 			self.latitude, self.longitude = tuple(self.result.coords)[:2]
 			self.refreshed = datetime.datetime.now()
+			self.expires_at = expiry.get_expiry_policy().location_expires(self)
 		return self
 	
-	def refresh(self):
+	def refresh(self, timeout=None):
 		"""Refreshes the geo-mapping it has already expired."""
 		if self.expired:
-			self.force_refresh()
+			self.force_refresh(timeout)
 		return self
 	
 	# Conveniences
+	def nearest_place(self):
+		"""Returns the nearest populated place to this Location in the local gazetteer (see
+		   gazetteer.reverse_geocode())."""
+		return gazetteer.reverse_geocode(self.latitude, self.longitude)
+	
 	def distance_between(self, other_location, units='miles'):
 		"""Calculates the distance between this Location object and another Location object.
 		   units should be a string containing the unit of measurement (default: miles) you would like
 		   the result returned in (kilometers, miles, feet or nautical)."""
 		if self.coords_tuple == other_location.coords_tuple:
 			return 0
-		dist_obj = geopy_distance.distance(self.coords_tuple, other_location.coords_tuple)
+		dist_obj = geopy_distance.Distance(distances.distance(self.coords_tuple, other_location.coords_tuple))
 		return getattr(dist_obj, str(units))
 	
 	def within_bounds(self, north_west, south_east):
@@ -0,0 +1,24 @@
+"""Filtering and ordering of locations by their distance from an origin. Each candidate's distance is
+   computed just once (for all of them together, see geo.distances) and attached to it (as its distance
+   attribute, a geopy Distance), so that it can be reused for filtering, ordering and display."""
+from geopy import distance as geopy_distance
+
+from geo import distances
+
+def by_proximity(locations, origin, radius_miles=None, method=None):
+	"""Returns a list of locations (objects with latitude and longitude attributes) within radius_miles of
+	   origin (a lat/long pair) if specified, ordered by ascending distance from it. Each location is given a
+	   distance attribute. method is the distances method to use."""
+	locations = list(locations)
+	kilometers = distances.distances(origin, [location.latitude for location in locations], [location.longitude for location in locations], method)
+	limit = None
+	if radius_miles is not None:
+		limit = geopy_distance.Distance(miles=radius_miles).kilometers
+	nearby = []
+	for distance, location in zip(kilometers, locations):
+		if limit is None or distance <= limit:
+			nearby.append((float(distance), location))
+	nearby.sort(key=lambda pair: pair[0])
+	for distance, location in nearby:
+		location.distance = geopy_distance.Distance(distance)
+	return [location for distance, location in nearby]
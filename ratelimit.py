@@ -0,0 +1,109 @@
+"""Per-provider rate limiting for the geocoders. Each geocoder's short_name can be given a token bucket in
+   settings.GEOCODING_RATE_LIMITS, for example:
+   
+   GEOCODING_RATE_LIMITS = {
+       'yahoo': {'rate': 5, 'burst': 5, 'daily': 50000},
+       'geonames': {'rate': 1},
+   }
+   
+   rate is the sustained number of requests per second, burst how many can be made at once after a quiet
+   spell, and daily the number allowed per (local) calendar day. Requests over the rate are queued and
+   released at exactly the allowed rate, from whichever thread makes them."""
+import datetime, threading, time
+
+from django.conf import settings
+
+from geo.misc import GeocodingQuotaExceeded
+
+class TokenBucket(object):
+	"""A thread-safe token bucket. Callers of acquire() reserve the next free slot and sleep until it
+	   comes round, so waiting requests are dispatched in order and as fast as the rate allows. clock is the
+	   function returning the current time in seconds (time.time by default)."""
+	def __init__(self, rate, burst=1, daily=None, clock=None, *args, **kwargs):
+		self.rate, self.burst, self.daily = float(rate), burst, daily
+		self.clock = clock or time.time
+		self.tokens = float(burst)
+		self.updated = self.clock()
+		self.lock = threading.Lock()
+		self.day, self.day_count = datetime.date.fromtimestamp(self.updated), 0
+		# Statistics
+		self.waiting = 0
+		self.requests = 0
+		self.total_wait = 0.0
+		self.max_wait = 0.0
+		return super(TokenBucket, self).__init__(*args, **kwargs)
+	
+	def reserve(self, timeout=None):
+		"""Takes a token, returning how many seconds the caller must wait before using it. Raises
+		   GeocodingQuotaExceeded (without taking a token) if the daily quota has been used up, or if the wait
+		   would be longer than timeout seconds."""
+		self.lock.acquire()
+		try:
+			now = self.clock()
+			today = datetime.date.fromtimestamp(now)
+			if today != self.day:
+				self.day, self.day_count = today, 0
+			if self.daily is not None and self.day_count >= self.daily:
+				raise GeocodingQuotaExceeded('The daily quota of %s requests has been used.' % self.daily)
+			self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			# tokens goes negative while requests are queued; each queued request waits for its own token
+			wait = max(0.0, (1 - self.tokens) / self.rate)
+			if timeout is not None and wait > timeout:
+				raise GeocodingQuotaExceeded('The rate limit would delay this request by %.2f seconds.' % wait)
+			self.tokens -= 1
+			self.day_count += 1
+			self.requests += 1
+			self.total_wait += wait
+			self.max_wait = max(self.max_wait, wait)
+			return wait
+		finally:
+			self.lock.release()
+	
+	def acquire(self, timeout=None):
+		"""Blocks until a request may be made (see reserve()). Returns the number of seconds waited."""
+		wait = self.reserve(timeout)
+		if wait:
+			self.lock.acquire()
+			self.waiting += 1
+			self.lock.release()
+			try:
+				time.sleep(wait)
+			finally:
+				self.lock.acquire()
+				self.waiting -= 1
+				self.lock.release()
+		return wait
+	
+	def stats(self):
+		"""Returns a dictionary with the current queue depth, and the number of requests and the average and
+		   maximum time they've waited."""
+		self.lock.acquire()
+		try:
+			return {
+				'queue_depth': self.waiting,
+				'requests': self.requests,
+				'requests_today': self.day_count,
+				'average_wait': self.requests and self.total_wait / self.requests or 0.0,
+				'max_wait': self.max_wait,
+			}
+		finally:
+			self.lock.release()
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_rate_limiter(short_name):
+	"""Returns the shared TokenBucket for the geocoder with short_name, or None if it isn't rate limited."""
+	try:
+		return _buckets[short_name]
+	except KeyError:
+		pass
+	_buckets_lock.acquire()
+	try:
+		if short_name not in _buckets:
+			options = getattr(settings, 'GEOCODING_RATE_LIMITS', {}).get(short_name)
+			_buckets[short_name] = options and TokenBucket(**dict([(str(k), v) for k, v in options.items()])) or None
+		return _buckets[short_name]
+	finally:
+		_buckets_lock.release()
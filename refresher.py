@@ -0,0 +1,242 @@
+"""Re-geocoding of expired Locations off the request path. Expired rows are walked in primary key order in
+   chunks, re-geocoded concurrently with geocoding.geocode_many(), and written back with UPDATEs touching
+   only their coordinates (and geohash), result and refreshed and expiry times. Progress can be saved to a file after every chunk so
+   an interrupted run can be resumed. Locations saved while stale (see Location.save()) are re-geocoded by
+   the RevalidationQueue's background workers instead."""
+import datetime, os, Queue, threading, time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from geo import expiry, geocoding, geohash as geo_geohash, metrics
+from geo.misc import GeocodingError
+
+class RefreshReport(object):
+	"""Running totals for a refresh."""
+	def __init__(self, *args, **kwargs):
+		self.started = time.time()
+		self.refreshed = 0
+		self.failed = 0
+		self.chunks = 0
+		self.last_pk = None
+		return super(RefreshReport, self).__init__(*args, **kwargs)
+	
+	@property
+	def elapsed(self):
+		return time.time() - self.started
+	
+	@property
+	def rate(self):
+		"""Locations processed per second."""
+		return self.elapsed and (self.refreshed + self.failed) / self.elapsed or 0.0
+	
+	def __unicode__(self):
+		return u'%d refreshed, %d failed in %d chunks (%.1f seconds, %.1f locations/second); last id %s' % (
+			self.refreshed, self.failed, self.chunks, self.elapsed, self.rate, self.last_pk)
+	
+	def __str__(self):
+		return unicode(self).encode('utf-8')
+
+def read_progress(path):
+	"""Returns the last primary key recorded in the progress file at path, or None."""
+	if not path or not os.path.exists(path):
+		return None
+	value = open(path).read().strip()
+	return value and int(value) or None
+
+def write_progress(path, pk):
+	# Written to a temporary file and renamed, so an interruption can't leave a truncated file behind
+	temporary = '%s.tmp' % path
+	progress = open(temporary, 'w')
+	try:
+		progress.write('%s\n' % pk)
+	finally:
+		progress.close()
+	os.rename(temporary, path)
+
+def write_back(model, results):
+	"""Saves the (location, GeocodingResult) pairs in results, in one transaction."""
+	now = datetime.datetime.now()
+	policy = expiry.get_expiry_policy()
+	for location, result in results:
+		location.latitude, location.longitude = tuple(result.coords)[:2]
+		location.result, location.refreshed = geocoding.store_result(result), now
+		location.expires_at = policy.location_expires(location)
+		location.geohash = geo_geohash.encode(location.latitude, location.longitude)
+		model.objects.filter(pk=location.pk).update(latitude=location.latitude, longitude=location.longitude, result=location.result,
+			refreshed=now, expires_at=location.expires_at, geohash=location.geohash)
+write_back = transaction.commit_on_success(write_back)
+
+def refresh_expired(model=None, chunk_size=500, max_workers=4, provider=None, timeout=None, progress_file=None, callback=None):
+	"""Re-geocodes every expired, geocoded row of model (defaults to Location), chunk_size rows at a time over
+	   max_workers threads. timeout is a budget in seconds for each chunk. If progress_file is given the last
+	   primary key processed is saved in it after every chunk, and a later run starts from there. callback,
+	   if given, is called with the RefreshReport after each chunk. Returns the final RefreshReport."""
+	if model is None:
+		from geo.models import Location as model
+	report = RefreshReport()
+	report.last_pk = read_progress(progress_file)
+	while True:
+		chunk = model.objects.expired.filter(geocoded=True).order_by('pk')
+		if report.last_pk is not None:
+			chunk = chunk.filter(pk__gt=report.last_pk)
+		chunk = list(chunk[:chunk_size])
+		if not chunk:
+			break
+		results = []
+		for location, result in geocoding.geocode_many(chunk, provider, max_workers, timeout):
+			if isinstance(result, GeocodingError):
+				report.failed += 1
+			else:
+				results.append((location, result))
+		write_back(model, results)
+		report.refreshed += len(results)
+		report.chunks += 1
+		report.last_pk = chunk[-1].pk
+		if progress_file:
+			write_progress(progress_file, report.last_pk)
+		if callback is not None:
+			callback(report)
+	if progress_file and os.path.exists(progress_file):
+		# The run completed, so the next one should start from the beginning again
+		os.remove(progress_file)
+	return report
+
+def backfill_geohashes(model=None, chunk_size=1000, everything=False, callback=None):
+	"""Fills in the geohash of every row of model (defaults to Location) which doesn't have one yet, or of
+	   every row if everything is True, chunk_size rows (and one transaction) at a time. callback, if given,
+	   is called with the number of rows updated so far after each chunk. Returns the number updated."""
+	if model is None:
+		from geo.models import Location as model
+	rows = model.objects.all()
+	if not everything:
+		rows = rows.filter(geohash__isnull=True)
+	def update(chunk):
+		for pk, latitude, longitude in chunk:
+			model.objects.filter(pk=pk).update(geohash=geo_geohash.encode(latitude, longitude))
+	update = transaction.commit_on_success(update)
+	updated, last_pk = 0, None
+	while True:
+		chunk = rows.order_by('pk')
+		if last_pk is not None:
+			chunk = chunk.filter(pk__gt=last_pk)
+		chunk = list(chunk.values_list('pk', 'latitude', 'longitude')[:chunk_size])
+		if not chunk:
+			return updated
+		update(chunk)
+		updated += len(chunk)
+		last_pk = chunk[-1][0]
+		if callback is not None:
+			callback(updated)
+
+class RevalidationQueue(object):
+	"""Re-geocodes stale Locations in the background. Up to max_size primary keys are queued (each at most once)
+	   and worked through by workers daemon threads, started on first use, using the geocoder with short_name
+	   provider (defaults to settings.DEFAULT_GEOCODER). With no workers, call drain() to process the queue."""
+	def __init__(self, workers=1, max_size=1000, provider=None, *args, **kwargs):
+		self.workers, self.provider = workers, provider
+		self.queue = Queue.Queue(max_size)
+		self.pending = set()
+		self.lock = threading.Lock()
+		self.threads = []
+		return super(RevalidationQueue, self).__init__(*args, **kwargs)
+	
+	def put(self, location):
+		"""Queues location to be re-geocoded. Returns False if it was already queued or the queue is full (it
+		   will then be queued again the next time it's saved)."""
+		self.lock.acquire()
+		try:
+			if location.pk in self.pending:
+				return False
+			try:
+				self.queue.put_nowait((type(location), location.pk))
+			except Queue.Full:
+				metrics.increment('revalidations_dropped', self.provider or settings.DEFAULT_GEOCODER)
+				return False
+			self.pending.add(location.pk)
+			if len(self.threads) < self.workers:
+				self.start()
+		finally:
+			self.lock.release()
+		return True
+	
+	def start(self):
+		while len(self.threads) < self.workers:
+			thread = threading.Thread(target=self.work)
+			thread.setDaemon(True)
+			thread.start()
+			self.threads.append(thread)
+	
+	def revalidate(self, model, pk):
+		"""Re-geocodes the location of model with primary key pk, unless it has been refreshed meanwhile."""
+		short_name = self.provider or settings.DEFAULT_GEOCODER
+		try:
+			location = model.objects.get(pk=pk)
+			if location.expired:
+				write_back(model, [(location, geocoding.get_geocoder(self.provider)(location).geocode())])
+				metrics.increment('revalidations', short_name)
+		except Exception:
+			# The location is still served stale, and will be queued again when it's next saved
+			metrics.increment('revalidation_errors', short_name)
+	
+	def take(self, block=True):
+		model, pk = self.queue.get(block)
+		self.lock.acquire()
+		try:
+			self.pending.discard(pk)
+		finally:
+			self.lock.release()
+		return model, pk
+	
+	def work(self):
+		while True:
+			model, pk = self.take()
+			try:
+				self.revalidate(model, pk)
+			finally:
+				# Don't hold a connection (or a transaction snapshot) open between jobs
+				connection.close()
+	
+	def drain(self):
+		"""Re-geocodes every queued location in the calling thread. Returns how many were processed."""
+		processed = 0
+		while True:
+			try:
+				model, pk = self.take(False)
+			except Queue.Empty:
+				return processed
+			self.revalidate(model, pk)
+			processed += 1
+
+_revalidation_queue = None
+_revalidation_queue_lock = threading.Lock()
+
+def get_revalidation_queue():
+	"""Returns the shared RevalidationQueue, configured from settings.GEOCODING_REVALIDATION_WORKERS and
+	   settings.GEOCODING_REVALIDATION_QUEUE_SIZE on first use."""
+	global _revalidation_queue
+	if _revalidation_queue is None:
+		_revalidation_queue_lock.acquire()
+		try:
+			if _revalidation_queue is None:
+				_revalidation_queue = RevalidationQueue(
+					workers=getattr(settings, 'GEOCODING_REVALIDATION_WORKERS', 1),
+					max_size=getattr(settings, 'GEOCODING_REVALIDATION_QUEUE_SIZE', 1000),
+				)
+		finally:
+			_revalidation_queue_lock.release()
+	return _revalidation_queue
+
+def set_revalidation_queue(queue):
+	"""Replaces the shared RevalidationQueue. Passing None makes the next get_revalidation_queue() call rebuild
+	   it from settings."""
+	global _revalidation_queue
+	_revalidation_queue_lock.acquire()
+	try:
+		_revalidation_queue = queue
+	finally:
+		_revalidation_queue_lock.release()
+
+def revalidate(location):
+	"""Queues location to be re-geocoded in the background."""
+	return get_revalidation_queue().put(location)
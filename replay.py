@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the geocoding services which replays recorded responses, so geocoding can be tested
+   and benchmarked without network access. ReplayServer can add latency to responses and fail a proportion
+   of requests. Point the geocoders at it by passing its host_overrides to a transport, e.g.
+
+   	server = ReplayServer(latency=0.05, error_rate=0.01).start()
+   	transport.set_transport(transport.PooledHTTPTransport(host_overrides=server.host_overrides))"""
+import BaseHTTPServer, cgi, gzip, random, SocketServer, threading, time, urlparse, zlib
+from cStringIO import StringIO
+
+# Responses recorded from each service for u'London, UK'
+YAHOO_RESPONSE = '<?xml version="1.0"?><ResultSet xmlns="urn:yahoo:maps"><Result precision="city"><Latitude>51.506325</Latitude><Longitude>-0.127144</Longitude><Address></Address><City>London</City><State>United Kingdom</State><Zip></Zip><Country>GB</Country></Result></ResultSet>'
+GOOGLE_RESPONSE = '<?xml version="1.0" encoding="UTF-8" ?><kml xmlns="http://earth.google.com/kml/2.0"><Response><name>London, UK</name><Status><code>200</code><request>geocode</request></Status><Placemark id="p1"><address>London, UK</address><AddressDetails Accuracy="4" xmlns="urn:oasis:names:tc:ciq:xsdschema:xAL:2.0"><Country><CountryNameCode>GB</CountryNameCode><CountryName>UK</CountryName><AdministrativeArea><AdministrativeAreaName>Greater London</AdministrativeAreaName><Locality><LocalityName>London</LocalityName></Locality></AdministrativeArea></Country></AddressDetails><ExtendedData><LatLonBox north="51.6723432" south="51.2867602" east="0.1483700" west="-0.3526120" /></ExtendedData><Point><coordinates>-0.1262362,51.5001524,0</coordinates></Point></Placemark></Response></kml>'
+GOOGLE_JSON_RESPONSE = '{"name": "London, UK", "Status": {"code": 200, "request": "geocode"}, "Placemark": [{"id": "p1", "address": "London, UK", "AddressDetails": {"Accuracy": 4, "Country": {"CountryNameCode": "GB", "CountryName": "UK", "AdministrativeArea": {"AdministrativeAreaName": "Greater London", "Locality": {"LocalityName": "London"}}}}, "ExtendedData": {"LatLonBox": {"north": 51.6723432, "south": 51.2867602, "east": 0.14837, "west": -0.352612}}, "Point": {"coordinates": [-0.1262362, 51.5001524, 0]}}]}'
+GEONAMES_RESPONSE = '<?xml version="1.0" encoding="UTF-8" standalone="no"?><geonames style="MEDIUM"><totalResultsCount>2890</totalResultsCount><geoname><toponymName>London</toponymName><name>London</name><lat>51.50853</lat><lng>-0.12574</lng><geonameId>2643743</geonameId><countryCode>GB</countryCode><countryName>United Kingdom</countryName><fcl>P</fcl><fcode>PPLC</fcode></geoname></geonames>'
+GEONAMES_JSON_RESPONSE = '{"totalResultsCount": 2890, "geonames": [{"toponymName": "London", "name": "London", "lat": 51.50853, "lng": -0.12574, "geonameId": 2643743, "countryCode": "GB", "countryName": "United Kingdom", "fcl": "P", "fcode": "PPLC"}]}'
+
+# The hosts of the services replayed (which a transport's host_overrides should send to the server)
+HOSTS = ('local.yahooapis.com', 'maps.google.com', 'ws.geonames.org')
+# Maps each service's path to the content type and response body replayed for it
+FIXTURES = {
+	'/MapsService/V1/geocode': ('text/xml', YAHOO_RESPONSE),
+	'/maps/geo': ('text/xml', GOOGLE_RESPONSE),
+	'/search': ('text/xml', GEONAMES_RESPONSE),
+	'/searchJSON': ('application/json', GEONAMES_JSON_RESPONSE),
+}
+# Google's geocoder picks its format from the output parameter rather than the path
+FORMATS = {
+	('/maps/geo', 'json'): ('application/json', GOOGLE_JSON_RESPONSE),
+}
+
+def compress(body, encoding=None):
+	"""Returns body compressed as it would be for the given Content-Encoding."""
+	if encoding == 'gzip':
+		compressed = StringIO()
+		gzipped = gzip.GzipFile(fileobj=compressed, mode='wb')
+		gzipped.write(body)
+		gzipped.close()
+		return compressed.getvalue()
+	if encoding == 'deflate':
+		return zlib.compress(body)
+	return body
+
+def geonames_rows(count=1000):
+	"""Returns a GeoNames search response with count rows, as for a query with maxRows set."""
+	row = GEONAMES_RESPONSE[GEONAMES_RESPONSE.index('<geoname>'):GEONAMES_RESPONSE.index('</geonames>')]
+	return GEONAMES_RESPONSE.replace(row, row * count)
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	# HTTP/1.1, so that connections are kept alive as the real services' are
+	protocol_version = 'HTTP/1.1'
+	# Each response is buffered and sent in one go, so the status line, headers and body don't each wait on
+	# the client's delayed ACK
+	wbufsize = -1
+	disable_nagle_algorithm = True
+	
+	def do_GET(self):
+		server = self.server
+		server.count()
+		delay = server.delay()
+		if delay:
+			time.sleep(delay)
+		if server.fail():
+			return self.respond(server.error_status, 'text/plain', 'Injected error')
+		path, query = urlparse.urlsplit(self.path)[2:4]
+		output = cgi.parse_qs(query).get('output', [None])[0]
+		fixture = server.formats.get((path, output)) or server.fixtures.get(path)
+		if fixture is None:
+			return self.respond(404, 'text/plain', 'No recorded response for %s' % path)
+		content_type, body = fixture
+		encoding = None
+		accepted = self.headers.get('Accept-Encoding', '')
+		if server.compress and 'gzip' in accepted:
+			encoding = 'gzip'
+		elif server.compress and 'deflate' in accepted:
+			encoding = 'deflate'
+		return self.respond(200, content_type, compress(body, encoding), encoding)
+	
+	def respond(self, status, content_type, body, encoding=None):
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		if encoding:
+			self.send_header('Content-Encoding', encoding)
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def log_message(self, *args):
+		pass
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""Serves the recorded fixtures (dictionaries like FIXTURES and FORMATS) for the services at hosts on
+	   host:port (any free port if port is 0). Each response is delayed by latency seconds plus up to
+	   latency_jitter more, and error_rate (0-1) of requests are answered with HTTP error_status instead.
+	   Responses are gzip or deflate compressed for clients which accept it, unless compress is False. seed
+	   makes the injected delays and errors repeatable. requests counts the requests served."""
+	daemon_threads = True
+	allow_reuse_address = True
+	
+	def __init__(self, host='127.0.0.1', port=0, hosts=HOSTS, fixtures=FIXTURES, formats=FORMATS, latency=0, latency_jitter=0, error_rate=0, error_status=503, compress=True, seed=None, *args, **kwargs):
+		self.hosts, self.fixtures, self.formats = hosts, fixtures, formats
+		self.latency, self.latency_jitter = latency, latency_jitter
+		self.error_rate, self.error_status = error_rate, error_status
+		self.compress = compress
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.requests = 0
+		self.thread = None
+		return BaseHTTPServer.HTTPServer.__init__(self, (host, port), ReplayHandler, *args, **kwargs)
+	
+	@property
+	def address(self):
+		"""The 'host:port' the server is listening on."""
+		return '%s:%s' % self.server_address[:2]
+	
+	@property
+	def host_overrides(self):
+		"""A Transport host_overrides dictionary sending each recorded service's requests to this server."""
+		return dict([(host, self.address) for host in self.hosts])
+	
+	def count(self):
+		self.lock.acquire()
+		try:
+			self.requests += 1
+		finally:
+			self.lock.release()
+	
+	def delay(self):
+		self.lock.acquire()
+		try:
+			return self.latency + self.latency_jitter * self.random.random()
+		finally:
+			self.lock.release()
+	
+	def fail(self):
+		if not self.error_rate:
+			return False
+		self.lock.acquire()
+		try:
+			return self.random.random() < self.error_rate
+		finally:
+			self.lock.release()
+	
+	def start(self):
+		"""Starts serving in a daemon thread. Returns the server."""
+		self.thread = threading.Thread(target=self.serve_forever)
+		self.thread.setDaemon(True)
+		self.thread.start()
+		return self
+	
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		self.thread.join()
@@ -13,7 +13,24 @@ class DictTestingModel(models.Model):
 class TestCustomDataType(str):
 	pass
 
+# Recorded geocoder responses (also replayed by the replay server and used by the benchmarks)
+from replay import YAHOO_RESPONSE, GOOGLE_RESPONSE, GOOGLE_JSON_RESPONSE, GEONAMES_RESPONSE, GEONAMES_JSON_RESPONSE
+
 class DummyLocation(object):
 	def __init__(self, location, *args, **kwargs):
 		self.name = location
 		return super(DummyLocation, self).__init__(*args, **kwargs)
+
+# A few rows in the format of a GeoNames dump, for testing the gazetteer
+GAZETTEER_FIXTURE = """\
+2643743\tLondon\tLondon\tLondres,Londra,LON\t51.50853\t-0.12574\tP\tPPLC\tGB\t\t\t\t\t\t7556900\t25\t25\tEurope/London\t2010-01-01
+6058560\tLondon\tLondon\t\t42.98339\t-81.23304\tP\tPPL\tCA\t\t\t\t\t\t346765\t251\t251\tEurope/London\t2010-01-01
+2988507\tParis\tParis\tParigi,Paname\t48.85341\t2.3488\tP\tPPLC\tFR\t\t\t\t\t\t2138551\t35\t35\tEurope/London\t2010-01-01
+4717560\tParis\tParis\t\t33.66094\t-95.55551\tP\tPPLA2\tUS\t\t\t\t\t\t25171\t183\t183\tEurope/London\t2010-01-01
+2635167\tUnited Kingdom\tUnited Kingdom\tUK,Great Britain\t54.75844\t-2.69531\tA\tPCLI\tGB\t\t\t\t\t\t62348447\t0\t0\tEurope/London\t2010-01-01
+2147714\tSydney\tSydney\t\t-33.86785\t151.20732\tP\tPPLA\tAU\t\t\t\t\t\t4627345\t58\t58\tEurope/London\t2010-01-01
+2193733\tAuckland\tAuckland\t\t-36.84853\t174.76349\tP\tPPLA\tNZ\t\t\t\t\t\t417910\t26\t26\tEurope/London\t2010-01-01
+4031574\tApia\tApia\t\t-13.83333\t-171.76666\tP\tPPLC\tWS\t\t\t\t\t\t40407\t2\t2\tEurope/London\t2010-01-01
+3413829\tReykjavik\tReykjavik\t\t64.13548\t-21.89541\tP\tPPLC\tIS\t\t\t\t\t\t118918\t40\t40\tEurope/London\t2010-01-01
+778707\tLongyearbyen\tLongyearbyen\t\t78.22334\t15.64689\tP\tPPLA\tSJ\t\t\t\t\t\t2060\t10\t10\tEurope/London\t2010-01-01
+"""
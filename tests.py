@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Unit testing for this module's fields and a subset of the model's functions.."""
 
+import datetime
 from geopy import distance as geopy_distance
 from django.test import TestCase
 from django.db import models
@@ -9,6 +10,19 @@ from fields import PickledObjectField
 from test_assets import *
 import models as geo_models
 import geocoding
+import cache as geo_cache
+import ratelimit
+import gazetteer
+import refresher
+import expiry
+import benchmarks
+import transport
+import replay
+import proximity
+import distances
+import geohash
+import metrics
+from misc import normalize_query, Deadline, GeocoderUnavailable, GeocodingQuotaExceeded, GeocodingTimeout
 
 class PickledObjectFieldTests(TestCase):
 	def setUp(self):
@@ -62,6 +76,885 @@ class DictionaryFieldTests(TestCase):
 			self.assertEquals(value, DictTestingModel.objects.get(dictionary_field__exact=value).dictionary_field)
 			
 
+class GeocodeCacheTests(TestCase):
+	def testNormalization(self):
+		"""Tests that trivially different queries share a cache key."""
+		self.assertEquals(normalize_query(u' london,uk '), normalize_query(u'London, UK'))
+		cache = geo_cache.GeocodeCache(max_size=10)
+		cache.set('google', u'London, UK', 'result')
+		self.assertEquals('result', cache.get('google', u' london,uk '))
+		self.assertEquals(None, cache.get('yahoo', u'London, UK'))
+		self.assertEquals(1, cache.stats()['local_hits'])
+		self.assertEquals(1, cache.stats()['misses'])
+	
+	def testEviction(self):
+		"""Tests that the least recently used item is evicted first and that expired items aren't returned."""
+		cache = geo_cache.LRUCache(max_size=2)
+		cache.set('a', 1)
+		cache.set('b', 2)
+		cache.get('a')
+		cache.set('c', 3)
+		self.assertEquals((1, None, 3), (cache.get('a'), cache.get('b'), cache.get('c')))
+		cache.set('d', 4, ttl=-1)
+		self.assertEquals(None, cache.get('d'))
+		cache = geo_cache.LRUCache(max_size=2, ttl=60)
+		cache.set('e', 5, ttl=0)
+		self.assertEquals(None, cache.get('e'))
+	
+	def testCopies(self):
+		"""Tests that changing a geocoded result doesn't change the cached copy of it."""
+		geocoding.GeoNamesGeocoder.transport = benchmarks.StaticTransport(GEONAMES_RESPONSE)
+		geo_cache.get_cache().clear()
+		try:
+			result = geocoding.GeoNamesGeocoder(u'London, UK').geocode()
+			result.coords.latitude = 0.0
+			result.response.data[u'name'].text = u'Atlantis'
+			for i in range(2):
+				result = geocoding.GeoNamesGeocoder(u'London, UK').geocode()
+				self.assertEquals((51.50853, u'London'), (result.coords.latitude, result.response.data[u'name'].text))
+				result.coords.latitude = 0.0
+			self.assertEquals(1, geo_cache.get_cache().stats()['misses'])
+		finally:
+			geocoding.GeoNamesGeocoder.transport = None
+			geo_cache.get_cache().clear()
+	
+	def testNegativeCaching(self):
+		"""Tests that failed queries are blocked for exponentially longer after each consecutive failure."""
+		cache = geo_cache.GeocodeCache(max_size=10, negative_ttl=10, max_negative_ttl=30)
+		self.assertEquals(None, cache.get_failure('google', u'Atlantis'))
+		self.assertEquals([10, 20, 30], [cache.set_failure('google', u'Atlantis', u'Not found') for i in range(3)])
+		self.assertEquals(u'Not found', cache.get_failure('google', u' atlantis'))
+		cache.delete_failure('google', u'Atlantis')
+		self.assertEquals(None, cache.get_failure('google', u'Atlantis'))
+	
+	def testSharedNegativeCaching(self):
+		"""Tests that a failure recorded by one process is seen, and can be forgotten, by another."""
+		first, second = [geo_cache.GeocodeCache(max_size=10, use_django_cache=True, negative_ttl=10) for i in range(2)]
+		first.set_failure('google', u'Atlantis', u'Not found')
+		self.assertEquals(u'Not found', second.get_failure('google', u'Atlantis'))
+		second.delete_failure('google', u'Atlantis')
+		self.assertEquals(None, second.get_failure('google', u'Atlantis'))
+		self.assertEquals(None, geo_cache.GeocodeCache(max_size=10, use_django_cache=True).get_failure('google', u'Atlantis'))
+	
+	def testDjangoKeys(self):
+		"""Tests that keys in Django's cache are safe for memcached (no spaces or control characters, and at most
+		   250 bytes), and shared by trivially different queries."""
+		cache = geo_cache.GeocodeCache(max_size=0, use_django_cache=True)
+		for query in (u'London, UK', u'Z\xfcrich\n' * 100):
+			key = cache.django_key('google', query)
+			self.assert_(isinstance(key, str) and len(key) <= 250)
+			self.assert_(not [character for character in key if ord(character) <= 32 or ord(character) >= 127])
+		self.assertEquals(cache.django_key('google', u' london,uk '), cache.django_key('google', u'London, UK'))
+		cache.set('google', u'Z\xfcrich, ' * 100, 'result')
+		self.assertEquals('result', cache.get('google', u'Z\xfcrich, ' * 100))
+	
+	def testSingleFlight(self):
+		"""Tests that concurrent calls for the same key are coalesced into one."""
+		import threading, time
+		flight, calls, results = geo_cache.SingleFlight(), [], []
+		def slow_call():
+			calls.append(1)
+			time.sleep(0.1)
+			return 'result'
+		threads = [threading.Thread(target=lambda: results.append(flight.do('key', slow_call))) for i in range(5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEquals(1, len(calls))
+		self.assertEquals(['result'] * 5, results)
+
+class RateLimitTests(TestCase):
+	def setUp(self):
+		# A fake clock, so that the waits don't depend on how quickly the test runs
+		self.now = [1262304000.0]
+		self.clock = lambda: self.now[0]
+		return super(RateLimitTests, self).setUp()
+	
+	def testTokenBucket(self):
+		"""Tests that requests beyond the burst are spaced out at the bucket's rate, and that the daily quota is
+		   enforced."""
+		bucket = ratelimit.TokenBucket(rate=10, burst=2, daily=5, clock=self.clock)
+		waits = [bucket.reserve() for i in range(4)]
+		self.assertEquals([0.0, 0.0], waits[:2])
+		self.assertAlmostEquals(0.1, waits[2])
+		self.assertAlmostEquals(0.2, waits[3])
+		# Once the queued requests have been sent, the bucket refills at its rate
+		self.now[0] += 0.35
+		self.assertAlmostEquals(0.0, bucket.reserve())
+		self.assertRaises(GeocodingQuotaExceeded, bucket.reserve)
+		self.assertEquals(5, bucket.stats()['requests_today'])
+		self.now[0] += 24 * 60 * 60
+		self.assertEquals(0.0, bucket.reserve())
+		self.assertEquals(1, bucket.stats()['requests_today'])
+	
+	def testTimeout(self):
+		"""Tests that a request which would have to wait too long is refused without using a token."""
+		bucket = ratelimit.TokenBucket(rate=1, burst=1, clock=self.clock)
+		bucket.reserve()
+		self.assertRaises(GeocodingQuotaExceeded, bucket.reserve, 0.5)
+		self.assertEquals(1, bucket.stats()['requests'])
+		self.now[0] += 0.6
+		self.assertAlmostEquals(0.4, bucket.reserve(0.5), 6)
+
+class StubGeocoder(geocoding.XMLGeocoder):
+	"""A geocoder which takes delay seconds (or until its deadline) to return latitude, or raise error."""
+	short_name = u'stub'
+	delay = 0
+	error = None
+	latitude = 0.0
+	calls = None
+	
+	def geocode(self, use_cache=True):
+		import threading, time
+		self.calls.append((self.short_name, threading.currentThread()))
+		remaining = self.deadline.remaining()
+		if remaining is not None and remaining <= self.delay:
+			time.sleep(remaining)
+			raise geocoding.GeocodingTimeout('The geocoding deadline was exceeded.')
+		time.sleep(self.delay)
+		if self.error is not None:
+			raise self.error
+		self.result.coords = geocoding.Coordinates(self.latitude, 0)
+		return self.result
+
+class FailoverTests(TestCase):
+	def setUp(self):
+		self.calls = []
+		return super(FailoverTests, self).setUp()
+	
+	def stub(self, short_name, latitude=0.0, delay=0, error=None):
+		return type('StubGeocoder', (StubGeocoder,), {'short_name': short_name, 'latitude': latitude, 'delay': delay, 'error': error, 'calls': self.calls})
+	
+	def failover(self, providers, hedge_delay=None, timeout=None):
+		attributes = {'providers': providers}
+		if hedge_delay is not None:
+			# No latencies are recorded for the stubs, so hedge_delay is always used
+			attributes.update(hedge_percentile=95, hedge_delay=hedge_delay)
+		return type('TestFailoverGeocoder', (geocoding.FailoverGeocoder,), attributes)(u'London, UK', timeout)
+	
+	def testFailover(self):
+		"""Tests that providers are tried in order until one succeeds, in the calling thread if not hedging."""
+		import threading
+		result = self.failover([self.stub(u'bad', error=geocoding.GeocodingError('Not found')), self.stub(u'good', 1.0), self.stub(u'unused', 2.0)]).geocode()
+		self.assertEquals(1.0, result.coords.latitude)
+		self.assertEquals([(u'bad', threading.currentThread()), (u'good', threading.currentThread())], self.calls)
+		failover = self.failover([self.stub(u'bad', error=geocoding.GeocodingError('Not found')), self.stub(u'broken', error=ValueError('Oops'))])
+		self.assertRaises(geocoding.GeocodingError, failover.geocode)
+	
+	def testHedging(self):
+		"""Tests that a slow provider is hedged with the next, and that the first good result wins."""
+		import time
+		started = time.time()
+		result = self.failover([self.stub(u'slow', 1.0, delay=0.5), self.stub(u'fast', 2.0)], hedge_delay=0.05).geocode()
+		self.assertEquals(2.0, result.coords.latitude)
+		self.assert_(time.time() - started < 0.4)
+		self.assertEquals([u'slow', u'fast'], [short_name for short_name, thread in self.calls])
+		# A failed hedge leaves the slow provider's result to be waited for
+		result = self.failover([self.stub(u'slow', 1.0, delay=0.2), self.stub(u'bad', error=geocoding.GeocodingError('Not found'))], hedge_delay=0.05).geocode()
+		self.assertEquals(1.0, result.coords.latitude)
+	
+	def testDeadline(self):
+		"""Tests that GeocodingTimeout is raised once the deadline passes, hedging or not."""
+		import time
+		started = time.time()
+		failover = self.failover([self.stub(u'slow', delay=0.5), self.stub(u'unused')], timeout=0.2)
+		self.assertRaises(geocoding.GeocodingTimeout, failover.geocode)
+		self.assert_(time.time() - started < 0.4)
+		self.assertEquals([u'slow'], [short_name for short_name, thread in self.calls])
+		started = time.time()
+		failover = self.failover([self.stub(u'slow', delay=0.5), self.stub(u'slower', delay=1.0)], hedge_delay=0.05, timeout=0.2)
+		self.assertRaises(geocoding.GeocodingTimeout, failover.geocode)
+		self.assert_(time.time() - started < 0.4)
+	
+	def testDefaultProviders(self):
+		"""Tests that by default each service is tried once, in its configured format, and the gazetteer only if
+		   it's set up."""
+		settings.GEOCODING_RESPONSE_FORMATS = {'google': 'json'}
+		try:
+			self.assertEquals([geocoding.GeoNamesGeocoder, geocoding.GoogleJSONGeocoder, geocoding.YahooGeocoder], geocoding.FailoverGeocoder(u'London, UK').get_providers())
+			settings.GEOCODING_GAZETTEER_PATH = '/tmp/cities1000.txt'
+			try:
+				self.assert_(geocoding.GazetteerGeocoder in geocoding.FailoverGeocoder(u'London, UK').get_providers())
+			finally:
+				del settings.GEOCODING_GAZETTEER_PATH
+		finally:
+			del settings.GEOCODING_RESPONSE_FORMATS
+
+class MetricsTests(TestCase):
+	def testHistogram(self):
+		"""Tests that values are counted into the first bucket whose bound they don't exceed."""
+		histogram = metrics.Histogram((1, 10))
+		for value in (0.5, 1, 5, 10, 11, 1000):
+			histogram.observe(value)
+		self.assertEquals({'count': 6, 'sum': 1027.5, 'mean': 1027.5 / 6, 'buckets': [(1, 2), (10, 2), (None, 2)]}, histogram.as_dict())
+		self.assertEquals(0.0, metrics.Histogram().as_dict()['mean'])
+	
+	def testRegistry(self):
+		"""Tests that counters and histograms are kept per geocoder, and passed on to listeners."""
+		registry, seen = metrics.MetricsRegistry(), []
+		def broken(*args):
+			raise ValueError('A broken exporter')
+		registry.add_listener(broken)
+		registry.add_listener(lambda *args: seen.append(args))
+		registry.increment('cache_hits', 'google')
+		registry.increment('cache_hits', 'google', 2)
+		registry.increment('cache_misses', 'google')
+		registry.increment('cache_misses', 'yahoo')
+		registry.observe('fetch_seconds', 'google', 0.2)
+		registry.observe('bytes_received', 'google', 5000, metrics.SIZE_BUCKETS)
+		snapshot = registry.snapshot()
+		self.assertEquals((3, 1, 0.75), (snapshot['google']['cache_hits'], snapshot['google']['cache_misses'], snapshot['google']['cache_hit_ratio']))
+		self.assertEquals(0.0, snapshot['yahoo']['cache_hit_ratio'])
+		self.assertEquals((1, 0.2), (snapshot['google']['fetch_seconds']['count'], snapshot['google']['fetch_seconds']['sum']))
+		self.assertEquals((16384, 1), snapshot['google']['bytes_received']['buckets'][3])
+		self.assertEquals(('counter', 'cache_hits', 'google', 2), seen[1])
+		self.assertEquals(('histogram', 'fetch_seconds', 'google', 0.2), seen[4])
+		registry.reset()
+		self.assertEquals({}, registry.snapshot())
+		settings.GEOCODING_METRICS = False
+		try:
+			registry.increment('cache_hits', 'google')
+			registry.observe('fetch_seconds', 'google', 0.2)
+		finally:
+			del settings.GEOCODING_METRICS
+		self.assertEquals(({}, 6), (registry.snapshot(), len(seen)))
+	
+	def testSaveWithoutDefaultGeocoder(self):
+		"""Tests that saving an ungeocoded location doesn't need settings.DEFAULT_GEOCODER."""
+		default = settings.DEFAULT_GEOCODER
+		del settings.DEFAULT_GEOCODER
+		try:
+			geo_models.Location.objects.create(query=u'London, UK', geocoded=False, latitude=51.5, longitude=-0.12)
+		finally:
+			settings.DEFAULT_GEOCODER = default
+		self.assertEquals(1, geo_models.Location.objects.count())
+	
+	def testTimings(self):
+		"""Tests that time spent waiting for the body counts as fetching it, and time spent parsing it as parsing,
+		   although they're interleaved when streaming."""
+		import time
+		from cStringIO import StringIO
+		class SlowSource(object):
+			# The body takes 0.05s to arrive
+			def __init__(self, body):
+				self.body, self.started = StringIO(body), False
+			def read(self, size=-1):
+				if not self.started:
+					self.started = True
+					time.sleep(0.05)
+				return self.body.read(size)
+		class SlowTransport(object):
+			def open(self, url, timeout=None):
+				return transport.Response(SlowSource(GEONAMES_RESPONSE))
+		class SlowGeocoder(geocoding.GeoNamesGeocoder):
+			# And 0.05s to parse
+			transport = SlowTransport()
+			def parse_streaming(self, source):
+				super(SlowGeocoder, self).parse_streaming(source)
+				time.sleep(0.05)
+		metrics.registry.reset()
+		SlowGeocoder(u'London, UK').lookup()
+		snapshot = metrics.snapshot()['geonames']
+		self.assert_(0.05 <= snapshot['fetch_seconds']['sum'] < 0.09)
+		self.assert_(0.05 <= snapshot['parse_seconds']['sum'] < 0.09)
+
+class GazetteerTests(TestCase):
+	def setUp(self):
+		self.gazetteer = gazetteer.Gazetteer().load(GAZETTEER_FIXTURE.splitlines())
+		return super(GazetteerTests, self).setUp()
+	
+	def testLookup(self):
+		"""Tests that the most populous match is found, and that a country qualifier narrows the search."""
+		self.assertEquals(u'GB', self.gazetteer.lookup(u'London').country_code)
+		self.assertEquals(u'GB', self.gazetteer.lookup(u' london,uk ').country_code)
+		self.assertEquals(u'CA', self.gazetteer.lookup(u'London, Canada').country_code)
+		self.assertEquals(u'US', self.gazetteer.lookup(u'Paris, US').country_code)
+		self.assertEquals(u'FR', self.gazetteer.lookup(u'Parigi').country_code)
+		self.assertEquals(3, self.gazetteer.lookup(u'United Kingdom').granularity)
+		self.assertEquals(None, self.gazetteer.lookup(u'Atlantis'))
+		self.assertEquals([u'london', u'londra', u'londres'], self.gazetteer.complete(u'Lond'))
+	
+	def testGeocoder(self):
+		"""Tests that the gazetteer geocoder fills in a GeocodingResult like the online geocoders."""
+		gazetteer.set_gazetteer(self.gazetteer)
+		try:
+			result = geocoding.GazetteerGeocoder(DummyLocation(u'Sydney, Australia')).geocode()
+			self.assertEquals((-33.86785, 151.20732, 58.0), tuple(result.coords))
+			self.assertEquals(u'AU', result.response.data[u'countrycode'].text)
+			self.assertRaises(geocoding.GeocodingError, geocoding.GazetteerGeocoder(DummyLocation(u'Atlantis')).geocode)
+		finally:
+			gazetteer.set_gazetteer(None)
+	
+	def testReverse(self):
+		"""Tests that the nearest populated place is found, including across the antimeridian and near a pole."""
+		place = self.gazetteer.reverse(51.5, -0.1)
+		self.assertEquals((u'London', u'United Kingdom'), (place.name, place.country))
+		self.assert_(place.distance < 5)
+		self.assertEquals(u'Apia', self.gazetteer.reverse(-15.0, 179.9).name)
+		self.assertEquals(u'Longyearbyen', self.gazetteer.reverse(89.0, -120.0).name)
+		self.assertEquals([u'Paris', u'Sydney'], [place.name for place in self.gazetteer.reverse_many((48.0, -34.0), (2.0, 151.0))])
+
+class DeadlineTests(TestCase):
+	def setUp(self):
+		self.now = [1262304000.0]
+		self.clock = lambda: self.now[0]
+		return super(DeadlineTests, self).setUp()
+	
+	def testBudget(self):
+		"""Tests that the time left is never handed out as a zero timeout, and that no deadline never expires."""
+		deadline = Deadline(1.0, self.clock)
+		self.assertEquals((1.0, 1.0, False), (deadline.remaining(), deadline.timeout(), deadline.expired))
+		self.now[0] += 1.0
+		self.assertEquals((0.0, True), (deadline.remaining(), deadline.expired))
+		self.assertRaises(GeocodingTimeout, deadline.timeout)
+		self.assertRaises(GeocodingTimeout, deadline.check)
+		self.assertEquals((None, None, False), (Deadline().remaining(), Deadline().timeout(), Deadline().expired))
+	
+	def testExpired(self):
+		"""Tests that nothing is requested once the deadline has passed."""
+		opened = []
+		class RecordingTransport(object):
+			def fetch(self, url, timeout=None):
+				opened.append(url)
+				return GEONAMES_RESPONSE
+		geocoding.GeoNamesGeocoder.transport = RecordingTransport()
+		try:
+			geocoder = geocoding.GeoNamesGeocoder(u'London, UK', Deadline(1.0, self.clock))
+			self.now[0] += 1.5
+			self.assertRaises(GeocodingTimeout, geocoder.lookup)
+		finally:
+			geocoding.GeoNamesGeocoder.transport = None
+		self.assertEquals([], opened)
+	
+	def testReads(self):
+		"""Tests that a response which trickles in is cut off once the deadline passes part-way through it."""
+		now, timeouts = self.now, []
+		class TricklingSource(object):
+			def read(self, size):
+				now[0] += 0.4
+				return 'x' * size
+		class Socket(object):
+			def settimeout(self, timeout):
+				timeouts.append(timeout)
+		response = transport.Response(TricklingSource(), sock=Socket())
+		response.chunk_size = 10
+		response.deadline = Deadline(1.0, self.clock)
+		self.assertRaises(GeocodingTimeout, response.read)
+		self.assertEquals(30, response.received)
+		self.assertEquals([1.0, 0.6, 0.2], [round(timeout, 6) for timeout in timeouts])
+	
+	def testSocketTimeout(self):
+		"""Tests that a response which is too slow fails with GeocodingTimeout."""
+		import time
+		server = replay.ReplayServer(latency=0.5).start()
+		geocoding.GeoNamesGeocoder.transport = transport.PooledHTTPTransport(host_overrides=server.host_overrides)
+		try:
+			started = time.time()
+			self.assertRaises(GeocodingTimeout, geocoding.GeoNamesGeocoder(u'London, UK', 0.2).lookup)
+			self.assert_(time.time() - started < 0.4)
+		finally:
+			geocoding.GeoNamesGeocoder.transport.close()
+			geocoding.GeoNamesGeocoder.transport = None
+			server.stop()
+
+class GeocodingResultTests(TestCase):
+	# A GeocodingResult pickled by a version of this module from before __slots__ were used
+	legacy_pickle = "ccopy_reg\n_reconstructor\np0\n(cgeo.geocoding\nGeocodingResult\np1\nc__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\nS'query'\np6\nVLondon, UK\np7\nsS'coords'\np8\ng0\n(cgeo.geocoding\nCoordinates\np9\ng2\nNtp10\nRp11\n(dp12\nS'latitude'\np13\nF51.5\nsS'elevation'\np14\nF0.0\nsS'longitude'\np15\nF-0.12\nsS'granularity'\np16\nI11\nsbsS'response'\np17\ng0\n(cgeo.geocoding\nXMLResponse\np18\ng2\nNtp19\nRp20\n(dp21\nS'raw'\np22\nS''\np23\nsg8\ng0\n(g9\ng2\nNtp24\nRp25\n(dp26\ng13\nF0.0\nsg14\nF0.0\nsg15\nF0.0\nsg16\nI0\nsbsS'data'\np27\n(dp28\nVlatitude\np29\ng0\n(cgeo.geocoding\nXMLElement\np30\ng2\nNtp31\nRp32\n(dp33\nS'text'\np34\nV51.5\np35\nsS'tag'\np36\ng29\nsS'attrs'\np37\n(dp38\nsbssbsb."
+	
+	def testPickling(self):
+		"""Tests that results survive a round trip through pickle."""
+		import pickle
+		result = geocoding.GeocodingResult()
+		result.query = u'London, UK'
+		result.coords = geocoding.Coordinates(51.5, -0.12, 0, 11)
+		result.response.data[u'latitude'] = geocoding.XMLElement(u'latitude', u'51.5')
+		result = pickle.loads(pickle.dumps(result))
+		self.assertEquals(u'London, UK', result.query)
+		self.assertEquals((51.5, -0.12, 0.0), tuple(result.coords))
+		self.assertEquals(11, result.coords.granularity)
+		self.assertEquals(51.5, float(result.response.data[u'latitude']))
+	
+	def testStoredResult(self):
+		"""Tests that only the coordinates and selected attributes are kept in the persisted form of a result."""
+		import pickle
+		result = geocoding.GeocodingResult()
+		result.query, result.provider = u'London, UK', u'geonames'
+		result.coords = geocoding.Coordinates(51.5, -0.12, 0, 11)
+		result.response.raw = '<geonames>...</geonames>'
+		for tag, text in ((u'lat', u'51.5'), (u'name', u'London'), (u'population', u'7556900')):
+			result.response.data[tag] = geocoding.XMLElement(tag, text)
+		stored = pickle.loads(pickle.dumps(geocoding.store_result(result, retain_raw=False)))
+		self.assertEquals((u'London, UK', u'geonames', None), (stored.query, stored.provider, stored.raw))
+		self.assertEquals((51.5, -0.12, 0.0), tuple(stored.coords))
+		self.assertEquals({u'name': u'London'}, stored.attributes)
+		self.assertEquals(stored, geocoding.store_result(stored))
+		self.assertEquals('<geonames>...</geonames>', geocoding.store_result(result, retain_raw=True).raw)
+	
+	def testLegacyPickles(self):
+		"""Tests that results pickled before __slots__ were used can still be loaded."""
+		import pickle
+		result = pickle.loads(self.legacy_pickle)
+		self.assertEquals(u'London, UK', result.query)
+		self.assertEquals((51.5, -0.12, 0.0), tuple(result.coords))
+		self.assertEquals(u'latitude', result.response.data[u'latitude'].tag)
+		self.assertEquals(None, result.provider)
+
+class RefresherTests(TestCase):
+	def setUp(self):
+		gazetteer.set_gazetteer(gazetteer.Gazetteer().load(GAZETTEER_FIXTURE.splitlines()))
+		self.stale = datetime.datetime(2000, 1, 1)
+		for query in (u'London, UK', u'Atlantis', u'Sydney, Australia'):
+			# Created ungeocoded so that save() doesn't try to reach a provider
+			geo_models.Location.objects.create(query=query, geocoded=False, latitude=0, longitude=0)
+		geo_models.Location.objects.all().update(geocoded=True, refreshed=self.stale, expires_at=None)
+		return super(RefresherTests, self).setUp()
+	
+	def tearDown(self):
+		gazetteer.set_gazetteer(None)
+		return super(RefresherTests, self).tearDown()
+	
+	def testRefresh(self):
+		"""Tests that expired locations are re-geocoded in chunks, and that failures are left to expire again."""
+		report = refresher.refresh_expired(chunk_size=2, provider='gazetteer')
+		self.assertEquals((2, 1, 2), (report.refreshed, report.failed, report.chunks))
+		london = geo_models.Location.objects.get(query=u'London, UK')
+		self.assertEquals((51.50853, -0.12574), (london.latitude, london.longitude))
+		self.assertEquals(u'gazetteer', london.result.provider)
+		self.assert_(london.refreshed > self.stale)
+		self.assertEquals(self.stale, geo_models.Location.objects.get(query=u'Atlantis').refreshed)
+	
+	def testResume(self):
+		"""Tests that a run starts after the last location recorded in the progress file."""
+		import os, tempfile
+		handle, path = tempfile.mkstemp()
+		os.close(handle)
+		refresher.write_progress(path, geo_models.Location.objects.get(query=u'Atlantis').pk)
+		report = refresher.refresh_expired(provider='gazetteer', progress_file=path)
+		self.assertEquals((1, 0), (report.refreshed, report.failed))
+		self.assertEquals(self.stale, geo_models.Location.objects.get(query=u'London, UK').refreshed)
+		self.failIf(os.path.exists(path))
+	
+	def testStaleWhileRevalidate(self):
+		"""Tests that a stale location is saved without geocoding and then re-geocoded in the background."""
+		refresher.refresh_expired(provider='gazetteer')
+		queue = refresher.RevalidationQueue(workers=0, provider='gazetteer')
+		refresher.set_revalidation_queue(queue)
+		expiry.set_expiry_policy(expiry.ExpiryPolicy(max_age={'days': 30}, max_ages=(), jitter=0))
+		settings.GEOCODING_STALE_WHILE_REVALIDATE = True
+		try:
+			expired = datetime.datetime.now() - datetime.timedelta(days=31)
+			geo_models.Location.objects.all().update(refreshed=expired, expires_at=None, latitude=0)
+			location = geo_models.Location.objects.get(query=u'London, UK')
+			self.assert_(location.stale)
+			location.is_public = False
+			location.save()
+			location.save()
+			location = geo_models.Location.objects.get(query=u'London, UK')
+			self.assertEquals((0, False), (location.latitude, location.is_public))
+			self.assertEquals(1, queue.drain())
+			self.assertEquals(51.50853, geo_models.Location.objects.get(query=u'London, UK').latitude)
+			location.refreshed, location.expires_at = self.stale, None
+			self.failIf(location.stale)
+		finally:
+			settings.GEOCODING_STALE_WHILE_REVALIDATE = False
+			refresher.set_revalidation_queue(None)
+			expiry.set_expiry_policy(None)
+
+class ExpiryTests(TestCase):
+	def testPolicy(self):
+		"""Tests that coarser results live longer (and never shorter than finer ones), and that expiry is spread
+		   deterministically over a range."""
+		policy = expiry.ExpiryPolicy(max_age={'days': 30}, jitter=0.1)
+		refreshed = datetime.datetime(2010, 1, 1)
+		fixed = expiry.ExpiryPolicy(max_age={'days': 30}, jitter=0)
+		self.assertEquals(refreshed + datetime.timedelta(days=30), fixed.expires(refreshed, 17))
+		self.assertEquals(refreshed + datetime.timedelta(days=30), fixed.expires(refreshed))
+		self.assertEquals(datetime.datetime(2010, 4, 1), fixed.expires(refreshed, 11))
+		self.assertEquals(datetime.datetime(2011, 1, 1), fixed.expires(refreshed, 3))
+		# A tier shorter than the maximum age is lengthened to it
+		fixed = expiry.ExpiryPolicy(max_age={'years': 2}, jitter=0)
+		self.assertEquals([datetime.datetime(2012, 1, 1)] * 3, [fixed.expires(refreshed, granularity) for granularity in (3, 11, 17)])
+		expires = [policy.expires(refreshed, 17, u'query %d' % i) for i in range(100)]
+		self.assertEquals(expires, [policy.expires(refreshed, 17, u'query %d' % i) for i in range(100)])
+		self.assert_(min(expires) >= refreshed + datetime.timedelta(days=27))
+		self.assert_(max(expires) <= refreshed + datetime.timedelta(days=30))
+		self.assert_(len(set(expires)) > 90)
+		self.assert_(policy.expires(refreshed, 11, u'London') > refreshed + datetime.timedelta(days=60))
+	
+	def testExpiredQuery(self):
+		"""Tests that the manager finds rows by their stored expiry time, falling back to their refreshed time."""
+		for query in (u'London, UK', u'Paris, France', u'Sydney, Australia'):
+			geo_models.Location.objects.create(query=query, geocoded=False, latitude=0, longitude=0)
+		now = datetime.datetime.now()
+		geo_models.Location.objects.filter(query=u'London, UK').update(expires_at=now - datetime.timedelta(days=1))
+		geo_models.Location.objects.filter(query=u'Paris, France').update(expires_at=None, refreshed=datetime.datetime(2000, 1, 1))
+		self.assertEquals([u'London, UK', u'Paris, France'], sorted([location.query for location in geo_models.Location.objects.expired]))
+
+class ResponseFormatTests(TestCase):
+	def lookup(self, geocoder, body):
+		geocoder.transport = benchmarks.StaticTransport(body)
+		try:
+			return geocoding.store_result(geocoder(u'London, UK').lookup())
+		finally:
+			geocoder.transport = None
+	
+	def testGoogle(self):
+		"""Tests that the JSON and XML geocoders read Google's longitude, latitude coordinates the right way round,
+		   and give the same result."""
+		result = self.lookup(geocoding.GoogleJSONGeocoder, GOOGLE_JSON_RESPONSE)
+		self.assertEquals((51.5001524, -0.1262362, 0.0), tuple(result.coords))
+		self.assertEquals(11, result.coords.granularity)
+		self.assertEquals({u'address': u'London, UK', u'countrynamecode': u'GB'}, result.attributes)
+		xml = self.lookup(geocoding.GoogleGeocoder, GOOGLE_RESPONSE)
+		self.assertEquals((tuple(xml.coords), xml.coords.granularity, xml.attributes), (tuple(result.coords), result.coords.granularity, result.attributes))
+	
+	def testGoogleStatus(self):
+		"""Tests that Google's quota and key errors are raised as such, and aren't remembered as the query's fault."""
+		xml = '<?xml version="1.0" encoding="UTF-8" ?><kml xmlns="http://earth.google.com/kml/2.0"><Response><name>Paris</name><Status><code>%s</code><request>geocode</request></Status></Response></kml>'
+		json = '{"name": "Paris", "Status": {"code": %s, "request": "geocode"}}'
+		for geocoder, body in ((geocoding.GoogleGeocoder, xml), (geocoding.GoogleJSONGeocoder, json)):
+			self.assertRaises(GeocodingQuotaExceeded, self.lookup, geocoder, body % 620)
+			self.assertRaises(GeocoderUnavailable, self.lookup, geocoder, body % 610)
+			try:
+				self.lookup(geocoder, body % 602)
+			except GeocoderUnavailable:
+				self.fail('An unknown address was blamed on the geocoder.')
+			except geocoding.GeocodingError:
+				pass
+			geocoder.transport = benchmarks.StaticTransport(body % 620)
+			geo_cache.get_cache().clear()
+			try:
+				self.assertRaises(GeocodingQuotaExceeded, geocoder(u'Paris').geocode)
+			finally:
+				geocoder.transport = None
+			self.assertEquals(None, geo_cache.get_cache().get_failure(geocoder.short_name, u'Paris'))
+	
+	def testGeoNames(self):
+		"""Tests that the JSON and XML geocoders give the same result, and that GeoNames' errors are raised."""
+		xml = self.lookup(geocoding.GeoNamesGeocoder, GEONAMES_RESPONSE)
+		result = self.lookup(geocoding.GeoNamesJSONGeocoder, GEONAMES_JSON_RESPONSE)
+		self.assertEquals((tuple(xml.coords), xml.coords.granularity, xml.attributes), (tuple(result.coords), result.coords.granularity, result.attributes))
+		self.assertEquals(11, result.coords.granularity)
+		self.assertRaises(geocoding.GeocodingError, self.lookup, geocoding.GeoNamesJSONGeocoder, '{"totalResultsCount": 0, "geonames": []}')
+		self.assertRaises(GeocodingQuotaExceeded, self.lookup, geocoding.GeoNamesJSONGeocoder, '{"status": {"message": "the daily limit of 30000 credits has been exceeded", "value": 18}}')
+	
+	def testEmptyElements(self):
+		"""Tests that empty elements are read as empty strings, and left out of the stored attributes."""
+		for streaming in (True, False):
+			settings.GEOCODING_STREAMING_PARSE = streaming
+			try:
+				result = self.lookup(geocoding.YahooGeocoder, YAHOO_RESPONSE)
+			finally:
+				del settings.GEOCODING_STREAMING_PARSE
+			self.assertEquals({u'city': u'London', u'state': u'United Kingdom', u'country': u'GB'}, result.attributes)
+	
+	def testRepeatedTags(self):
+		"""Tests that the first of a repeated tag is used whether the response is parsed incrementally or not."""
+		row = GEONAMES_RESPONSE[GEONAMES_RESPONSE.index('<geoname>'):GEONAMES_RESPONSE.index('</geonames>')]
+		paris = row.replace('London', 'Paris').replace('51.50853', '48.85341').replace('-0.12574', '2.3488')
+		body = GEONAMES_RESPONSE.replace(row, row + paris)
+		streamed = self.lookup(geocoding.GeoNamesGeocoder, body)
+		settings.GEOCODING_STREAMING_PARSE = False
+		try:
+			parsed = self.lookup(geocoding.GeoNamesGeocoder, body)
+		finally:
+			del settings.GEOCODING_STREAMING_PARSE
+		self.assertEquals(((51.50853, -0.12574, 0.0), {u'name': u'London', u'countrycode': u'GB', u'fcode': u'PPLC'}), (tuple(streamed.coords), streamed.attributes))
+		self.assertEquals((tuple(streamed.coords), streamed.attributes), (tuple(parsed.coords), parsed.attributes))
+	
+	def testSelection(self):
+		"""Tests that settings.GEOCODING_RESPONSE_FORMATS picks the JSON variant of a provider."""
+		settings.GEOCODING_RESPONSE_FORMATS = {'google': 'json'}
+		try:
+			self.assertEquals(geocoding.GoogleJSONGeocoder, geocoding.get_geocoder('google'))
+			self.assertEquals(geocoding.GeoNamesGeocoder, geocoding.get_geocoder('geonames'))
+		finally:
+			del settings.GEOCODING_RESPONSE_FORMATS
+
+class TransportTests(TestCase):
+	def testDecompression(self):
+		"""Tests that gzip and deflate (with or without its zlib header) bodies are decompressed as they're read."""
+		import zlib
+		from cStringIO import StringIO
+		body = benchmarks.geonames_rows(50)
+		raw_deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+		for encoding, compressed in (('gzip', benchmarks.compress(body, 'gzip')), ('deflate', benchmarks.compress(body, 'deflate')),
+				('deflate', raw_deflate.compress(body) + raw_deflate.flush()), (None, body)):
+			closed = []
+			response = transport.Response(StringIO(compressed), encoding, closed.append)
+			response.chunk_size = 100
+			self.assertEquals(body[:10], response.read(10))
+			self.assertEquals(body[10:], response.read())
+			response.close()
+			self.assertEquals((body, len(compressed), [True]), (response.content, response.received, closed))
+		self.assertRaises(GeocoderUnavailable, transport.Response(StringIO('not gzip'), 'gzip').read)
+	
+	def testStreaming(self):
+		"""Tests that a long response is only read as far as the parser needs."""
+		static = benchmarks.StaticTransport(benchmarks.geonames_rows(1000))
+		geocoding.GeoNamesGeocoder.transport = static
+		try:
+			result = geocoding.GeoNamesGeocoder(u'London, UK').lookup()
+		finally:
+			geocoding.GeoNamesGeocoder.transport = None
+		self.assertEquals((51.50853, -0.12574, 0.0), tuple(result.coords))
+		self.assert_(static.received < len(static.body))
+		self.assertEquals(None, result.response.raw)
+		# Nor when the rest of the body was small enough to be drained when the response was closed
+		body = benchmarks.geonames_rows(70)
+		self.assert_(0 < len(body) - transport.Response.chunk_size <= transport.Response.drain_limit)
+		geocoding.GeoNamesGeocoder.transport = benchmarks.StaticTransport(body)
+		try:
+			result = geocoding.GeoNamesGeocoder(u'London, UK').lookup()
+		finally:
+			geocoding.GeoNamesGeocoder.transport = None
+		self.assertEquals(None, result.response.raw)
+		settings.GEOCODING_RETAIN_RAW = True
+		try:
+			geocoding.GeoNamesGeocoder.transport = benchmarks.StaticTransport(body)
+			result = geocoding.GeoNamesGeocoder(u'London, UK').lookup()
+		finally:
+			geocoding.GeoNamesGeocoder.transport = None
+			del settings.GEOCODING_RETAIN_RAW
+		self.assertEquals(body, result.response.raw)
+	
+	def testDrain(self):
+		"""Tests that closing a response reads a small remainder, so the connection can be reused, but not a large one."""
+		from cStringIO import StringIO
+		for remainder, finished in ((transport.Response.drain_limit, True), (transport.Response.drain_limit + 1, False)):
+			closed = []
+			response = transport.Response(StringIO('x' * (100 + remainder)), None, closed.append)
+			response.chunk_size = 100
+			response.read(100)
+			response.close()
+			self.assertEquals([finished], closed)
+			self.assert_(response.received <= 100 + transport.Response.drain_limit + 1)
+	
+	def testMissingStoredTag(self):
+		"""Tests that a stored tag missing from the response doesn't make the parser read the rest of it."""
+		static = benchmarks.StaticTransport(benchmarks.geonames_rows(1000).replace('<countryCode>GB</countryCode>', ''))
+		geocoding.GeoNamesGeocoder.transport = static
+		try:
+			result = geocoding.store_result(geocoding.GeoNamesGeocoder(u'London, UK').lookup())
+		finally:
+			geocoding.GeoNamesGeocoder.transport = None
+		self.assertEquals(((51.50853, -0.12574, 0.0), {u'name': u'London', u'fcode': u'PPLC'}), (tuple(result.coords), result.attributes))
+		self.assert_(static.received < len(static.body))
+
+class ReplayTests(TestCase):
+	def testReplay(self):
+		"""Tests that the geocoders work end to end against the replay server, over pooled connections."""
+		server = replay.ReplayServer(seed=0).start()
+		pooled = transport.PooledHTTPTransport(host_overrides=server.host_overrides)
+		try:
+			for geocoder, coords in ((geocoding.YahooGeocoder, (51.506325, -0.127144, 0.0)), (geocoding.GoogleGeocoder, (51.5001524, -0.1262362, 0.0)),
+					(geocoding.GoogleJSONGeocoder, (51.5001524, -0.1262362, 0.0)), (geocoding.GeoNamesGeocoder, (51.50853, -0.12574, 0.0)), (geocoding.GeoNamesJSONGeocoder, (51.50853, -0.12574, 0.0))):
+				geocoder.transport = pooled
+				try:
+					self.assertEquals(coords, tuple(geocoder(u'London, UK').lookup().coords))
+					self.assertEquals(coords, tuple(geocoder(u'London, UK').lookup().coords))
+				finally:
+					geocoder.transport = None
+			self.assertEquals(10, server.requests)
+			self.assertEquals(1, len(pooled.pools.values()[0]))
+			server.error_rate = 1
+			self.assertRaises(GeocoderUnavailable, pooled.fetch, 'http://ws.geonames.org/search?q=London')
+			server.error_status = 302
+			self.assertRaises(GeocoderUnavailable, pooled.fetch, 'http://ws.geonames.org/search?q=London')
+		finally:
+			pooled.close()
+			server.stop()
+
+class GeocodeManyTests(TestCase):
+	def setUp(self):
+		self.server = replay.ReplayServer(seed=0).start()
+		self.pooled = transport.PooledHTTPTransport(host_overrides=self.server.host_overrides)
+		geocoding.GeoNamesGeocoder.transport = self.pooled
+		geo_cache.get_cache().clear()
+		return super(GeocodeManyTests, self).setUp()
+	
+	def tearDown(self):
+		geocoding.GeoNamesGeocoder.transport = None
+		geo_cache.get_cache().clear()
+		self.pooled.close()
+		self.server.stop()
+		return super(GeocodeManyTests, self).tearDown()
+	
+	def testBatch(self):
+		"""Tests that every query is yielded once with its result, and that a failed query doesn't abort the batch."""
+		queries = [u'London %d, UK' % i for i in range(10)] + [u'Atlantis']
+		geo_cache.get_cache().set_failure('geonames', u'Atlantis', u'Not found')
+		results = dict(geocoding.geocode_many(iter(queries), 'geonames', max_workers=3))
+		self.assertEquals(sorted(queries), sorted(results))
+		self.assert_(isinstance(results[u'Atlantis'], geocoding.GeocodingError))
+		for query in queries[:-1]:
+			self.assertEquals((query, (51.50853, -0.12574, 0.0)), (results[query].query, tuple(results[query].coords)))
+		self.assertEquals(10, self.server.requests)
+	
+	def testDeadline(self):
+		"""Tests that the batch's timeout is shared by all its queries, which fail once it's spent."""
+		import time
+		self.server.latency = 0.5
+		started = time.time()
+		results = list(geocoding.geocode_many([u'London %d, UK' % i for i in range(6)], 'geonames', max_workers=2, timeout=0.2))
+		self.assert_(time.time() - started < 0.5)
+		self.assertEquals(6, len(results))
+		for query, result in results:
+			self.assert_(isinstance(result, geocoding.GeocodingTimeout), result)
+
+class ProximityTests(TestCase):
+	def testByProximity(self):
+		"""Tests that candidates are filtered and ordered by a single distance calculation each."""
+		points = benchmarks.random_points(200, spread=1.0)
+		calls, seconds = benchmarks.counting_distances(lambda: proximity.by_proximity(points, (51.5, -0.12), 30))
+		self.assertEquals([], proximity.by_proximity(points, (51.5, -0.12), 0))
+		nearby = proximity.by_proximity(points, (51.5, -0.12), 30)
+		self.assertEquals(200, calls)
+		self.assert_(0 < len(nearby) < 200)
+		distances = [point.distance.miles for point in nearby]
+		self.assertEquals(sorted(distances), distances)
+		self.assert_(max(distances) <= 30)
+		self.assertEquals(len(points), len(proximity.by_proximity(points, (51.5, -0.12))))
+	
+	def testManager(self):
+		"""Tests that the manager orders locations by proximity and attaches their distances."""
+		for query, latitude, longitude in ((u'London', 51.50853, -0.12574), (u'Paris', 48.85341, 2.3488), (u'Reading', 51.45625, -0.97113), (u'Sydney', -33.86785, 151.20732)):
+			geo_models.Location.objects.create(query=query, geocoded=False, latitude=latitude, longitude=longitude)
+		london = geo_models.Location.objects.get(query=u'London')
+		nearby = geo_models.Location.objects.by_proximity_to_location(london)
+		self.assertEquals([u'Reading', u'Paris', u'Sydney'], [location.query for location in nearby])
+		self.assertEquals(int(london.distance_between(nearby[1])), int(nearby[1].distance.miles))
+		self.assertEquals([u'Reading', u'Paris'], [location.query for location in geo_models.Location.objects.by_proximity_to_location(london, 300)])
+
+class DistanceTests(TestCase):
+	def testKernels(self):
+		"""Tests that the vectorized distances match geopy's (Vincenty) and the one point at a time haversine."""
+		points = [(point.latitude, point.longitude) for point in benchmarks.random_points(100, spread=80.0)] + [(51.5, -0.12), (0.0, 90.0), (-51.5, 179.88)]
+		latitudes, longitudes = [point[0] for point in points], [point[1] for point in points]
+		numpy = distances.numpy
+		try:
+			for distances.numpy in set([numpy, None]):
+				vincenty = distances.distances((51.5, -0.12), latitudes, longitudes, 'vincenty')
+				haversine = distances.distances((51.5, -0.12), latitudes, longitudes, 'haversine')
+				for point, kilometers, great_circle in zip(points, vincenty, haversine):
+					self.assertAlmostEquals(distances.python_vincenty(51.5, -0.12, point[0], point[1]), kilometers, 6)
+					self.assertAlmostEquals(distances.python_haversine(51.5, -0.12, point[0], point[1]), great_circle, 6)
+				# The antipode, where Vincenty's formula doesn't converge
+				self.assertAlmostEquals(distances.python_haversine(51.5, -0.12, -51.5, 179.88), distances.distance((51.5, -0.12), (-51.5, 179.88), 'vincenty'), 6)
+		finally:
+			distances.numpy = numpy
+		self.assertRaises(ValueError, distances.distances, (0, 0), [0], [0], 'flat')
+
+class GeohashTests(TestCase):
+	def testEncoding(self):
+		"""Tests geohashes against known values, and that a point falls in its decoded cell."""
+		self.assertEquals('u4pruydqqvj', geohash.encode(57.64911, 10.40744, 11))
+		self.assertEquals('ezs42', geohash.encode(42.6, -5.6, 5))
+		south, west, north, east = geohash.decode('gcpvj0')
+		self.assert_(south <= 51.50853 < north and west <= -0.12574 < east)
+	
+	def testCover(self):
+		"""Tests that every point in a bounding box falls in one of its cover's ranges, across the antimeridian too."""
+		import random
+		random.seed(0)
+		for south, west, north, east in ((51.3, -0.5, 51.7, 0.3), (-20.0, 170.0, -10.0, -170.0), (85.0, -180.0, 90.0, 180.0), (-1.0, -1.0, 1.0, 1.0)):
+			ranges = geohash.cover(south, west, north, east, 16)
+			self.assert_(len(ranges) <= 32)
+			for i in range(200):
+				longitude = random.uniform(west, west <= east and east or east + 360)
+				point = geohash.encode(random.uniform(south, north), longitude > 180 and longitude - 360 or longitude)
+				self.assert_([low for low, high in ranges if low <= point and (high is None or point < high)])
+	
+	def testQueries(self):
+		"""Tests that bounding box queries use the geohash prefilter, and find rows which haven't been backfilled."""
+		for query, latitude, longitude in ((u'London', 51.50853, -0.12574), (u'Reading', 51.45625, -0.97113), (u'Apia', -13.83333, -171.76666), (u'Suva', -18.14161, 178.44149)):
+			geo_models.Location.objects.create(query=query, geocoded=False, latitude=latitude, longitude=longitude)
+		self.assertEquals(geohash.encode(51.50853, -0.12574), geo_models.Location.objects.get(query=u'London').geohash)
+		geo_models.Location.objects.filter(query__in=[u'Reading', u'Suva']).update(geohash=None)
+		self.assertEquals([u'London', u'Reading'], sorted([location.query for location in geo_models.Location.objects.within_bounds((52.0, -1.0), (51.0, 0.0))]))
+		self.assertEquals([u'Apia', u'Suva'], sorted([location.query for location in geo_models.Location.objects.in_box(-20.0, 175.0, -10.0, -170.0)]))
+		self.assertEquals(2, refresher.backfill_geohashes(chunk_size=1))
+		self.assertEquals(0, geo_models.Location.objects.filter(geohash__isnull=True).count())
+		self.assertEquals([u'Apia', u'Suva'], sorted([location.query for location in geo_models.Location.objects.in_box(-20.0, 175.0, -10.0, -170.0)]))
+
+class BoundingBoxTests(TestCase):
+	def inside(self, box, latitude, longitude):
+		south, west, north, east = box
+		if not south <= latitude <= north:
+			return False
+		if west <= east:
+			return west <= longitude <= east
+		return longitude >= west or longitude <= east
+	
+	def testEnvelope(self):
+		"""Tests that bounding boxes are tight at the equator, widen with latitude, and cover poles and the antimeridian."""
+		south, west, north, east = distances.bounding_box(0.0, 0.0, 111.2)
+		self.assertAlmostEquals(1.0, north, 1)
+		self.assertAlmostEquals(1.0, east, 1)
+		south, west, north, east = distances.bounding_box(60.0, 0.0, 111.2)
+		self.assertAlmostEquals(2.0, east, 1)
+		self.assertEquals((-180.0, 90.0, 180.0), distances.bounding_box(89.9, 0.0, 50)[1:])
+		south, west, north, east = distances.bounding_box(-89.9, 0.0, 50)
+		self.assertEquals((-90.0, -180.0, 180.0), (south, west, east))
+		south, west, north, east = distances.bounding_box(70.0, 179.9, 100, 'miles')
+		self.assert_(west > east)
+		self.assert_(self.inside((south, west, north, east), 70.0, -179.5))
+	
+	def testNoFalseNegatives(self):
+		"""Tests that every point within the radius (by Vincenty's formula) falls in the box, including at extreme latitudes."""
+		import random
+		random.seed(0)
+		for latitude in (0.0, 45.0, -60.0, 80.0, 88.0, -89.5):
+			for longitude in (0.0, 179.5, -179.9):
+				for radius in (1.0, 50.0, 500.0):
+					box = distances.bounding_box(latitude, longitude, radius)
+					for i in range(100):
+						point = (random.uniform(-90, 90), random.uniform(-180, 180))
+						if random.random() < 0.9:
+							# Most points are placed near the origin
+							point = (max(-90.0, min(90.0, latitude + random.uniform(-1, 1) * radius / 100.0)), ((longitude + random.uniform(-1, 1) * radius / 10.0 + 180) % 360) - 180)
+						if distances.python_vincenty(latitude, longitude, point[0], point[1]) <= radius:
+							self.assert_(self.inside(box, point[0], point[1]), (latitude, longitude, radius, point))
+	
+	def testManager(self):
+		"""Tests that proximity searches find locations across a pole and the antimeridian, and take kilometers."""
+		for query, latitude, longitude in ((u'Origin', 89.9, 0.0), (u'Across the pole', 89.9, 180.0), (u'Far', 85.0, 0.0), (u'East', 70.0, 179.9), (u'West', 70.0, -179.5)):
+			geo_models.Location.objects.create(query=query, geocoded=False, latitude=latitude, longitude=longitude)
+		origin = geo_models.Location.objects.get(query=u'Origin')
+		self.assertEquals([u'Across the pole'], [location.query for location in geo_models.Location.objects.by_proximity_to_location(origin, radius_kilometers=50)])
+		east = geo_models.Location.objects.get(query=u'East')
+		self.assertEquals([u'West'], [location.query for location in geo_models.Location.objects.by_proximity_to_location(east, 100)])
+
+class NearestTests(TestCase):
+	def testNearest(self):
+		"""Tests that the k nearest locations match those found by ordering every row, without fetching every row."""
+		for i, point in enumerate(benchmarks.random_points(300, spread=3.0)):
+			geo_models.Location.objects.create(query=u'Point %d' % i, geocoded=False, latitude=point.latitude, longitude=point.longitude)
+		everything = proximity.by_proximity(geo_models.Location.objects.all(), (51.5, -0.12))
+		calls, seconds = benchmarks.counting_distances(lambda: geo_models.Location.objects.nearest((51.5, -0.12), 5))
+		self.assert_(calls < 300)
+		nearest = geo_models.Location.objects.nearest((51.5, -0.12), 5)
+		self.assertEquals([location.pk for location in everything[:5]], [location.pk for location in nearest])
+		self.assertEquals([location.distance.miles for location in everything[:5]], [location.distance.miles for location in nearest])
+		self.assertEquals([location.pk for location in everything[:50]], [location.pk for location in geo_models.Location.objects.nearest((51.5, -0.12), 50)])
+		# The origin location is left out
+		origin = everything[0]
+		self.assertEquals([location.pk for location in everything[1:4]], [location.pk for location in geo_models.Location.objects.nearest(origin, 3)])
+		# A limited radius, and more locations than there are
+		within = [location.pk for location in everything if location.distance.miles <= 30]
+		self.assertEquals(within, [location.pk for location in geo_models.Location.objects.nearest((51.5, -0.12), 300, 30)])
+		self.assert_(0 < len(within) < 300)
+		self.assertEquals(300, len(geo_models.Location.objects.nearest((-51.5, 179.88), 400)))
+		self.assertEquals([], geo_models.Location.objects.nearest((51.5, -0.12), 0))
+	
+	def testLargeRadius(self):
+		"""Tests that max_radius still applies once the search has widened to cover the globe."""
+		for query, latitude, longitude in ((u'Near', 0.0, 1.0), (u'Far', 0.0, 60.0), (u'Too far', 10.0, 120.0), (u'Furthest', 0.0, 170.0)):
+			geo_models.Location.objects.create(query=query, geocoded=False, latitude=latitude, longitude=longitude)
+		self.assertEquals([u'Near', u'Far'], [location.query for location in geo_models.Location.objects.nearest((0.0, 0.0), 10, max_radius=7000)])
+		self.assertEquals([u'Near', u'Far', u'Too far', u'Furthest'], [location.query for location in geo_models.Location.objects.nearest((0.0, 0.0), 10)])
+
 class GeocodingTest(TestCase):
 	def __init__(self, *args, **kwargs):
 		self.query = 'London, UK'
@@ -0,0 +1,316 @@
+"""HTTP transports used by the geocoders to fetch provider responses. The default transport keeps a pool
+   of persistent (keep-alive) connections per host, shared by every XMLGeocoder subclass and safe to use
+   from any thread. Responses are requested gzip or deflate compressed, and decompressed as they're read so
+   they can be parsed while they're still arriving."""
+import httplib, socket, threading, time, urllib2, urlparse, zlib
+from cStringIO import StringIO
+
+from django.conf import settings
+
+from geo.misc import GeocoderUnavailable, GeocodingTimeout
+
+DEFAULT_TRANSPORT = 'geo.transport.PooledHTTPTransport'
+
+def reraise(function):
+	"""Calls function, raising GeocodingTimeout or GeocoderUnavailable for the errors a socket read can raise."""
+	try:
+		return function()
+	except socket.timeout:
+		raise GeocodingTimeout('The geocoder didn\'t respond in time.')
+	except (httplib.HTTPException, socket.error), e:
+		raise GeocoderUnavailable('The geocoder could not be reached (%s).' % e)
+
+class Response(object):
+	"""A response body read from source (a file-like object) and decompressed on the fly according to its
+	   Content-Encoding ('gzip', 'deflate' or None). received counts the bytes read from source, read_seconds
+	   the time spent waiting for them, and content holds the decompressed data read so far (all of the body,
+	   once complete is True). on_close, if given, is called by close() with whether the whole body was read
+	   (so a connection can be reused).
+	   
+	   If deadline (a geo.misc.Deadline) is set, it's checked before every read from source, and sock (the
+	   socket source reads from, if known) has its timeout lowered to the time left, so that a response which
+	   trickles in can't outlast the deadline."""
+	chunk_size = 16384
+	# Most unread bytes close() will consume so a connection can still be reused (such as the end of a chunked
+	# body). With any more left, on_close() is told the body wasn't finished and the connection is closed.
+	drain_limit = 1024
+	
+	def __init__(self, source, encoding=None, on_close=None, sock=None, *args, **kwargs):
+		self.source, self.encoding, self.on_close, self.sock = source, encoding, on_close, sock
+		self.deadline = None
+		self.decompressor = None
+		if encoding == 'gzip':
+			self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		elif encoding == 'deflate':
+			self.decompressor = zlib.decompressobj()
+		self.received = 0
+		self.read_seconds = 0.0
+		self.chunks = []
+		self.buffer = ''
+		self.finished = False
+		self.read_to_end = False # Unlike finished, not set if close() drained the rest of the body
+		self.closed = False
+		return super(Response, self).__init__(*args, **kwargs)
+	
+	@property
+	def content(self):
+		return ''.join(self.chunks)
+	
+	@property
+	def complete(self):
+		"""Whether content holds the whole body."""
+		return self.read_to_end and not self.buffer
+	
+	def decompress(self, data):
+		try:
+			return self.decompressor.decompress(data)
+		except zlib.error, e:
+			if self.encoding == 'deflate' and self.received == len(data):
+				# Some servers send raw deflate data without the zlib header 'deflate' calls for
+				self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+				return self.decompress(data)
+			raise GeocoderUnavailable('The geocoder\'s compressed response could not be read (%s).' % e)
+	
+	def read_source(self, size):
+		"""Reads up to size bytes from source, counting them and the time taken."""
+		started = time.time()
+		data = self.source.read(size)
+		self.read_seconds += time.time() - started
+		self.received += len(data)
+		return data
+	
+	def read_chunk(self):
+		"""Returns the next piece of the decompressed body, or '' at its end."""
+		while not self.finished:
+			if self.deadline is not None:
+				timeout = self.deadline.timeout()
+				if self.sock is not None:
+					self.sock.settimeout(timeout)
+			data = reraise(lambda: self.read_source(self.chunk_size))
+			if not data:
+				self.finished = self.read_to_end = True
+				return self.decompressor is not None and self.decompressor.flush() or ''
+			if self.decompressor is None:
+				return data
+			data = self.decompress(data)
+			if data:
+				return data
+		return ''
+	
+	def read(self, size=-1):
+		pieces, length = [self.buffer], len(self.buffer)
+		while (size < 0 or length < size) and not self.finished:
+			chunk = self.read_chunk()
+			pieces.append(chunk)
+			length += len(chunk)
+		data = ''.join(pieces)
+		self.buffer = ''
+		if size >= 0:
+			data, self.buffer = data[:size], data[size:]
+		if data:
+			self.chunks.append(data)
+		return data
+	
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		# A little unread data is cheaper to read than a new connection, but a lot isn't (if source is an
+		# httplib response with a Content-Length, its length says how much is left)
+		remaining = getattr(self.source, 'length', None)
+		if not self.finished and (remaining is None or remaining <= self.drain_limit):
+			try:
+				drained = 0
+				while drained <= self.drain_limit:
+					data = self.read_source(self.drain_limit + 1 - drained)
+					if not data:
+						self.finished = True
+						break
+					drained += len(data)
+			except (httplib.HTTPException, socket.error):
+				pass
+		if self.on_close is not None:
+			self.on_close(self.finished)
+
+class Transport(object):
+	"""Base class for geocoder transports. Subclasses must implement open() or fetch(), which are by default
+	   implemented in terms of each other."""
+	def __init__(self, host_overrides=None, compress=True, *args, **kwargs):
+		# Maps a provider's host (e.g. 'ws.geonames.org') to another 'host[:port]', which makes it easy to
+		# point the geocoders at a local stub server.
+		self.host_overrides = host_overrides or {}
+		# Whether to ask for gzip or deflate compressed responses
+		self.compress = compress
+		return super(Transport, self).__init__(*args, **kwargs)
+	
+	@property
+	def request_headers(self):
+		headers = {'Connection': 'keep-alive'}
+		if self.compress:
+			headers['Accept-Encoding'] = 'gzip, deflate'
+		return headers
+	
+	def rewrite(self, url):
+		"""Returns the passed URL with its host replaced according to self.host_overrides."""
+		parts = urlparse.urlsplit(str(url))
+		if parts[1] in self.host_overrides:
+			parts = (parts[0], self.host_overrides[parts[1]]) + tuple(parts[2:])
+		return urlparse.urlunsplit(parts)
+	
+	def open(self, url, timeout=None):
+		"""Requests url and returns a Response to read its (decompressed) body from. timeout is the number of
+		   seconds allowed for connecting and for each read (None for no limit). Should raise a GeocodingTimeout
+		   if that's exceeded, or a GeocoderUnavailable if the request fails."""
+		return Response(StringIO(self.fetch(url, timeout)))
+	
+	def fetch(self, url, timeout=None):
+		"""Fetches url and returns the whole (decompressed) response body as a string."""
+		response = self.open(url, timeout)
+		try:
+			return response.read()
+		finally:
+			response.close()
+
+class UrllibTransport(Transport):
+	"""Opens a new connection for every request using urllib2 (the original behaviour)."""
+	def open(self, url, timeout=None):
+		request = urllib2.Request(self.rewrite(url), headers=self.request_headers)
+		try:
+			if timeout is None:
+				response = urllib2.urlopen(request)
+			else:
+				response = urllib2.urlopen(request, timeout=timeout)
+			return Response(response, response.info().get('Content-Encoding'), lambda finished: response.close())
+		except socket.timeout:
+			raise GeocodingTimeout('The geocoder didn\'t respond in time.')
+		except urllib2.URLError, e:
+			if isinstance(e.reason, socket.timeout):
+				raise GeocodingTimeout('The geocoder didn\'t respond in time.')
+			raise GeocoderUnavailable('The geocoder could not be reached (%s).' % e)
+		except (httplib.HTTPException, socket.error), e:
+			raise GeocoderUnavailable('The geocoder could not be reached (%s).' % e)
+
+class PooledHTTPTransport(Transport):
+	"""Keeps up to max_connections idle keep-alive connections per (scheme, host, port) and reuses them
+	   between requests, so repeated geocodes don't pay for a new TCP (and DNS) setup every time."""
+	connection_classes = {
+		'http': httplib.HTTPConnection,
+		'https': httplib.HTTPSConnection,
+	}
+	
+	def __init__(self, max_connections=4, *args, **kwargs):
+		self.max_connections = max_connections
+		self.pools = {}
+		self.lock = threading.Lock()
+		return super(PooledHTTPTransport, self).__init__(*args, **kwargs)
+	
+	def acquire(self, key, timeout=None):
+		"""Returns an idle connection for key from the pool, or a new one if there are none, with its socket
+		   timeout set to timeout."""
+		self.lock.acquire()
+		try:
+			pool = self.pools.get(key)
+			connection = pool and pool.pop() or None
+		finally:
+			self.lock.release()
+		if timeout is None:
+			timeout = socket.getdefaulttimeout()
+		if connection is None:
+			scheme, host, port = key
+			return self.connection_classes[scheme](host, port, timeout=timeout)
+		connection.timeout = timeout
+		if connection.sock is not None:
+			connection.sock.settimeout(timeout)
+		return connection
+	
+	def release(self, key, connection):
+		"""Returns connection to the pool for key (or closes it if the pool is already full)."""
+		self.lock.acquire()
+		try:
+			pool = self.pools.setdefault(key, [])
+			if len(pool) < self.max_connections:
+				pool.append(connection)
+				return
+		finally:
+			self.lock.release()
+		connection.close()
+	
+	def close(self):
+		"""Closes every pooled connection."""
+		self.lock.acquire()
+		try:
+			pools, self.pools = self.pools, {}
+		finally:
+			self.lock.release()
+		for pool in pools.values():
+			for connection in pool:
+				connection.close()
+	
+	def open(self, url, timeout=None):
+		parts = urlparse.urlsplit(self.rewrite(url))
+		if parts[0] not in self.connection_classes:
+			raise GeocoderUnavailable('Unsupported URL scheme: %s' % parts[0])
+		key = (parts[0], parts.hostname, parts.port)
+		path = urlparse.urlunsplit(('', '', parts[2] or '/', parts[3], ''))
+		# A pooled connection may have been dropped by the server since it was last used, so a failure on a
+		# reused connection is retried once on a fresh one.
+		for attempt in (0, 1):
+			connection = self.acquire(key, timeout)
+			reused = connection.sock is not None
+			try:
+				connection.request('GET', path, headers=self.request_headers)
+				response = connection.getresponse()
+			except socket.timeout:
+				connection.close()
+				raise GeocodingTimeout('The geocoder didn\'t respond in time.')
+			except (httplib.HTTPException, socket.error), e:
+				connection.close()
+				if reused and not attempt:
+					continue
+				raise GeocoderUnavailable('The geocoder could not be reached (%s).' % e)
+			def on_close(finished, key=key, connection=connection, response=response):
+				# The connection can only be reused once the whole of this response has been read from it
+				if finished and not response.will_close:
+					self.release(key, connection)
+				else:
+					connection.close()
+			# The socket the body is read from (the connection's own is closed if the response will close it)
+			body = Response(response, response.getheader('Content-Encoding'), on_close, getattr(response.fp, '_sock', None))
+			# Redirects aren't followed, so a 3xx response (whose body the parsers can't read) is an error too
+			if not 200 <= response.status < 300:
+				body.close()
+				raise GeocoderUnavailable('The geocoder returned HTTP %s.' % response.status)
+			return body
+
+def import_transport(path):
+	"""Imports a transport class given its full dotted path."""
+	module, attr = path.rsplit('.', 1)
+	return getattr(__import__(module, {}, {}, [attr]), attr)
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+	"""Returns the transport shared by all geocoders, creating it from settings.GEOCODING_TRANSPORT and
+	   settings.GEOCODING_TRANSPORT_OPTIONS on first use."""
+	global _transport
+	if _transport is None:
+		_transport_lock.acquire()
+		try:
+			if _transport is None:
+				transport_class = import_transport(getattr(settings, 'GEOCODING_TRANSPORT', DEFAULT_TRANSPORT))
+				options = getattr(settings, 'GEOCODING_TRANSPORT_OPTIONS', {})
+				_transport = transport_class(**dict([(str(k), v) for k, v in options.items()]))
+		finally:
+			_transport_lock.release()
+	return _transport
+
+def set_transport(transport):
+	"""Replaces the shared transport (e.g. with one pointed at a stub server for benchmarking). Passing None
+	   makes the next get_transport() call rebuild it from settings."""
+	global _transport
+	_transport_lock.acquire()
+	try:
+		_transport = transport
+	finally:
+		_transport_lock.release()